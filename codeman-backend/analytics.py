@@ -0,0 +1,223 @@
+"""
+Pre-aggregated counters for the admin dashboard.
+
+Write paths call record("posts", category_id) and similar. The event
+goes into an in-memory buffer, so the request pays nothing but a list
+append. flush_loop() writes the buffer every FLUSH_INTERVAL seconds as one
+upsert per (metric, bucket, period, dimension) into StatCounter, adding to
+whatever is there. Every event lands in an hourly and a daily bucket, and
+in the "" (total) dimension as well as its own dimension if it has one.
+
+Daily active users are counted the same way. The auth middleware calls
+seen(user_id), which buffers the user once per day per worker. On flush
+the (day, user) pairs go into ActiveUserDay with INSERT OR IGNORE, and the
+number of rows actually inserted is added to the "active_users" counter.
+So several workers seeing the same user still count them once.
+
+GET /api/admin/analytics reads series() for any date range. That is one
+index range scan on StatCounter, with cost set by the number of periods,
+not by how many posts or users there are.
+
+rebuild() recomputes the counters that have a source table (posts,
+comments, works, signups, active_users) from scratch. It runs as the
+"analytics.rebuild" job for backfills, or when a counter is suspected to
+have drifted. Rows that were hard-deleted are not counted again.
+Other workers may still hold increments for rows the rebuild just counted.
+So the rebuild stamps its start time in SystemSetting (EPOCH_KEY), and a
+flush drops buffered events recorded before it. Active users need no such
+care: their rows are counted once by ActiveUserDay's unique key either way.
+"""
+import asyncio
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Set, Tuple
+
+from peewee import EXCLUDED, fn
+
+from models import db, ActiveUserDay, Comment, Post, StatCounter, SystemSetting, User, Work
+
+FLUSH_INTERVAL = 10
+EPOCH_KEY = "analytics_rebuilt_at"
+HOUR_RETENTION = timedelta(days=90)
+ACTIVE_USER_RETENTION = timedelta(days=400)
+BUCKETS = ("hour", "day")
+REBUILT_METRICS = {
+    "posts": Post,
+    "comments": Comment,
+    "works": Work,
+    "signups": User,
+}
+
+def period_start(moment: datetime, bucket: str) -> datetime:
+    if bucket == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _step(bucket: str) -> timedelta:
+    return timedelta(hours=1) if bucket == "hour" else timedelta(days=1)
+
+class Recorder:
+    """Buffers counter events and active users until the next flush."""
+
+    def __init__(self):
+        self._events: List[Tuple[datetime, str, str, int]] = [] # (recorded at, metric, dimension, n)
+        self._active: Set[Tuple[datetime, int]] = set()
+        self._seen_day: Optional[datetime] = None
+        self._seen: Set[int] = set() # Users already buffered or flushed today by this worker
+        self._lock = threading.Lock()
+
+    def record(self, metric: str, dimension=None, n: int = 1) -> None:
+        event = (datetime.utcnow(), metric, "" if dimension is None else str(dimension), n)
+        with self._lock:
+            self._events.append(event)
+
+    def seen(self, user_id: int) -> None:
+        day = period_start(datetime.utcnow(), "day")
+        with self._lock:
+            if day != self._seen_day:
+                self._seen_day = day
+                self._seen = set()
+            if user_id in self._seen:
+                return
+            self._seen.add(user_id)
+            self._active.add((day, user_id))
+
+    def flush(self) -> int:
+        with self._lock:
+            events, self._events = self._events, []
+            active, self._active = self._active, set()
+        if not events and not active:
+            return 0
+        try:
+            self._write(events, active)
+        except Exception as e:
+            print(f"Analytics flush error: {e}")
+            with self._lock:  # retry on the next tick
+                self._events[:0] = events
+                self._active |= active
+            return 0
+        return len(events) + len(active)
+
+    def _write(self, events: list, active: set) -> None:
+        with db.atomic():
+            counts = defaultdict(int)
+            epoch = rebuilt_at()
+            for moment, metric, dimension, n in events:
+                if epoch is not None and moment < epoch:
+                    continue  # already counted by rebuild() from the source table
+                dims = [""] if dimension == "" else ["", dimension]
+                for bucket in BUCKETS:
+                    start = period_start(moment, bucket)
+                    for dim in dims:
+                        counts[(metric, bucket, start, dim)] += n
+            if active:
+                new_per_day = defaultdict(int)
+                for day, user_id in active:
+                    inserted = (ActiveUserDay.insert(day=day, user=user_id)
+                                .on_conflict_ignore().as_rowcount().execute())
+                    new_per_day[day] += inserted
+                for day, n in new_per_day.items():
+                    if n:
+                        counts[("active_users", "day", day, "")] += n
+            if counts:
+                rows = [{"metric": m, "bucket": b, "period_start": p, "dimension": d, "value": n}
+                        for (m, b, p, d), n in counts.items()]
+                (StatCounter.insert_many(rows)
+                 .on_conflict(conflict_target=[StatCounter.metric, StatCounter.bucket,
+                                               StatCounter.period_start, StatCounter.dimension],
+                              update={StatCounter.value: StatCounter.value + EXCLUDED.value})
+                 .execute())
+
+    async def flush_loop(self) -> None:
+        try:
+            while True:
+                await asyncio.sleep(FLUSH_INTERVAL)
+                await asyncio.to_thread(self.flush)
+        finally:
+            self.flush()
+
+recorder = Recorder()
+record = recorder.record
+seen = recorder.seen
+
+def series(metrics: Iterable[str], bucket: str = "day", since: Optional[datetime] = None,
+           until: Optional[datetime] = None, dimension: str = "") -> dict:
+    """Zero-filled time series for each metric, oldest period first."""
+    metrics = list(metrics)
+    until = period_start(until or datetime.utcnow(), bucket)
+    since = period_start(since or until - 29 * _step(bucket), bucket)
+    periods: List[datetime] = []
+    moment = since
+    while moment <= until:
+        periods.append(moment)
+        moment += _step(bucket)
+
+    values = {m: {} for m in metrics}
+    rows = (StatCounter.select(StatCounter.metric, StatCounter.period_start, StatCounter.value)
+            .where((StatCounter.metric.in_(metrics)) & (StatCounter.bucket == bucket) &
+                   (StatCounter.dimension == dimension) &
+                   (StatCounter.period_start >= since) & (StatCounter.period_start <= until))
+            .tuples())
+    for metric, start, value in rows:
+        values[metric][start] = value
+    return {
+        "bucket": bucket,
+        "periods": periods,
+        "series": {m: [values[m].get(p, 0) for p in periods] for m in metrics}
+    }
+
+def breakdown(metric: str, since: datetime, limit: int = 10) -> List[dict]:
+    """Totals per dimension from the daily buckets, largest first."""
+    total = fn.SUM(StatCounter.value)
+    rows = (StatCounter.select(StatCounter.dimension, total.alias("total"))
+            .where((StatCounter.metric == metric) & (StatCounter.bucket == "day") &
+                   (StatCounter.dimension != "") & (StatCounter.period_start >= period_start(since, "day")))
+            .group_by(StatCounter.dimension)
+            .order_by(total.desc())
+            .limit(limit)
+            .tuples())
+    return [{"dimension": d, "total": t} for d, t in rows]
+
+def rebuilt_at() -> Optional[datetime]:
+    value = SystemSetting.select(SystemSetting.value).where(SystemSetting.key == EPOCH_KEY).scalar()
+    return datetime.fromisoformat(value) if value else None
+
+def rebuild() -> None:
+    """Recomputes the counters that have a source table."""
+    formats = {"hour": "%Y-%m-%d %H:00:00", "day": "%Y-%m-%d 00:00:00"}
+    # IMMEDIATE: no row commits between the epoch and the counts below
+    with db.atomic("IMMEDIATE"):
+        (SystemSetting.insert(key=EPOCH_KEY, value=datetime.utcnow().isoformat())
+         .on_conflict(conflict_target=[SystemSetting.key], preserve=[SystemSetting.value])
+         .execute())
+        StatCounter.delete().where(StatCounter.metric.in_(list(REBUILT_METRICS) + ["active_users"])).execute()
+        for metric, model in REBUILT_METRICS.items():
+            for bucket, fmt in formats.items():
+                period = fn.strftime(fmt, model.created_at)
+                source = (model.select(metric, bucket, period, "", fn.COUNT(model.id))
+                          .where(model.created_at.is_null(False))
+                          .group_by(period))
+                StatCounter.insert_from(source, [StatCounter.metric, StatCounter.bucket, StatCounter.period_start,
+                                                 StatCounter.dimension, StatCounter.value]).execute()
+            if metric == "posts":
+                for bucket, fmt in formats.items():
+                    period = fn.strftime(fmt, Post.created_at)
+                    source = (Post.select("posts", bucket, period, Post.category.cast("TEXT"), fn.COUNT(Post.id))
+                              .where(Post.category.is_null(False))
+                              .group_by(period, Post.category))
+                    StatCounter.insert_from(source, [StatCounter.metric, StatCounter.bucket, StatCounter.period_start,
+                                                     StatCounter.dimension, StatCounter.value]).execute()
+        source = (ActiveUserDay.select("active_users", "day", ActiveUserDay.day, "", fn.COUNT(ActiveUserDay.id))
+                  .group_by(ActiveUserDay.day))
+        StatCounter.insert_from(source, [StatCounter.metric, StatCounter.bucket, StatCounter.period_start,
+                                         StatCounter.dimension, StatCounter.value]).execute()
+
+def prune() -> int:
+    """Drops hourly buckets and active-user rows past their retention."""
+    now = datetime.utcnow()
+    removed = (StatCounter.delete()
+               .where((StatCounter.bucket == "hour") & (StatCounter.period_start < now - HOUR_RETENTION))
+               .execute())
+    removed += ActiveUserDay.delete().where(ActiveUserDay.day < now - ACTIVE_USER_RETENTION).execute()
+    return removed
@@ -0,0 +1,96 @@
+"""
+Per-item serialization cost for a 100-post /api/posts page.
+
+    python benchmarks/serialization.py [--items 100] [--rounds 200]
+
+Compares the previous path (hand-built dicts -> response_model validation ->
+jsonable_encoder -> stdlib json) with serializers.py (precompiled row
+serializers -> orjson bytes). No database access: rows are built in memory.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import List
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# Importing main creates key files and a DB in the working directory
+os.chdir(tempfile.mkdtemp(prefix="codeman-bench-"))
+os.environ.setdefault("DB_PATH", os.path.join(os.getcwd(), "bench.db"))
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+import serializers
+from main import PostRead
+from models import Post, User
+
+def build_rows(count: int) -> list:
+    author = User(id=1, codemao_id="10001", username="bench_user", avatar_url="https://static.codemao.cn/a.png",
+                  description="Benchmark author", is_admin=False)
+    now = datetime.utcnow()
+    content = "## Heading\n\n" + "Some **markdown** body text with a [link](https://example.com). " * 20
+    return [
+        Post(id=i, title=f"Post title {i}", content=content, excerpt=content[:200], category=1,
+             created_at=now, updated_at=now, views=i * 3, likes=i, is_pinned=(i == 0), user=author)
+        for i in range(count)
+    ]
+
+def legacy_path(rows: list, adapter: TypeAdapter) -> bytes:
+    payload = [{
+        "id": p.id,
+        "title": p.title,
+        "content": p.content,
+        "excerpt": p.excerpt,
+        "category_id": p.category_id,
+        "created_at": p.created_at,
+        "updated_at": p.updated_at,
+        "views": p.views,
+        "likes": p.likes,
+        "is_liked": False,
+        "is_pinned": p.is_pinned,
+        "user": {
+            "id": p.user.id,
+            "codemao_id": p.user.codemao_id,
+            "username": p.user.username,
+            "avatar_url": p.user.avatar_url,
+            "description": p.user.description,
+            "is_admin": p.user.is_admin
+        }
+    } for p in rows]
+    validated = adapter.validate_python(payload)
+    return json.dumps(jsonable_encoder(validated), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def fast_path(rows: list) -> bytes:
+    return serializers.dumps([serializers.serialize_post(p) for p in rows])
+
+def timeit(fn, rounds: int) -> float:
+    fn()  # warm-up
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--items", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    rows = build_rows(args.items)
+    adapter = TypeAdapter(List[PostRead])
+
+    legacy = timeit(lambda: legacy_path(rows, adapter), args.rounds)
+    fast = timeit(lambda: fast_path(rows), args.rounds)
+
+    encoder = "orjson" if serializers.orjson is not None else "json (orjson not installed)"
+    print(f"{args.items} posts/page, {args.rounds} rounds, encoder: {encoder}")
+    print(f"{'path':<10}{'per page':>14}{'per item':>14}{'bytes':>10}")
+    for name, seconds, body in (("legacy", legacy, legacy_path(rows, adapter)), ("fast", fast, fast_path(rows))):
+        print(f"{name:<10}{seconds * 1e3:>11.3f} ms{seconds / args.items * 1e6:>11.2f} us{len(body):>10}")
+    print(f"speedup: {legacy / fast:.1f}x")
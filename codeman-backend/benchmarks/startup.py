@@ -0,0 +1,96 @@
+"""
+Cold-start cost of the API process.
+
+    python benchmarks/startup.py [--top 15] [--runs 3]
+
+For a fresh working directory (no keys, no database) and then a warm one
+(keys and schema already in place), reports:
+  * the slowest modules by cumulative import time (python -X importtime -c "import main")
+  * time-to-first-request: spawn `uvicorn main:app` and poll GET / until it answers
+"""
+import argparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def env_for(workdir: str) -> dict:
+    env = dict(os.environ)
+    env["DB_PATH"] = os.path.join(workdir, "bench.db")
+    env["PYTHONPATH"] = BACKEND_DIR + os.pathsep + env.get("PYTHONPATH", "")
+    env["RATE_LIMIT_STORAGE_URI"] = "memory://"
+    env.pop("DEBUG", None)
+    return env
+
+def import_times(workdir: str) -> list:
+    """Returns [(cumulative_us, self_us, module)] for the top-level imports of main."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                          cwd=workdir, env=env_for(workdir), capture_output=True, text=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue  # header line
+        rows.append((int(cumulative_us), int(self_us), name[1:].rstrip()))  # drop the separator space
+    return rows
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def time_to_first_request(workdir: str, timeout: float = 60.0) -> float:
+    port = free_port()
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                            cwd=workdir, env=env_for(workdir), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                req = urllib.request.Request(f"http://127.0.0.1:{port}/", headers={"User-Agent": "startup-bench"})
+                with urllib.request.urlopen(req, timeout=1):
+                    return time.perf_counter() - start
+            except OSError:
+                if proc.poll() is not None:
+                    raise RuntimeError("uvicorn exited before serving a request")
+                time.sleep(0.01)
+        raise RuntimeError(f"no response within {timeout}s")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def report(label: str, workdir: str, top: int, runs: int) -> None:
+    # Serve first so the cold pass really starts without keys or a database
+    samples = [time_to_first_request(workdir) for _ in range(runs)]
+    rows = import_times(workdir)
+    total = next((cum for cum, _, name in rows if name.strip() == "main"), 0)
+    print(f"\n== {label} ==")
+    print(f"import main: {total / 1e3:.1f} ms")
+    print(f"{'cumulative':>12}{'self':>10}  module")
+    # Direct children of main (two-space indent) are what main.py pays for
+    children = [r for r in rows if r[2].startswith("  ") and not r[2].startswith("   ")]
+    for cumulative, self_us, name in sorted(children, reverse=True)[:top]:
+        print(f"{cumulative / 1e3:>9.1f} ms{self_us / 1e3:>7.1f} ms  {name.strip()}")
+    print(f"time to first request: min {min(samples) * 1e3:.0f} ms, max {max(samples) * 1e3:.0f} ms ({runs} runs)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="codeman-startup-")
+    try:
+        # First pass runs without key files or a database, so it includes their creation
+        report("cold (no keys, no database)", workdir, args.top, 1)
+        report("warm (keys and schema present)", workdir, args.top, args.runs)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
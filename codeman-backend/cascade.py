@@ -0,0 +1,248 @@
+"""
+Chunked background cascade deletes for posts, works and users.
+
+start() hides the target at once: it sets is_deleted on a post or work, or
+bans a user and hides their posts and works. It then records a Deletion row
+and enqueues a "cascade.run" job (jobs.py). The job walks the target's
+steps in order. Each step removes up to CHUNK rows per short transaction,
+so a 5,000-comment thread never holds the SQLite write lock for more than
+a few milliseconds at a time. Between transactions it sleeps for PAUSE
+seconds so request writes get in.
+
+Progress (current step and rows removed per step) is saved on the Deletion
+row after every chunk, and GET /api/deletions/{id} reads it. The steps are
+idempotent queries, so a job that is retried or picked up after a crash
+just carries on.
+
+A step either deletes matching rows or, for rows other users still see
+(a purged user's comments), blanks them the way delete_comment does.
+Likes also decrement the counter they contributed to. Pending reports on
+the comments of a deleted post or work are dropped with them.
+
+Write paths check visibility against the database (not entity_cache), but a
+like or comment that passed the check just before the hide can still land
+after its step ran. So a post or work cascade sweeps every step once more
+before it deletes the parent row.
+"""
+import json
+import time
+from datetime import datetime
+from typing import Callable, List, Optional
+
+from peewee import fn
+
+import entity_cache
+import jobs
+from models import (db, Comment, CommentLike, ConversationSummary, ChatMessage, Deletion, DirectMessage, Follow,
+                    FriendRequest, Notification, OAuthCode, Post, PostLike, Report, ReportTarget, TimelineEntry, User,
+                    Work, WorkComment, WorkCommentLike, WorkLike)
+
+CHUNK = 500
+PAUSE = 0.05
+DELETED_COMMENT = "[This comment has been deleted]"
+
+class Step:
+    def __init__(self, name: str, model, where: Callable, blank: Optional[dict] = None, counter=None):
+        self.name = name
+        self.model = model
+        self.where = where # target_id -> expression, built lazily so subqueries see current rows
+        self.blank = blank # Update these fields instead of deleting the row
+        self.counter = counter # (counted model, fk field on self.model, count field) to decrement
+
+    def run_chunk(self, target_id: int) -> int:
+        """Removes up to CHUNK rows; returns how many."""
+        model = self.model
+        where = self.where(target_id)
+        if self.blank is not None:
+            where = where & ((model.is_deleted == False) | model.is_deleted.is_null())
+        with db.atomic():
+            # Newest first, so replies go before the comments they reply to
+            ids = [i for (i,) in model.select(model.id).where(where).order_by(model.id.desc()).limit(CHUNK).tuples()]
+            if not ids:
+                return 0
+            if self.counter is not None:
+                counted, fk, count_field = self.counter
+                for parent_id, n in (model.select(fk, fn.COUNT(model.id)).where(model.id.in_(ids))
+                                     .group_by(fk).tuples()):
+                    (counted.update({count_field: count_field - n})
+                     .where(counted._meta.primary_key == parent_id).execute())
+            if self.blank is not None:
+                model.update(self.blank).where(model.id.in_(ids)).execute()
+            else:
+                model.delete().where(model.id.in_(ids)).execute()
+        return len(ids)
+
+def _post_comments(post_id):
+    return Comment.select(Comment.id).where(Comment.post == post_id)
+
+def _work_pk(work_id):
+    return Work.select(Work.id).where(Work.work_id == work_id)
+
+def _work_comments(work_id):
+    return WorkComment.select(WorkComment.id).where(WorkComment.work.in_(_work_pk(work_id)))
+
+def _report_targets(target_type: str, comments):
+    # Report targets store ids as text
+    keys = comments.select(comments.model.id.cast("TEXT"))
+    return ReportTarget.select(ReportTarget.id).where((ReportTarget.target_type == target_type) &
+                                                      (ReportTarget.target_id.in_(keys)))
+
+def _pending_reports(target_type: str, comments):
+    return (Report.status == "pending") & Report.group.in_(_report_targets(target_type, comments))
+
+def _open_report_targets(target_type: str, comments):
+    # Pending targets with nothing left in them; resolved history stays
+    orphaned = ~fn.EXISTS(Report.select(Report.id).where(Report.group == ReportTarget.id))
+    return (ReportTarget.status == "pending") & ReportTarget.id.in_(_report_targets(target_type, comments)) & orphaned
+
+POST_STEPS = [
+    Step("comment_reports", Report, lambda pid: _pending_reports("comment", _post_comments(pid))),
+    Step("comment_report_targets", ReportTarget, lambda pid: _open_report_targets("comment", _post_comments(pid))),
+    Step("comment_likes", CommentLike, lambda pid: CommentLike.comment.in_(_post_comments(pid))),
+    Step("comments", Comment, lambda pid: Comment.post == pid),
+    Step("post_likes", PostLike, lambda pid: PostLike.post == pid),
+    Step("notifications", Notification, lambda pid: (Notification.target_type == "post") & (Notification.target_id == pid)),
+    Step("timeline", TimelineEntry, lambda pid: (TimelineEntry.item_type == "post") & (TimelineEntry.item_id == pid)),
+    Step("post", Post, lambda pid: Post.id == pid),
+]
+
+WORK_STEPS = [
+    Step("comment_reports", Report, lambda wid: _pending_reports("work_comment", _work_comments(wid))),
+    Step("comment_report_targets", ReportTarget, lambda wid: _open_report_targets("work_comment", _work_comments(wid))),
+    Step("comment_likes", WorkCommentLike, lambda wid: WorkCommentLike.comment.in_(_work_comments(wid))),
+    Step("comments", WorkComment, lambda wid: WorkComment.work.in_(_work_pk(wid))),
+    Step("work_likes", WorkLike, lambda wid: WorkLike.work.in_(_work_pk(wid))),
+    Step("notifications", Notification, lambda wid: (Notification.target_type == "work") & (Notification.target_id == wid)),
+    Step("timeline", TimelineEntry, lambda wid: (TimelineEntry.item_type == "work") & (TimelineEntry.item_id == wid)),
+    Step("work", Work, lambda wid: Work.work_id == wid),
+]
+
+# A user's own posts and works get their own cascades (see _start_children);
+# these steps clear what the user left elsewhere. The User row is kept and
+# scrubbed at the end, since announcements and resolved reports point at it.
+USER_STEPS = [
+    Step("post_likes", PostLike, lambda uid: PostLike.user == uid, counter=(Post, PostLike.post, Post.likes)),
+    Step("comment_likes", CommentLike, lambda uid: CommentLike.user == uid, counter=(Comment, CommentLike.comment, Comment.likes)),
+    Step("work_likes", WorkLike, lambda uid: WorkLike.user == uid, counter=(Work, WorkLike.work, Work.likes)),
+    Step("work_comment_likes", WorkCommentLike, lambda uid: WorkCommentLike.user == uid,
+         counter=(WorkComment, WorkCommentLike.comment, WorkComment.likes)),
+    Step("comments", Comment, lambda uid: Comment.user == uid, blank={Comment.is_deleted: True, Comment.content: DELETED_COMMENT}),
+    Step("work_comments", WorkComment, lambda uid: WorkComment.user == uid,
+         blank={WorkComment.is_deleted: True, WorkComment.content: DELETED_COMMENT}),
+    Step("follows", Follow, lambda uid: (Follow.follower == uid) | (Follow.followed == uid)),
+    Step("notifications", Notification, lambda uid: (Notification.recipient == uid) | (Notification.sender == uid)),
+    Step("timeline", TimelineEntry, lambda uid: (TimelineEntry.owner == uid) | (TimelineEntry.author == uid)),
+    Step("chat_messages", ChatMessage, lambda uid: ChatMessage.user == uid),
+    Step("direct_messages", DirectMessage, lambda uid: (DirectMessage.sender == uid) | (DirectMessage.recipient == uid)),
+    Step("conversations", ConversationSummary, lambda uid: (ConversationSummary.owner == uid) | (ConversationSummary.peer == uid)),
+    Step("friend_requests", FriendRequest, lambda uid: (FriendRequest.sender == uid) | (FriendRequest.recipient == uid)),
+    Step("oauth_codes", OAuthCode, lambda uid: OAuthCode.user == uid),
+    Step("reports", Report, lambda uid: (Report.reporter == uid) & (Report.status == "pending")),
+]
+
+STEPS = {"post": POST_STEPS, "work": WORK_STEPS, "user": USER_STEPS}
+
+def start(target_type: str, target_id: int, requested_by: Optional[int] = None) -> Deletion:
+    """Hides the target now and schedules removal of it and its dependents."""
+    with db.atomic():
+        existing = (Deletion.select()
+                    .where((Deletion.target_type == target_type) & (Deletion.target_id == target_id) &
+                           (Deletion.status.in_(["pending", "running"])))
+                    .first())
+        if existing is not None:
+            return existing
+        _hide(target_type, target_id)
+        deletion = Deletion.create(target_type=target_type, target_id=target_id, requested_by=requested_by)
+        jobs.enqueue("cascade.run", {"deletion_id": deletion.id}, queue="cascade")
+    return deletion
+
+def _hide(target_type: str, target_id: int) -> None:
+    if target_type == "post":
+        post_ids = [target_id]
+        work_pks = []
+    elif target_type == "work":
+        post_ids = []
+        work_pks = [pk for (pk,) in Work.select(Work.id).where(Work.work_id == target_id).tuples()]
+    elif target_type == "user":
+        User.update(is_banned=True, ban_reason="Account deleted").where(User.id == target_id).execute()
+        entity_cache.publish(User, target_id)
+        post_ids = [pk for (pk,) in Post.select(Post.id).where(Post.user == target_id).tuples()]
+        work_pks = [pk for (pk,) in Work.select(Work.id).where(Work.user == target_id).tuples()]
+    else:
+        raise ValueError(f"Unknown cascade target: {target_type}")
+    # Bulk updates skip the model write hooks, so drop cached rows by hand (on every worker)
+    if post_ids:
+        Post.update(is_deleted=True).where(Post.id.in_(post_ids)).execute()
+        entity_cache.publish(Post, *post_ids)
+    if work_pks:
+        Work.update(is_deleted=True).where(Work.id.in_(work_pks)).execute()
+        entity_cache.publish(Work, *work_pks)
+
+def _start_children(user_id: int) -> None:
+    for (post_id,) in Post.select(Post.id).where(Post.user == user_id).tuples():
+        start("post", post_id)
+    for (work_id,) in Work.select(Work.work_id).where(Work.user == user_id).tuples():
+        start("work", work_id)
+
+def _scrub_user(user_id: int) -> None:
+    User.update(username="[deleted]", avatar_url=None, description=None, login_identity=None,
+                is_admin=False).where(User.id == user_id).execute()
+    entity_cache.publish(User, user_id)
+
+def progress(deletion: Deletion) -> dict:
+    steps = STEPS[deletion.target_type]
+    return {
+        "id": deletion.id,
+        "target_type": deletion.target_type,
+        "target_id": deletion.target_id,
+        "status": deletion.status,
+        "step": steps[deletion.step].name if deletion.step < len(steps) else None,
+        "steps_done": min(deletion.step, len(steps)),
+        "steps_total": len(steps),
+        "removed": json.loads(deletion.removed or "{}"),
+        "created_at": deletion.created_at,
+        "updated_at": deletion.updated_at,
+        "finished_at": deletion.finished_at
+    }
+
+def run(deletion_id: int) -> None:
+    deletion = Deletion.get_or_none(Deletion.id == deletion_id)
+    if deletion is None or deletion.status == "done":
+        return
+    steps: List[Step] = STEPS[deletion.target_type]
+    removed = json.loads(deletion.removed or "{}")
+    Deletion.update(status="running", updated_at=datetime.utcnow()).where(Deletion.id == deletion_id).execute()
+    if deletion.target_type == "user" and deletion.step == 0:
+        _start_children(deletion.target_id)
+
+    try:
+        for index in range(deletion.step, len(steps)):
+            step = steps[index]
+            if deletion.target_type != "user" and index == len(steps) - 1:
+                # A write that passed its visibility check just before the hide can
+                # land after its step ran; sweep again before the parent row goes
+                for earlier in steps[:-1]:
+                    while True:
+                        n = earlier.run_chunk(deletion.target_id)
+                        if n:
+                            removed[earlier.name] = removed.get(earlier.name, 0) + n
+                        if n < CHUNK:
+                            break
+                        time.sleep(PAUSE)
+            while True:
+                n = step.run_chunk(deletion.target_id)
+                if n:
+                    removed[step.name] = removed.get(step.name, 0) + n
+                (Deletion.update(step=index if n == CHUNK else index + 1, removed=json.dumps(removed), updated_at=datetime.utcnow())
+                 .where(Deletion.id == deletion_id).execute())
+                if n < CHUNK:
+                    break
+                time.sleep(PAUSE)
+    except Exception:
+        Deletion.update(status="failed", updated_at=datetime.utcnow()).where(Deletion.id == deletion_id).execute()
+        raise  # the job retries from the saved step
+
+    if deletion.target_type == "user":
+        _scrub_user(deletion.target_id)
+    now = datetime.utcnow()
+    Deletion.update(status="done", finished_at=now, updated_at=now).where(Deletion.id == deletion_id).execute()
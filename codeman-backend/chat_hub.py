@@ -0,0 +1,215 @@
+"""
+Public chat room hub behind /api/ws/chat (routers/chat.py).
+
+* Recent messages live in a ring buffer (RING_SIZE), so a joining socket gets
+  its history without touching the database.
+* A message is encoded to JSON once and the same string goes into every
+  connection's outbox. Each connection has a bounded queue drained by its
+  own writer task, so a slow client can't stall the broadcast. A client
+  whose outbox fills up is disconnected.
+* Messages are written to ChatMessage in batches by flush_loop(), either
+  every FLUSH_INTERVAL seconds or once FLUSH_SIZE are pending, with one
+  insert_many per batch.
+* Each worker has its own hub. relay_loop() first seeds the ring with the
+  latest persisted messages, then picks up rows that other workers
+  persisted (id > last seen) and broadcasts any whose uid this hub hasn't
+  seen yet. It keeps doing so with nobody connected, so the ring stays
+  complete for the next joiner.
+
+Idle connections cost one socket, one asyncio task per direction and an
+empty queue. There are no per-connection timers: uvicorn's WebSocket pings
+keep proxies alive.
+"""
+import asyncio
+import threading
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import List, Optional, Set, Tuple
+
+from models import db, ChatMessage, User
+from serializers import dumps, user_brief
+
+RING_SIZE = 200
+OUTBOX_SIZE = 256
+FLUSH_INTERVAL = 0.5
+FLUSH_SIZE = 200
+RELAY_INTERVAL = 1.0
+MAX_CONTENT_LENGTH = 1000
+
+def serialize_message(uid: str, user, content: str, msg_type: str, created_at: datetime) -> dict:
+    return {
+        "id": uid,
+        "user": user_brief(user),
+        "content": content,
+        "msg_type": msg_type,
+        "created_at": created_at
+    }
+
+class Connection:
+    def __init__(self):
+        self.outbox: asyncio.Queue = asyncio.Queue(maxsize=OUTBOX_SIZE)
+        self.closed = False
+
+    def offer(self, text: str) -> bool:
+        try:
+            self.outbox.put_nowait(text)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+class ChatHub:
+    def __init__(self):
+        self.connections: Set[Connection] = set()
+        self.ring = deque(maxlen=RING_SIZE)
+        self._pending: List[dict] = []
+        self._pending_lock = threading.Lock()
+        self._flush_now: Optional[asyncio.Event] = None
+        self._seen_uids = deque(maxlen=4096)
+        self._seen_set: Set[str] = set()
+        self.last_relayed_id: Optional[int] = None
+
+    # --- connections (event loop thread only) ---
+
+    def join(self) -> Connection:
+        conn = Connection()
+        self.connections.add(conn)
+        return conn
+
+    def leave(self, conn: Connection) -> None:
+        conn.closed = True
+        self.connections.discard(conn)
+
+    def history(self) -> List[dict]:
+        return list(self.ring)
+
+    def _remember(self, uid: str) -> bool:
+        if uid in self._seen_set:
+            return False
+        if len(self._seen_uids) == self._seen_uids.maxlen:
+            self._seen_set.discard(self._seen_uids[0])
+        self._seen_uids.append(uid)
+        self._seen_set.add(uid)
+        return True
+
+    def broadcast(self, message: dict) -> None:
+        if not self._remember(message["id"]):
+            return
+        self.ring.append(message)
+        text = dumps({"type": "message", "message": message}).decode("utf-8")
+        for conn in list(self.connections):
+            if not conn.offer(text):
+                # Outbox full: the client stopped reading. Its writer sees
+                # `closed` after the next send and hangs up.
+                self.leave(conn)
+
+    # --- sending ---
+
+    def post(self, user: User, content: str, msg_type: str = "text") -> dict:
+        message = serialize_message(uuid.uuid4().hex, user, content, msg_type, datetime.utcnow())
+        with self._pending_lock:
+            self._pending.append({
+                "user": user.id,
+                "content": content,
+                "msg_type": msg_type,
+                "created_at": message["created_at"],
+                "uid": message["id"]
+            })
+            pending = len(self._pending)
+        self.broadcast(message)
+        if pending >= FLUSH_SIZE and self._flush_now is not None:
+            self._flush_now.set()
+        return message
+
+    # --- persistence ---
+
+    def flush(self) -> int:
+        with self._pending_lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return 0
+        try:
+            with db.atomic():
+                ChatMessage.insert_many(batch).execute()
+        except Exception as e:
+            print(f"Chat flush error: {e}")
+            with self._pending_lock:
+                self._pending = batch + self._pending  # retry on the next tick
+            return 0
+        return len(batch)
+
+    async def flush_loop(self) -> None:
+        self._flush_now = asyncio.Event()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._flush_now.wait(), timeout=FLUSH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._flush_now.clear()
+                await asyncio.to_thread(self.flush)
+        finally:
+            # Shutdown: persist whatever is still buffered
+            self.flush()
+
+    # --- cross-worker relay ---
+
+    def _load_recent(self) -> list:
+        rows = list(ChatMessage.select(ChatMessage, User)
+                    .join(User)
+                    .order_by(ChatMessage.id.desc())
+                    .limit(RING_SIZE))
+        rows.reverse()
+        self.last_relayed_id = rows[-1].id if rows else 0
+        return rows
+
+    def _fetch_new(self) -> list:
+        # Runs even with nobody connected: the ring is what the next joiner
+        # gets as history, so it must hold other workers' messages too
+        rows = list(ChatMessage.select(ChatMessage, User)
+                    .join(User)
+                    .where(ChatMessage.id > self.last_relayed_id)
+                    .order_by(ChatMessage.id)
+                    .limit(500))
+        if rows:
+            self.last_relayed_id = rows[-1].id
+        return rows
+
+    @staticmethod
+    def _from_row(row) -> dict:
+        return serialize_message(row.uid or f"db-{row.id}", row.user, row.content, row.msg_type, row.created_at)
+
+    async def relay_loop(self) -> None:
+        while True:
+            try:
+                if self.last_relayed_id is None:
+                    # Seed the ring from the database, ahead of anything posted here meanwhile
+                    recent = [self._from_row(row) for row in await asyncio.to_thread(self._load_recent)]
+                    recent = [m for m in recent if self._remember(m["id"])]
+                    self.ring = deque(recent + list(self.ring), maxlen=RING_SIZE)
+                else:
+                    for row in await asyncio.to_thread(self._fetch_new):
+                        self.broadcast(self._from_row(row))  # skips messages already seen here
+            except Exception as e:
+                print(f"Chat relay error: {e}")
+            await asyncio.sleep(RELAY_INTERVAL)
+
+hub = ChatHub()
+
+def load_history(before: Optional[datetime], limit: int, before_id: Optional[int] = None) -> Tuple[List[dict], Optional[ChatMessage]]:
+    """
+    Persisted messages before the (before, before_id) cursor (newest `limit` of
+    them), oldest first, plus the oldest row when the page is full.
+    Messages flushed in one batch share created_at, so the id breaks ties.
+    """
+    query = ChatMessage.select(ChatMessage, User).join(User)
+    if before is not None:
+        if before_id is not None:
+            query = query.where((ChatMessage.created_at < before) |
+                                ((ChatMessage.created_at == before) & (ChatMessage.id < before_id)))
+        else:
+            query = query.where(ChatMessage.created_at < before)
+    rows = list(query.order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc()).limit(limit))
+    rows.reverse()
+    oldest = rows[0] if len(rows) == limit else None
+    return [serialize_message(r.uid or f"db-{r.id}", r.user, r.content, r.msg_type, r.created_at) for r in rows], oldest
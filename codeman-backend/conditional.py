@@ -0,0 +1,116 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+
+from fastapi import Request, Response
+
+# Bodies above this size are passed through without hashing
+MAX_HASHED_BODY = 2 * 1024 * 1024
+HASHED_CONTENT_TYPES = ("application/json", "text/html", "text/plain")
+DEFAULT_CACHE_CONTROL = "private, no-cache"
+
+def make_etag(*parts) -> str:
+    """Builds a weak ETag from entity version fields (ids, updated_at, counters...)."""
+    digest = hashlib.sha1("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+    return f'W/"{digest[:20]}"'
+
+def body_etag(body: bytes) -> str:
+    return f'W/"{hashlib.sha1(body).hexdigest()[:20]}"'
+
+def http_date(value: datetime) -> str:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+def _strip_weak(tag: str) -> str:
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+def is_not_modified(request: Request, etag: Optional[str], last_modified: Optional[datetime] = None) -> bool:
+    """Evaluates If-None-Match / If-Modified-Since (weak comparison, RFC 9110)."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if not etag:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        wanted = _strip_weak(etag)
+        return any(_strip_weak(tag) == wanted for tag in if_none_match.split(","))
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if last_modified.tzinfo is None:
+            last_modified = last_modified.replace(tzinfo=timezone.utc)
+        # HTTP dates have one-second resolution
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+def validator_headers(etag: Optional[str], last_modified: Optional[datetime] = None, vary_auth: bool = False) -> dict:
+    headers = {"Cache-Control": DEFAULT_CACHE_CONTROL}
+    if etag:
+        headers["ETag"] = etag
+    if isinstance(last_modified, datetime):
+        headers["Last-Modified"] = http_date(last_modified)
+    if vary_auth:
+        headers["Vary"] = "Authorization"
+    return headers
+
+def conditional_response(request: Request, response: Response, etag: str,
+                         last_modified: Optional[datetime] = None, vary_auth: bool = False) -> Optional[Response]:
+    """
+    Call from a GET handler once the entity version is known, before building the body.
+    Returns a ready 304 to return immediately, or None after attaching validators
+    to the handler's Response so the full 200 carries them.
+    """
+    headers = validator_headers(etag, last_modified, vary_auth)
+    if is_not_modified(request, etag, last_modified):
+        not_modified = Response(status_code=304, headers=headers)
+        # Keep cookies the handler already set (e.g. view counters)
+        for key, value in response.raw_headers:
+            if key == b"set-cookie":
+                not_modified.raw_headers.append((key, value))
+        return not_modified
+    response.headers.update(headers)
+    return None
+
+async def _iterate(body: bytes):
+    yield body
+
+async def conditional_get_middleware(request: Request, call_next):
+    """
+    Fallback for GET endpoints that don't compute their own validator:
+    hashes the serialized body into an ETag and answers 304 on a match.
+    Saves bandwidth for every endpoint; handlers using conditional_response()
+    also skip the DB work and serialization.
+    """
+    response = await call_next(request)
+
+    if request.method not in ("GET", "HEAD") or response.status_code != 200:
+        return response
+    if not request.url.path.startswith("/api") or "etag" in response.headers:
+        return response
+    content_type = response.headers.get("content-type", "")
+    if not content_type.startswith(HASHED_CONTENT_TYPES):
+        return response
+    content_length = response.headers.get("content-length")
+    if content_length is not None and int(content_length) > MAX_HASHED_BODY:
+        return response
+
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    etag = body_etag(body)
+    if is_not_modified(request, etag):
+        not_modified = Response(status_code=304, headers=validator_headers(etag, vary_auth=True))
+        for key, value in response.raw_headers:
+            if key == b"set-cookie":
+                not_modified.raw_headers.append((key, value))
+        return not_modified
+
+    response.body_iterator = _iterate(body)
+    for key, value in validator_headers(etag, vary_auth=True).items():
+        response.headers.setdefault(key, value)
+    return response
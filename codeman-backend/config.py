@@ -1,9 +1,16 @@
 import os
-import secrets
+import tempfile
+
+import keystore
+
+# --- Debug ---
+# Verbose startup output (e.g. the registered route table)
+DEBUG = os.getenv("DEBUG", "0") == "1"
 
 # --- Security ---
-# Use a secure random key if not set in environment (Note: restarts will invalidate sessions)
-SECRET_KEY = os.getenv("SECRET_KEY", secrets.token_hex(32))
+# Taken from the environment, otherwise generated once into secret_key.key so that
+# every worker process (and restarts) sign tokens with the same key
+SECRET_KEY = os.getenv("SECRET_KEY") or keystore.load_secret_key()
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7 # 1 week
 
@@ -13,8 +20,22 @@ CODEMAO_PID = os.getenv("CODEMAO_PID", "65edCTyg")
 # --- Database ---
 DATABASE_URL = "database.db"
 
+# --- Serialization ---
+# Hot endpoints return pre-encoded JSON and skip response_model validation.
+# Set VALIDATE_RESPONSES=1 in development to validate against the Pydantic models again.
+VALIDATE_RESPONSES = os.getenv("VALIDATE_RESPONSES", "0") == "1"
+
 # --- Rate Limiting ---
-# (Configs for slowapi could go here if needed)
+# Counters must be shared by all uvicorn workers, otherwise each limit is multiplied
+# by the worker count. "shm://<path>" is the mmap table in shm_ratelimit.py (POSIX only);
+# any limits URI (memory://, redis://...) also works.
+try:
+    import fcntl  # noqa: F401
+    _shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    _default_rate_limit_storage = f"shm://{_shm_dir}/codeman-ratelimit?slots=65536"
+except ImportError:  # Windows: single process, per-process counters are fine
+    _default_rate_limit_storage = "memory://"
+RATE_LIMIT_STORAGE_URI = os.getenv("RATE_LIMIT_STORAGE_URI", _default_rate_limit_storage)
 
 # --- Anti-Scraping ---
 BLOCKED_USER_AGENTS = ["python-requests", "curl", "wget", "scrapy", "httpie"]
@@ -0,0 +1,125 @@
+"""
+In-process LRU/TTL cache for hot entity rows (User, Post, Work, Category, SystemSetting).
+
+Reads return a fresh model instance built from the cached row data, so callers
+can mutate and save() it without affecting other requests. Any save() or
+delete_instance() on a cached model drops its entry via models.on_model_write;
+bulk Model.update() queries must call invalidate() themselves.
+
+The cache is per process: with several workers, an entry changed on another
+worker is at most `ttl` seconds stale. Writes that must not stay stale
+anywhere (bans, admin rights, hidden posts) call publish() instead of
+invalidate(). publish() bumps a shared counter in SystemSetting, and each
+worker's watch_loop() polls it every CHECK_INTERVAL seconds and drops its
+caches when it moves. Those writes are rare, so a full clear is cheaper
+than tracking keys.
+"""
+import asyncio
+import os
+from typing import Any, Optional, Type
+
+from cache import TTLCache
+from models import User, Post, Work, Category, SystemSetting, on_model_write
+
+VERSION_KEY = "entity_cache_version"
+CHECK_INTERVAL = float(os.getenv("ENTITY_CACHE_CHECK_INTERVAL", 1))
+
+def _size(name: str, default: int) -> int:
+    return int(os.getenv(f"ENTITY_CACHE_{name}_SIZE", default))
+
+_caches = {
+    User: TTLCache(maxsize=_size("USER", 5000), ttl=60),
+    Post: TTLCache(maxsize=_size("POST", 5000), ttl=120),
+    Work: TTLCache(maxsize=_size("WORK", 5000), ttl=120),
+    Category: TTLCache(maxsize=_size("CATEGORY", 100), ttl=600),
+    SystemSetting: TTLCache(maxsize=_size("SETTING", 100), ttl=300),
+}
+# Secondary unique keys (e.g. Work.work_id, SystemSetting.key) -> primary key
+_key_index = TTLCache(maxsize=10000, ttl=600)
+
+def _copy(model: Type, data: dict):
+    instance = model(__no_default__=1)
+    instance.__data__ = dict(data)
+    return instance
+
+def get_or_none(model: Type, pk: Any):
+    cache = _caches[model]
+    data = cache.get(pk)
+    if data is None:
+        instance = model.get_or_none(model._meta.primary_key == pk)
+        if instance is None:
+            return None
+        data = dict(instance.__data__)
+        cache.set(pk, data)
+    return _copy(model, data)
+
+def get(model: Type, pk: Any):
+    """Cached equivalent of Model.get_by_id(); raises Model.DoesNotExist."""
+    instance = get_or_none(model, pk)
+    if instance is None:
+        raise model.DoesNotExist(f"{model.__name__} {pk} does not exist")
+    return instance
+
+def get_by(model: Type, field, value: Any):
+    """Cached lookup by a unique non-primary column. Returns None if missing."""
+    index_key = (model.__name__, field.name, value)
+    pk = _key_index.get(index_key)
+    if pk is not None:
+        instance = get_or_none(model, pk)
+        if instance is not None and getattr(instance, field.name) == value:
+            return instance
+    instance = model.get_or_none(field == value)
+    if instance is None:
+        return None
+    _key_index.set(index_key, instance._pk)
+    _caches[model].set(instance._pk, dict(instance.__data__))
+    return _copy(model, instance.__data__)
+
+def invalidate(model: Type, pk: Any) -> None:
+    cache = _caches.get(model)
+    if cache is not None:
+        cache.delete(pk)
+
+def clear() -> None:
+    for cache in _caches.values():
+        cache.clear()
+    _key_index.clear()
+
+# --- cross-worker invalidation ---
+
+_seen_version: Optional[str] = None
+
+def publish(model: Type, *pks: Any) -> None:
+    """Invalidates rows here and tells every other worker to drop its caches."""
+    for pk in pks:
+        invalidate(model, pk)
+    (SystemSetting.insert(key=VERSION_KEY, value="1")
+     .on_conflict(conflict_target=[SystemSetting.key],
+                  update={SystemSetting.value: SystemSetting.value.cast("INTEGER") + 1})
+     .execute())
+
+def check() -> None:
+    global _seen_version
+    version = SystemSetting.select(SystemSetting.value).where(SystemSetting.key == VERSION_KEY).scalar()
+    if version != _seen_version:
+        if _seen_version is not None or version is not None:
+            clear()
+        _seen_version = version
+
+async def watch_loop() -> None:
+    while True:
+        try:
+            await asyncio.to_thread(check)
+        except Exception as e:
+            print(f"Entity cache check error: {e}")
+        await asyncio.sleep(CHECK_INTERVAL)
+
+def stats() -> dict:
+    result = {model.__name__: cache.stats() for model, cache in _caches.items()}
+    result["_key_index"] = _key_index.stats()
+    return result
+
+@on_model_write
+def _invalidate_on_write(instance, deleted: bool) -> None:
+    if type(instance) in _caches:
+        invalidate(type(instance), instance._pk)
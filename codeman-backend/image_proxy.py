@@ -0,0 +1,312 @@
+"""
+Caching image proxy for avatars, work covers and banners (GET /api/img).
+
+Images are fetched from an allowlisted host (Codemao's CDNs by default) once
+and then served from disk. Everything lives under CACHE_DIR, keyed by a
+hash of the source URL:
+
+    <key>.orig    the original bytes, at most MAX_SOURCE_BYTES
+    <key>.type    its content type
+    <key>_<w>.webp / .jpeg    resized variants
+
+Widths are rounded up to one of WIDTHS so a page can't create unbounded
+variants. Resizing runs in a process pool (Pillow is CPU bound and holds
+the GIL), so request threads never decode images. Without Pillow installed
+the proxy still caches and serves originals.
+
+Files are written to a temp name and renamed into place, so workers sharing
+the directory never see half-written images. Concurrent requests for the
+same image in one worker share a single fetch/resize. The cache is bounded
+by CACHE_MAX_BYTES. trim() deletes the least recently served files. It runs
+once a worker has written enough new bytes, and hourly as the
+"images.trim" job. Responses are served from a file opened by
+open_variant(), which fetches again if trim() got there first.
+
+Responses carry Cache-Control: immutable for a year. Codemao's static URLs
+change when the image does, so a URL always means the same picture.
+"""
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Optional: without Pillow originals are served unresized
+    Image = None
+
+CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "codeman-images"))
+CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_MB", 512)) * 1024 * 1024
+ALLOWED_HOSTS = [h.strip() for h in os.getenv("IMAGE_PROXY_HOSTS", "codemao.cn").split(",") if h.strip()]
+WIDTHS = (48, 96, 200, 400, 800, 1200)
+FORMATS = ("webp", "jpeg")
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+MAX_PIXELS = 40_000_000 # Refuse to decode anything bigger (decompression bombs)
+FETCH_TIMEOUT = 10
+POOL_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+TRIM_EVERY = CACHE_MAX_BYTES // 20 # Bytes written by this worker between trims
+
+class ImageError(Exception):
+    """Raised for sources the proxy won't serve; status is the HTTP status to answer with."""
+
+    def __init__(self, status: int, detail: str):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+_pool: Optional[ProcessPoolExecutor] = None
+_inflight: Dict[str, asyncio.Future] = {}
+_written = 0
+_written_lock = threading.Lock()
+
+def _client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(timeout=FETCH_TIMEOUT, follow_redirects=False)
+
+def host_allowed(url: str) -> bool:
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        return False
+    host = parts.hostname.lower()
+    return any(host == allowed or host.endswith("." + allowed) for allowed in ALLOWED_HOSTS)
+
+def pick_width(width: Optional[int]) -> Optional[int]:
+    if not width:
+        return None
+    for w in WIDTHS:
+        if w >= width:
+            return w
+    return WIDTHS[-1]
+
+def _key(url: str) -> str:
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+def _path(name: str) -> str:
+    # Two-level fan-out keeps directories small
+    return os.path.join(CACHE_DIR, name[:2], name)
+
+def _write_atomic(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    _note_written(len(data))
+
+def _note_written(n: int) -> None:
+    global _written
+    with _written_lock:
+        _written += n
+        due = _written >= TRIM_EVERY
+        if due:
+            _written = 0
+    if due:
+        threading.Thread(target=trim, daemon=True).start()
+
+def _touch(path: str) -> None:
+    # mtime doubles as "last served" for trim()
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def _resize(src: str, dst: str, width: int, fmt: str) -> bool:
+    """Runs in a pool process. Returns False if the source should be served as is."""
+    with Image.open(src) as im:
+        # open() only reads the header; refuse huge images before anything is decoded
+        if im.width * im.height > MAX_PIXELS:
+            return False
+        if getattr(im, "is_animated", False):
+            return False  # keep GIF/WebP animations
+        im = ImageOps.exif_transpose(im)
+        if im.width > width:
+            im = im.resize((width, max(1, round(im.height * width / im.width))), Image.LANCZOS)
+        if fmt == "jpeg":
+            if im.mode in ("RGBA", "LA", "P"):
+                im = im.convert("RGBA")
+                background = Image.new("RGB", im.size, (255, 255, 255))
+                background.paste(im, mask=im.split()[-1])
+                im = background
+            elif im.mode != "RGB":
+                im = im.convert("RGB")
+            options = {"quality": 82, "optimize": True, "progressive": True}
+        else:
+            if im.mode not in ("RGB", "RGBA"):
+                im = im.convert("RGBA")
+            options = {"quality": 80, "method": 4}
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst), suffix=".tmp")
+        os.close(fd)
+        im.save(tmp, format=fmt.upper(), **options)
+    os.replace(tmp, dst)
+    return True
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Not fork: a forked child would inherit the event loop, the sqlite
+        # connection and locks held by other threads at the time
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _pool = ProcessPoolExecutor(max_workers=POOL_WORKERS, mp_context=multiprocessing.get_context(method))
+    return _pool
+
+def shutdown() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+async def _single_flight(name: str, make):
+    """Runs make() once per name at a time in this worker; concurrent callers await the same result."""
+    future = _inflight.get(name)
+    if future is not None:
+        return await asyncio.shield(future)
+    future = asyncio.get_running_loop().create_future()
+    _inflight[name] = future
+    try:
+        result = await make()
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # retrieved here so it isn't reported as never retrieved
+        raise
+    finally:
+        _inflight.pop(name, None)
+
+async def _fetch(url: str, key: str) -> Tuple[str, str]:
+    async with _client() as client:
+        try:
+            async with client.stream("GET", url) as response:
+                if response.status_code != 200:
+                    raise ImageError(502, f"Upstream answered {response.status_code}")
+                content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+                if not content_type.startswith("image/") or content_type == "image/svg+xml":
+                    raise ImageError(415, "Not a raster image")
+                declared = response.headers.get("content-length")
+                if declared and declared.isdigit() and int(declared) > MAX_SOURCE_BYTES:
+                    raise ImageError(413, "Image too large")
+                chunks = []
+                size = 0
+                async for chunk in response.aiter_bytes():
+                    size += len(chunk)
+                    if size > MAX_SOURCE_BYTES:
+                        raise ImageError(413, "Image too large")
+                    chunks.append(chunk)
+        except httpx.HTTPError as e:
+            raise ImageError(502, f"Fetch failed: {e.__class__.__name__}")
+    data = b"".join(chunks)
+    original = _path(key + ".orig")
+    await asyncio.to_thread(_write_atomic, _path(key + ".type"), content_type.encode("utf-8"))
+    await asyncio.to_thread(_write_atomic, original, data)
+    return original, content_type
+
+async def original(url: str) -> Tuple[str, str]:
+    """(path, content type) of the cached original, fetching it on a miss."""
+    key = _key(url)
+    path = _path(key + ".orig")
+    try:
+        with open(_path(key + ".type"), "rb") as f:
+            content_type = f.read().decode("utf-8")
+        if os.path.exists(path):
+            return path, content_type
+    except FileNotFoundError:
+        pass
+    return await _single_flight(key, lambda: _fetch(url, key))
+
+async def variant(url: str, width: Optional[int], fmt: Optional[str]) -> Tuple[str, str]:
+    """(path, content type) to serve for url at width/fmt. Falls back to the original when resizing isn't possible."""
+    if not host_allowed(url):
+        raise ImageError(400, "Host not allowed")
+    src, content_type = await original(url)
+    width = pick_width(width)
+    if Image is None or width is None or fmt not in FORMATS or content_type == "image/gif":
+        _touch(src)
+        return src, content_type
+
+    name = f"{_key(url)}_{width}.{fmt}"
+    path = _path(name)
+    if os.path.exists(path):
+        _touch(path)
+        return path, f"image/{fmt}"
+
+    async def make():
+        loop = asyncio.get_running_loop()
+        try:
+            resized = await loop.run_in_executor(_get_pool(), _resize, src, path, width, fmt)
+        except Exception as e:
+            print(f"Image resize failed for {url}: {e}")
+            resized = False
+        if resized:
+            _note_written(os.path.getsize(path))
+        return resized
+
+    if await _single_flight(name, make):
+        return path, f"image/{fmt}"
+    _touch(src)
+    return src, content_type
+
+async def open_variant(url: str, width: Optional[int], fmt: Optional[str]) -> Tuple[BinaryIO, str, str]:
+    """
+    Like variant(), but returns the file already open. trim() may delete a file
+    between variant() returning its path and the response opening it; the
+    second attempt then fetches or resizes it again. An open file stays
+    readable after it is unlinked.
+    """
+    for attempt in range(2):
+        path, content_type = await variant(url, width, fmt)
+        try:
+            return open(path, "rb"), path, content_type
+        except FileNotFoundError:
+            if attempt:
+                raise ImageError(503, "Image was evicted, try again")
+
+def trim() -> int:
+    """Deletes least recently served files until the cache is under 90% of CACHE_MAX_BYTES."""
+    files = []
+    total = 0
+    now = time.time()
+    for root, _, names in os.walk(CACHE_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.endswith(".tmp"):
+                if now - st.st_mtime > 3600:  # left behind by a crashed writer
+                    _remove(path)
+                continue
+            if name.endswith(".type"):
+                continue  # removed along with its original
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    if total <= CACHE_MAX_BYTES:
+        return 0
+    target = CACHE_MAX_BYTES * 9 // 10
+    removed = 0
+    for _, size, path in sorted(files):
+        if total <= target:
+            break
+        _remove(path)
+        if path.endswith(".orig"):
+            _remove(path[:-len(".orig")] + ".type")
+        total -= size
+        removed += 1
+    return removed
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass  # already gone, or (on Windows) still open for a response
@@ -0,0 +1,360 @@
+"""
+Durable background jobs, backed by the Job table.
+
+    @jobs.task("timeline.fan_out")
+    def fan_out(author_id, ...): ...
+
+    jobs.enqueue("timeline.fan_out", {"author_id": 1, ...})  # returns at once
+
+    @jobs.periodic("*/10 * * * *", "oauth.cleanup_codes", queue="maintenance")
+    def cleanup_codes(): ...
+
+* Delivery is at least once. A worker claims a job by taking a lease
+  (locked_until) and renews it while the job runs. If the worker dies, the
+  lease expires and another worker requeues the job, so tasks must be safe
+  to run twice.
+* A failed job is retried with exponential backoff until max_attempts, then
+  it is left as 'failed' for an admin to look at or retry.
+* Jobs are claimed by priority (higher first), then run_at.
+* Each queue has a concurrency limit that counts running jobs across all
+  workers. The limit is checked inside the IMMEDIATE claim transaction.
+* Periodic tasks take 5-field cron expressions in UTC. Every worker runs the
+  scheduler. A unique dedupe_key per (task, slot) means each slot is
+  enqueued once.
+
+Task functions may be sync (they run in a worker thread) or async.
+"""
+import asyncio
+import json
+import os
+import random
+import socket
+import traceback
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from peewee import fn
+
+from models import db, Job
+
+POLL_INTERVAL = 1.0
+REAP_INTERVAL = 30
+SCHEDULE_INTERVAL = 15
+LEASE_SECONDS = 60
+BACKOFF_BASE = 5
+BACKOFF_MAX = 3600
+
+# Max jobs running at once per queue, across all workers
+QUEUE_CONCURRENCY = {
+    "default": 4,
+    "maintenance": 1,
+    "cascade": 1, # One big delete at a time keeps the write lock free for requests
+    "moderation": 1, # Also orders an undo after the run it reverts
+}
+DEFAULT_CONCURRENCY = 2
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+_tasks: Dict[str, dict] = {}
+_schedules: List[dict] = []
+
+def task(name: str, queue: str = "default", max_attempts: int = 5):
+    """Registers a function as a job task."""
+    def decorator(func: Callable) -> Callable:
+        _tasks[name] = {"func": func, "queue": queue, "max_attempts": max_attempts}
+        return func
+    return decorator
+
+def periodic(cron: str, name: str, queue: str = "maintenance", max_attempts: int = 1):
+    """Registers a task and enqueues it on a cron schedule (UTC)."""
+    def decorator(func: Callable) -> Callable:
+        task(name, queue=queue, max_attempts=max_attempts)(func)
+        _schedules.append({"name": name, "cron": cron, "schedule": CronSchedule(cron), "next_run": None})
+        return func
+    return decorator
+
+def enqueue(name: str, payload: Optional[dict] = None, priority: int = 0, delay: float = 0,
+            queue: Optional[str] = None, dedupe_key: Optional[str] = None) -> Optional[int]:
+    """
+    Persists a job and returns its id (None if dedupe_key already exists).
+    Safe to call inside the caller's transaction; the job becomes visible on commit.
+    """
+    spec = _tasks.get(name)
+    if spec is None:
+        raise ValueError(f"Unknown job task: {name}")
+    inserted = list(Job.insert(queue=queue or spec["queue"], name=name, payload=json.dumps(payload or {}),
+                               priority=priority, max_attempts=spec["max_attempts"],
+                               run_at=datetime.utcnow() + timedelta(seconds=delay), dedupe_key=dedupe_key)
+                    .on_conflict_ignore()
+                    .returning(Job.id)
+                    .tuples()
+                    .execute())
+    if not inserted:
+        return None
+    runner.wake()
+    return inserted[0][0]
+
+# --- cron ---
+
+class CronSchedule:
+    """Minimal 5-field cron: minute hour day-of-month month day-of-week, with *, */n, a-b, a-b/n and lists."""
+
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expr: str):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expr!r}")
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse(f, lo, hi) for f, (lo, hi) in zip(fields, self.RANGES))
+        self.weekdays = {d % 7 for d in weekdays}  # 7 is also Sunday
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def _parse(field: str, lo: int, hi: int) -> set:
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step_text = part.split("/", 1)
+                step = int(step_text)
+            if part == "*":
+                start, end = lo, hi
+            elif "-" in part:
+                start, end = (int(x) for x in part.split("-", 1))
+            else:
+                start = int(part)
+                end = hi if step > 1 else start
+            if start < lo or end > hi or step < 1:
+                raise ValueError(f"Cron field out of range: {field!r}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, t: datetime) -> bool:
+        dom = t.day in self.days
+        dow = (t.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return dom and dow
+        return dom or dow  # classic cron: either restricted field may match
+
+    def next_after(self, after: datetime) -> datetime:
+        t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = after + timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError("Cron expression never matches")
+
+# --- running ---
+
+def backoff(attempts: int) -> float:
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX) * random.uniform(0.8, 1.2)
+
+def concurrency(queue: str) -> int:
+    return QUEUE_CONCURRENCY.get(queue, DEFAULT_CONCURRENCY)
+
+def claim(queue: str) -> Optional[Job]:
+    now = datetime.utcnow()
+    ready = (Job.status == "queued") & (Job.queue == queue) & (Job.run_at <= now)
+    # Cheap indexed probe first so idle polls don't take the write lock
+    if not Job.select(Job.id).where(ready).exists():
+        return None
+    with db.atomic("IMMEDIATE"):
+        running = Job.select().where((Job.queue == queue) & (Job.status == "running")).count()
+        if running >= concurrency(queue):
+            return None
+        job = Job.select().where(ready).order_by(Job.priority.desc(), Job.run_at, Job.id).first()
+        if job is None:
+            return None
+        job.status = "running"
+        job.attempts += 1
+        job.locked_by = WORKER_ID
+        job.locked_until = now + timedelta(seconds=LEASE_SECONDS)
+        job.started_at = now
+        job.save()
+    return job
+
+def complete(job: Job) -> None:
+    (Job.update(status="done", finished_at=datetime.utcnow(), locked_by=None, locked_until=None, last_error=None)
+     .where((Job.id == job.id) & (Job.locked_by == WORKER_ID))
+     .execute())
+
+def fail(job: Job, error: str) -> None:
+    now = datetime.utcnow()
+    if job.attempts < job.max_attempts:
+        update = {"status": "queued", "run_at": now + timedelta(seconds=backoff(job.attempts))}
+    else:
+        update = {"status": "failed", "finished_at": now}
+    (Job.update(locked_by=None, locked_until=None, last_error=error[-4000:], **update)
+     .where((Job.id == job.id) & (Job.locked_by == WORKER_ID))
+     .execute())
+
+def release(job: Job) -> None:
+    """Hands a job back without counting the attempt (shutdown)."""
+    (Job.update(status="queued", attempts=Job.attempts - 1, locked_by=None, locked_until=None)
+     .where((Job.id == job.id) & (Job.locked_by == WORKER_ID) & (Job.status == "running"))
+     .execute())
+
+def reap_expired() -> int:
+    """Requeues running jobs whose worker stopped renewing the lease."""
+    return (Job.update(status="queued", locked_by=None, locked_until=None)
+            .where((Job.status == "running") & (Job.locked_until < datetime.utcnow()))
+            .execute())
+
+def renew(job: Job) -> None:
+    (Job.update(locked_until=datetime.utcnow() + timedelta(seconds=LEASE_SECONDS))
+     .where((Job.id == job.id) & (Job.locked_by == WORKER_ID))
+     .execute())
+
+def schedule_due(now: Optional[datetime] = None) -> int:
+    now = now or datetime.utcnow()
+    enqueued = 0
+    for entry in _schedules:
+        if entry["next_run"] is None:
+            entry["next_run"] = entry["schedule"].next_after(now)
+        if entry["next_run"] <= now:
+            slot = entry["next_run"].strftime("%Y%m%d%H%M")
+            if enqueue(entry["name"], dedupe_key=f"cron:{entry['name']}:{slot}"):
+                enqueued += 1
+            entry["next_run"] = entry["schedule"].next_after(now)
+    return enqueued
+
+class JobRunner:
+    def __init__(self):
+        self.active: Dict[int, asyncio.Task] = {}
+        self._wake: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def wake(self) -> None:
+        if self._loop is not None and self._wake is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._wake.set)
+            except RuntimeError:
+                pass  # loop already closed
+
+    async def _execute(self, job: Job) -> None:
+        spec = _tasks.get(job.name)
+        renewer = asyncio.create_task(self._renew_loop(job))
+        try:
+            if spec is None:
+                raise LookupError(f"No task registered as {job.name!r} in this worker")
+            kwargs = json.loads(job.payload or "{}")
+            if asyncio.iscoroutinefunction(spec["func"]):
+                await spec["func"](**kwargs)
+            else:
+                await asyncio.to_thread(spec["func"], **kwargs)
+        except asyncio.CancelledError:
+            await asyncio.to_thread(release, job)
+            raise
+        except Exception:
+            error = traceback.format_exc()
+            print(f"Job {job.id} ({job.name}) failed, attempt {job.attempts}/{job.max_attempts}")
+            await asyncio.to_thread(fail, job, error)
+        else:
+            await asyncio.to_thread(complete, job)
+        finally:
+            renewer.cancel()
+            self.active.pop(job.id, None)
+            self.wake()  # a slot just freed up
+
+    async def _renew_loop(self, job: Job) -> None:
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            await asyncio.to_thread(renew, job)
+
+    def _claim_ready(self) -> List[Job]:
+        claimed = []
+        queues = {spec["queue"] for spec in _tasks.values()}
+        for queue in sorted(queues):
+            local = sum(1 for t in self.active.values() if getattr(t, "queue", None) == queue)
+            while local < concurrency(queue):
+                job = claim(queue)
+                if job is None:
+                    break
+                claimed.append(job)
+                local += 1
+        return claimed
+
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        last_reap = last_schedule = 0.0
+        try:
+            while True:
+                now = self._loop.time()
+                try:
+                    if now - last_reap >= REAP_INTERVAL:
+                        last_reap = now
+                        await asyncio.to_thread(reap_expired)
+                    if now - last_schedule >= SCHEDULE_INTERVAL:
+                        last_schedule = now
+                        await asyncio.to_thread(schedule_due)
+                    for job in await asyncio.to_thread(self._claim_ready):
+                        t = asyncio.create_task(self._execute(job))
+                        t.queue = job.queue
+                        self.active[job.id] = t
+                except Exception as e:
+                    print(f"Job runner error: {e}")
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+        finally:
+            self._wake = None
+            tasks = list(self.active.values())
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+runner = JobRunner()
+
+def stats() -> dict:
+    """Queue depth, lag and failures for the admin dashboard."""
+    now = datetime.utcnow()
+    queues = {}
+    for name in set(QUEUE_CONCURRENCY) | {spec["queue"] for spec in _tasks.values()}:
+        queues[name] = {"queued": 0, "ready": 0, "running": 0, "failed": 0, "done": 0,
+                        "lag_seconds": 0.0, "concurrency": concurrency(name)}
+    for queue, status, count in (Job.select(Job.queue, Job.status, fn.COUNT(Job.id))
+                                 .group_by(Job.queue, Job.status).tuples()):
+        queues.setdefault(queue, {"queued": 0, "ready": 0, "running": 0, "failed": 0, "done": 0,
+                                  "lag_seconds": 0.0, "concurrency": concurrency(queue)})[status] = count
+    # Lag: how long the oldest ready job has been waiting past its run_at
+    for queue, ready, oldest in (Job.select(Job.queue, fn.COUNT(Job.id), fn.MIN(Job.run_at))
+                                 .where((Job.status == "queued") & (Job.run_at <= now))
+                                 .group_by(Job.queue).tuples()):
+        if isinstance(oldest, str):
+            oldest = datetime.fromisoformat(oldest)
+        queues[queue]["ready"] = ready
+        queues[queue]["lag_seconds"] = round((now - oldest).total_seconds(), 3) if oldest else 0.0
+    failures = (Job.select(Job.id, Job.queue, Job.name, Job.attempts, Job.finished_at, Job.last_error)
+                .where(Job.status == "failed").order_by(Job.finished_at.desc()).limit(20))
+    return {
+        "worker": WORKER_ID,
+        "active_here": len(runner.active),
+        "queues": queues,
+        "schedules": [{"name": s["name"], "cron": s["cron"], "next_run": s["next_run"]} for s in _schedules],
+        "recent_failures": [{
+            "id": j.id, "queue": j.queue, "name": j.name, "attempts": j.attempts, "finished_at": j.finished_at,
+            "error": j.last_error.strip().splitlines()[-1] if j.last_error else None
+        } for j in failures]
+    }
+
+def retry(job_id: int) -> bool:
+    """Puts a failed job back in its queue with a fresh attempt budget."""
+    updated = (Job.update(status="queued", attempts=0, run_at=datetime.utcnow(), finished_at=None)
+               .where((Job.id == job_id) & (Job.status == "failed"))
+               .execute())
+    if updated:
+        runner.wake()
+    return bool(updated)
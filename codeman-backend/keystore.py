@@ -0,0 +1,103 @@
+"""
+Create-once key files shared by every worker process.
+
+Each key is generated into a temp file and published with os.link(), which
+fails if the target already exists. When several processes start together,
+exactly one key wins and the others read it back, so every worker signs
+and verifies with the same secrets. serve.py calls ensure_keys() before
+forking, so workers normally only ever read. For single-process setups run
+
+    python keystore.py
+
+once at deploy time; otherwise a missing key is generated on first use.
+
+Keys live in CODEMAN_KEY_DIR, never in the image: serve.py points it at a
+runtime directory (a volume in Docker) unless it is already set. Plain
+`uvicorn main:app` development keeps them in the working directory, where
+.gitignore and .dockerignore exclude them.
+"""
+import os
+import secrets
+import shutil
+import tempfile
+from typing import Callable
+
+KEY_DIR = os.getenv("CODEMAN_KEY_DIR", ".")
+SECRET_KEY_FILE = os.getenv("SECRET_KEY_FILE", os.path.join(KEY_DIR, "secret_key.key"))
+RSA_KEY_FILE = os.path.join(KEY_DIR, "private_key.pem")
+FERNET_KEY_FILE = os.path.join(KEY_DIR, "credential_key.key")
+# Kept when moving to a key directory. Not secret_key.key: moving means rotating it.
+LEGACY_KEY_FILES = ("private_key.pem", "credential_key.key")
+
+def load_or_create(path: str, generate: Callable[[], bytes]) -> bytes:
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        if data:
+            return data
+    except FileNotFoundError:
+        pass
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".keytmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(generate())
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o600)
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass  # another process published first; use theirs
+    finally:
+        os.unlink(tmp_path)
+    with open(path, "rb") as f:
+        return f.read()
+
+def load_secret_key() -> str:
+    return load_or_create(SECRET_KEY_FILE, lambda: secrets.token_hex(32).encode()).decode().strip()
+
+def load_rsa_private_key():
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    def generate() -> bytes:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        return key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+
+    return serialization.load_pem_private_key(load_or_create(RSA_KEY_FILE, generate), password=None)
+
+def load_fernet_key() -> bytes:
+    from cryptography.fernet import Fernet
+    return load_or_create(FERNET_KEY_FILE, Fernet.generate_key)
+
+def adopt_legacy_keys() -> None:
+    """
+    Moves the RSA and Fernet keys of a deployment that kept them in the source
+    tree into KEY_DIR. Credentials encrypted with the old Fernet key stay readable.
+    """
+    for name in LEGACY_KEY_FILES:
+        target = os.path.join(KEY_DIR, name)
+        if os.path.abspath(name) == os.path.abspath(target) or os.path.exists(target) or not os.path.exists(name):
+            continue
+        os.makedirs(KEY_DIR, mode=0o700, exist_ok=True)
+        shutil.move(name, target)
+        print(f"Moved {name} to {target}")
+
+def ensure_keys() -> None:
+    """Creates any missing key files. Run once in the parent before starting workers."""
+    adopt_legacy_keys()
+    if not os.getenv("SECRET_KEY"):
+        load_secret_key()
+    load_rsa_private_key()
+    load_fernet_key()
+
+if __name__ == "__main__":
+    ensure_keys()
+    print(f"Keys ready: {SECRET_KEY_FILE}, {RSA_KEY_FILE}, {FERNET_KEY_FILE}")
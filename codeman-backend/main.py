@@ -1,36 +1,66 @@
 
-from fastapi import FastAPI, HTTPException, Depends, Request, Response, status, Query
+from fastapi import FastAPI, HTTPException, Depends, Request, Response, status, Query, WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer
 from pydantic import BaseModel as PydanticBaseModel, Field
 from typing import List, Optional, Dict, Any
 from datetime import datetime
-import re
-import markdown
+import asyncio
+import contextvars
+import functools
+import os
 import base64
-import bleach
 from cryptography.hazmat.primitives.asymmetric import padding
 import httpx
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
-from models import db, User, Post, Category, Comment, Work, Notification, Follow, SystemSetting, Report, create_tables, PostLike, CommentLike
+from models import db, User, Post, Category, Comment, Work, Notification, Follow, setup_database, PostLike, CommentLike, Deletion
 from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from cache import TTLCache
+import entity_cache
 from codemao_api import codemao_api
+from rendering import render_post_fields, ensure_rendered, ensure_rendered_many
+from work_cards import expand_work_tags
+import work_cards
+import worker_health
+import notifications
+import chat_hub
+import timeline
+import mentions
+import jobs
+import tasks
+import cascade
+import reports
+import analytics
+import site_snapshot
+import image_proxy
+from serializers import dumps, respond, serialize_post, serialize_comment, user_brief, compile_serializer
+from conditional import make_etag, conditional_response, is_not_modified, validator_headers, conditional_get_middleware
 
 from security import (
     create_access_token, 
     get_current_user, 
-    pem_public_key, 
-    private_key
+    get_optional_user_id,
+    get_optional_user,
+    build_auth_context,
+    auth_context_from_token,
+    get_public_key_pem,
+    get_private_key
 )
 from crypto_utils import encrypt_data
-from config import BLOCKED_USER_AGENTS, SECRET_KEY, ALGORITHM
-import jwt
+from config import BLOCKED_USER_AGENTS, RATE_LIMIT_STORAGE_URI, DEBUG
 
 # --- Rate Limiter ---
-limiter = Limiter(key_func=get_remote_address)
+if RATE_LIMIT_STORAGE_URI.startswith("shm://"):
+    import shm_ratelimit  # noqa: F401 - registers the shm:// scheme with limits
+limiter = Limiter(key_func=get_remote_address, storage_uri=RATE_LIMIT_STORAGE_URI)
+
+categories_cache = TTLCache(maxsize=1, ttl=300)
+TRENDING_TTL = 60
+trending_cache = TTLCache(maxsize=2, ttl=TRENDING_TTL)
 
 # --- Pydantic Models ---
 
@@ -84,12 +114,16 @@ class NotificationRead(PydanticBaseModel):
     target_type: Optional[str]
     is_read: bool
     created_at: datetime
+    updated_at: Optional[datetime] = None
+    actor_count: int = 1 # Events folded into this row
+    recent_actors: List[UserRead] = [] # Newest first, at most notifications.RECENT_ACTORS
     
     class Config:
         from_attributes = True
 
 class PostRead(PostBase):
     id: int
+    excerpt: Optional[str] = None # Plain-text snippet rendered at write time
     created_at: datetime
     updated_at: datetime
     views: int
@@ -144,6 +178,98 @@ class SearchResult(PydanticBaseModel):
     url: str
     image_url: Optional[str] = None
 
+class PostListItem(PydanticBaseModel):
+    # Every field is optional: list endpoints only emit the fields that were asked for
+    id: int
+    title: Optional[str] = None
+    content: Optional[str] = None
+    excerpt: Optional[str] = None
+    category_id: Optional[int] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    views: Optional[int] = None
+    likes: Optional[int] = None
+    is_liked: Optional[bool] = None
+    is_pinned: Optional[bool] = None
+    user: Optional[UserRead] = None
+
+# --- Post List Projections ---
+# Lists select only the columns for the requested fields; `content` is never
+# read unless explicitly asked for (view=full or fields=...,content).
+
+POST_LIST_FIELDS = ("id", "title", "content", "excerpt", "category_id", "created_at", "updated_at",
+                    "views", "likes", "is_liked", "is_pinned", "user")
+POST_LIST_VIEWS = {
+    "full": set(POST_LIST_FIELDS),
+    "summary": set(POST_LIST_FIELDS) - {"content"},
+}
+POST_FIELD_COLUMNS = {
+    "title": [Post.title],
+    "content": [Post.content],
+    "excerpt": [Post.excerpt, Post.render_version],
+    "category_id": [Post.category],
+    "created_at": [Post.created_at],
+    "updated_at": [Post.updated_at],
+    "views": [Post.views],
+    "likes": [Post.likes],
+    "is_pinned": [Post.is_pinned],
+}
+
+def resolve_post_fields(view: str, fields: Optional[str]) -> set:
+    if fields:
+        requested = {f.strip() for f in fields.split(",") if f.strip()}
+        unknown = requested - set(POST_LIST_FIELDS)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+        return requested | {"id"}
+    if view not in POST_LIST_VIEWS:
+        raise HTTPException(status_code=400, detail=f"Unknown view: {view}")
+    return POST_LIST_VIEWS[view]
+
+def select_post_list(fields: set):
+    columns = [Post.id]
+    for field in fields:
+        columns.extend(POST_FIELD_COLUMNS.get(field, []))
+    if "user" in fields:
+        columns.extend([User.id, User.codemao_id, User.username, User.avatar_url, User.description, User.is_admin])
+        return Post.select(*columns).join(User).where(Post.is_deleted == False)
+    return Post.select(*columns).where(Post.is_deleted == False)
+
+def get_visible_post(post_id: int, fresh: bool = False) -> Post:
+    """
+    Cached post lookup; posts being deleted (see cascade.py) raise DoesNotExist like missing ones.
+    Write paths pass fresh=True: they save the row back, and must not attach
+    new rows to a post another worker has just hidden.
+    """
+    post = Post.get_by_id(post_id) if fresh else entity_cache.get(Post, post_id)
+    if post.is_deleted:
+        raise Post.DoesNotExist(post_id)
+    return post
+
+def serialize_post_list(posts: list, fields: set, current_user_id: Optional[int] = None) -> list:
+    if "excerpt" in fields:
+        ensure_rendered_many(posts)
+
+    # One IN query for like state instead of one EXISTS per post
+    liked_ids = set()
+    if "is_liked" in fields and current_user_id and posts:
+        liked_ids = {post_id for (post_id,) in PostLike
+                     .select(PostLike.post_id)
+                     .where((PostLike.user_id == current_user_id) & (PostLike.post_id.in_([p.id for p in posts])))
+                     .tuples()}
+
+    ordered = [f for f in POST_LIST_FIELDS if f in fields and f not in ("is_liked", "user")]
+    to_dict = compile_serializer(ordered)
+    result = []
+    for p in posts:
+        item = to_dict(p)
+        if "is_liked" in fields:
+            item["is_liked"] = p.id in liked_ids
+        if "user" in fields:
+            item["user"] = user_brief(p.user)
+        result.append(item)
+    return result
+
 # --- Security Helpers ---
 # Imported from security.py
 
@@ -153,38 +279,47 @@ class SearchResult(PydanticBaseModel):
 async def lifespan(app: FastAPI):
     if db.is_closed():
         db.connect()
-    create_tables()
-    
-    # Set user with ID 1 as admin
-    try:
-        user_1 = User.get_or_none(User.id == 1)
-        if user_1 and not user_1.is_admin:
-            user_1.is_admin = True
-            user_1.save()
-            print(f"Set user ID 1 ({user_1.username}) as admin")
-    except Exception as e:
-        print(f"Could not set user ID 1 as admin: {e}")
-    
-    # Init Categories
-    if Category.select().count() == 0:
-        categories = [
-            {"name": "General Discussion", "slug": "general"},
-            {"name": "Help & Support", "slug": "help"},
-            {"name": "Showcase", "slug": "showcase"},
-            {"name": "Tutorials", "slug": "tutorials"}
-        ]
-        for cat in categories:
-            Category.create(**cat)
-            
+    # serve.py runs setup once before forking workers and sets CODEMAN_SETUP_DONE,
+    # so workers don't race each other on migrations and seeding
+    if os.getenv("CODEMAN_SETUP_DONE") != "1":
+        setup_database()
+
+    heartbeat = asyncio.create_task(worker_health.heartbeat_loop())
+    relay = asyncio.create_task(notifications.relay_loop())
+    chat_flush = asyncio.create_task(chat_hub.hub.flush_loop())
+    chat_relay = asyncio.create_task(chat_hub.hub.relay_loop())
+    notification_writer = asyncio.create_task(notifications.writer.write_loop())
+    job_runner = asyncio.create_task(jobs.runner.run())
+    analytics_flush = asyncio.create_task(analytics.recorder.flush_loop())
+    snapshot_watch = asyncio.create_task(site_snapshot.watch_loop())
+    cache_watch = asyncio.create_task(entity_cache.watch_loop())
     yield
+    analytics_flush.cancel()
+    snapshot_watch.cancel()
+    cache_watch.cancel()
+    job_runner.cancel()
+    heartbeat.cancel()
+    relay.cancel()
+    chat_relay.cancel()
+    chat_flush.cancel()
+    notification_writer.cancel()
+    for task in (chat_flush, notification_writer, job_runner, analytics_flush):
+        try:
+            await task  # flushes buffered chat messages / notifications / counters and hands back running jobs
+        except asyncio.CancelledError:
+            pass
+    image_proxy.shutdown()
+    worker_health.remove_heartbeat()
     if not db.is_closed():
         db.close()
 
 app = FastAPI(lifespan=lifespan, title="CodeMan API")
 
-# Print routes for debugging
+# Print routes for debugging (DEBUG=1)
 @app.on_event("startup")
 async def startup_event():
+    if not DEBUG:
+        return
     print("--- Registered Routes ---")
     for route in app.routes:
         print(f"{route.path} [{route.name}]")
@@ -196,6 +331,8 @@ app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 @app.middleware("http")
 async def auth_middleware(request: Request, call_next):
+    worker_health.count_request()
+
     # 1. Allow OPTIONS (CORS preflight)
     if request.method == "OPTIONS":
         return await call_next(request)
@@ -211,19 +348,17 @@ async def auth_middleware(request: Request, call_next):
 
     # 3. Check Authentication for all other /api paths
     if request.url.path.startswith("/api"):
-        auth_header = request.headers.get("Authorization")
-        if auth_header and auth_header.startswith("Bearer "):
-            token = auth_header.split(" ")[1]
-            try:
-                # Verify token signature
-                jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            except jwt.ExpiredSignatureError:
-                return JSONResponse(status_code=401, content={"detail": "Token expired"})
-            except jwt.InvalidTokenError:
-                return JSONResponse(status_code=401, content={"detail": "Invalid token"})
-            except Exception as e:
-                print(f"Auth Middleware Error: {e}")
-                return JSONResponse(status_code=401, content={"detail": "Authentication failed"})
+        # Decode the token once; handlers and dependencies reuse request.state.auth
+        try:
+            ctx = build_auth_context(request)
+        except Exception as e:
+            print(f"Auth Middleware Error: {e}")
+            return JSONResponse(status_code=401, content={"detail": "Authentication failed"})
+        if ctx.error:
+            return JSONResponse(status_code=401, content={"detail": ctx.error})
+        request.state.auth = ctx
+        if ctx.user_id is not None:
+            analytics.seen(ctx.user_id)  # buffered, see analytics.py
         # Note: If no token, we proceed. Routes that require auth will fail in their dependencies.
 
 
@@ -269,12 +404,20 @@ async def anti_scraping_middleware(request: Request, call_next):
     response = await call_next(request)
     return response
 
-from routers import works, banners, codemao_forum, oauth, admin
+# --- Conditional GET (ETag / 304) ---
+app.middleware("http")(conditional_get_middleware)
+
+from routers import works, banners, codemao_forum, oauth, admin, chat, messages, feed, batch, images
 app.include_router(works.router, prefix="/api", tags=["works"])
 app.include_router(banners.router, prefix="/api", tags=["banners"])
 app.include_router(codemao_forum.router, prefix="/api", tags=["codemao-forum"])
 app.include_router(oauth.router, prefix="/api", tags=["oauth"])
 app.include_router(admin.router, prefix="/api", tags=["admin"])
+app.include_router(chat.router, prefix="/api", tags=["chat"])
+app.include_router(messages.router, prefix="/api", tags=["messages"])
+app.include_router(feed.router, prefix="/api", tags=["feed"])
+app.include_router(batch.router, prefix="/api", tags=["batch"])
+app.include_router(images.router, prefix="/api", tags=["images"])
 
 # --- CORS ---
 app.add_middleware(
@@ -293,6 +436,28 @@ app.add_middleware(
 def read_root():
     return {"message": "Welcome to CodeMan API (Connected to Codemao)"}
 
+@app.get("/api/health")
+def health_check():
+    """Liveness of the answering worker plus the last heartbeat of every worker (see serve.py)."""
+    try:
+        db.execute_sql("SELECT 1")
+        database_ok = True
+    except Exception as e:
+        print(f"Health check DB error: {e}")
+        database_ok = False
+    workers = worker_health.read_workers()
+    return JSONResponse(
+        status_code=200 if database_ok else 503,
+        content={
+            "status": "ok" if database_ok else "degraded",
+            "database": database_ok,
+            "worker": worker_health.snapshot(),
+            "workers": workers,
+            "workers_alive": sum(1 for w in workers if w["alive"])
+        },
+        headers={"Cache-Control": "no-store"}
+    )
+
 # --- Auth ---
 
 @app.get("/api/search/global", response_model=List[SearchResult])
@@ -302,18 +467,18 @@ async def global_search(request: Request, q: str = Query(..., min_length=1)):
     
     # 1. Search Posts
     posts = (Post.select()
-             .where((Post.title.contains(q)) | (Post.content.contains(q)))
+             .where(((Post.title.contains(q)) | (Post.content.contains(q))) & (Post.is_deleted == False))
              .order_by(Post.created_at.desc())
              .limit(5))
              
     for p in posts:
-        # Create a subtitle from content snippet
-        snippet = p.content[:100].replace('\n', ' ') + "..." if len(p.content) > 100 else p.content
+        # Subtitle comes from the excerpt stored at write time
+        ensure_rendered(p)
         results.append(SearchResult(
             type="post",
             id=str(p.id),
             title=p.title,
-            subtitle=snippet,
+            subtitle=p.excerpt,
             url=f"/forum/{p.id}",
             image_url=None
         ))
@@ -336,7 +501,7 @@ async def global_search(request: Request, q: str = Query(..., min_length=1)):
     # 3. Search Works (DB)
     works_list = (Work.select(Work, User)
              .join(User)
-             .where(Work.name.contains(q))
+             .where(Work.name.contains(q) & (Work.is_deleted == False))
              .limit(5))
              
     for w in works_list:
@@ -351,6 +516,7 @@ async def global_search(request: Request, q: str = Query(..., min_length=1)):
 
     # 4. Search BCM Posts (Codemao Forum)
     try:
+        import bleach  # imported lazily, see rendering.py
         url = "https://api.codemao.cn/web/forums/posts/search"
         params = {"title": q, "page": 1, "limit": 5}
         
@@ -381,7 +547,7 @@ async def global_search(request: Request, q: str = Query(..., min_length=1)):
 
 @app.get("/api/auth/public-key")
 def get_public_key():
-    return {"public_key": pem_public_key}
+    return {"public_key": get_public_key_pem()}
 
 @app.post("/api/auth/login", response_model=AuthResponse)
 @limiter.limit("5/minute")
@@ -389,7 +555,7 @@ async def login(data: LoginRequest, request: Request):
     # 1. Decrypt Password (RSA)
     try:
         encrypted_bytes = base64.b64decode(data.password)
-        decrypted_password = private_key.decrypt(
+        decrypted_password = get_private_key().decrypt(
             encrypted_bytes,
             padding.PKCS1v15()
         ).decode('utf-8')
@@ -438,8 +604,7 @@ async def login(data: LoginRequest, request: Request):
 
         # Check if banned
         if user.is_banned:
-             ban_screen = SystemSetting.get_or_none(SystemSetting.key == "ban_screen_html")
-             screen_html = ban_screen.value if ban_screen else "<h1>Account Suspended</h1><p>Your account has been banned.</p>"
+             screen_html = site_snapshot.setting("ban_screen_html", "<h1>Account Suspended</h1><p>Your account has been banned.</p>")
              return JSONResponse(status_code=403, content={
                  "detail": "Account Banned", 
                  "ban_reason": user.ban_reason,
@@ -463,6 +628,7 @@ async def login(data: LoginRequest, request: Request):
             user.login_identity = data.identity
             user.encrypted_password = encrypt_data(decrypted_password)
             user.save()
+            analytics.record("signups")
 
         # 6. Issue Application JWT
         # We ignore Codemao token for client-side auth, and use our own JWT
@@ -492,7 +658,7 @@ async def read_user_me(current_user: User = Depends(get_current_user)):
 @limiter.limit("60/minute")
 def read_user(user_id: int, request: Request):
     try:
-        user = User.get_by_id(user_id)
+        user = entity_cache.get(User, user_id)
         
         # Counts
         followers = Follow.select().where(Follow.followed == user).count()
@@ -500,22 +666,12 @@ def read_user(user_id: int, request: Request):
         
         # Check if current user is following this user
         is_following = False
-        auth_header = request.headers.get('Authorization')
-        if auth_header and auth_header.startswith("Bearer "):
-            try:
-                token = auth_header.split(" ")[1]
-                # Manually verify token to get current user ID
-                payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-                current_user_id = int(payload.get("sub"))
-                
-                # Check follow status
-                is_following = Follow.select().where(
-                    (Follow.follower_id == current_user_id) & 
-                    (Follow.followed_id == user.id)
-                ).exists()
-            except Exception as e:
-                # Token invalid or expired, treat as not logged in
-                pass
+        current_user_id = get_optional_user_id(request)
+        if current_user_id:
+            is_following = Follow.select().where(
+                (Follow.follower_id == current_user_id) & 
+                (Follow.followed_id == user.id)
+            ).exists()
         
         return {
             "id": user.id,
@@ -543,7 +699,7 @@ def follow_user(user_id: int, request: Request, current_user: User = Depends(get
         
         if created:
             # Create notification
-            Notification.create(
+            notifications.notify(
                 recipient=target_user,
                 sender=current_user,
                 type="follow",
@@ -551,6 +707,7 @@ def follow_user(user_id: int, request: Request, current_user: User = Depends(get
                 target_id=current_user.id,
                 target_type="user"
             )
+            jobs.enqueue("timeline.backfill_follow", {"follower_id": current_user.id, "author_id": target_user.id})
             
         return {"status": "success", "following": True}
     except User.DoesNotExist:
@@ -563,6 +720,8 @@ def unfollow_user(user_id: int, request: Request, current_user: User = Depends(g
         target_user = User.get_by_id(user_id)
         query = Follow.delete().where((Follow.follower == current_user) & (Follow.followed == target_user))
         rows = query.execute()
+        if rows:
+            timeline.remove_follow(current_user.id, target_user.id)
         return {"status": "success", "following": False}
     except User.DoesNotExist:
         raise HTTPException(status_code=404, detail="User not found")
@@ -577,17 +736,7 @@ def read_user_followers(user_id: int, request: Request):
                      .join(Follow, on=(Follow.follower == User.id))
                      .where(Follow.followed == user))
         
-        return [
-            {
-                "id": u.id,
-                "codemao_id": u.codemao_id,
-                "username": u.username,
-                "avatar_url": u.avatar_url,
-                "description": u.description,
-                "is_admin": u.is_admin
-            }
-            for u in followers
-        ]
+        return [user_brief(u) for u in followers]
     except User.DoesNotExist:
         raise HTTPException(status_code=404, detail="User not found")
 
@@ -601,58 +750,108 @@ def read_user_following(user_id: int, request: Request):
                      .join(Follow, on=(Follow.followed == User.id))
                      .where(Follow.follower == user))
         
-        return [
-            {
-                "id": u.id,
-                "codemao_id": u.codemao_id,
-                "username": u.username,
-                "avatar_url": u.avatar_url,
-                "description": u.description,
-                "is_admin": u.is_admin
-            }
-            for u in following
-        ]
+        return [user_brief(u) for u in following]
     except User.DoesNotExist:
         raise HTTPException(status_code=404, detail="User not found")
 
-@app.get("/api/users/{user_id}/posts", response_model=List[PostRead])
+@app.get("/api/users/{user_id}/posts", response_model=List[PostListItem], response_model_exclude_unset=True)
 @limiter.limit("30/minute")
-def read_user_posts(user_id: int, request: Request):
+def read_user_posts(user_id: int, request: Request, skip: int = 0, limit: int = Query(50, ge=1, le=100),
+                    view: str = "full", fields: Optional[str] = None):
     # Verify user exists first
     try:
         u = User.get_by_id(user_id)
     except User.DoesNotExist:
         raise HTTPException(status_code=404, detail="User not found")
-        
-    posts = (Post.select(Post, User)
-             .join(User)
-             .where(Post.user == u)
-             .order_by(Post.created_at.desc()))
-             
-    # Reuse the serialization logic from read_posts
-    return [
-        {
-            "id": p.id,
-            "title": p.title,
-            "content": p.content,
-            "category_id": p.category_id,
-            "created_at": p.created_at,
-            "updated_at": p.updated_at,
-            "views": p.views,
-            "likes": p.likes,
-            "is_pinned": p.is_pinned,
-            "user": u 
-        }
-        for p in posts
-    ]
+
+    selected = resolve_post_fields(view, fields)
+    posts = list(select_post_list(selected)
+                 .where(Post.user == u)
+                 .order_by(Post.created_at.desc())
+                 .offset(skip)
+                 .limit(limit))
+
+    return respond(serialize_post_list(posts, selected, get_optional_user_id(request)))
+
+def select_notifications(user_id: int, since_id: Optional[int] = None, since: Optional[datetime] = None):
+    query = (Notification.select(Notification, User)
+             .join(User, on=(Notification.sender == User.id))
+             .where(Notification.recipient == user_id))
+    if since_id is not None:
+        query = query.where(Notification.id > since_id)
+    if since is not None:
+        query = query.where(Notification.updated_at > since)
+    return list(query.order_by(Notification.updated_at.desc()).limit(50))
 
 @app.get("/api/notifications", response_model=List[NotificationRead])
-def get_notifications(request: Request, current_user: User = Depends(get_current_user)):
-    return list(Notification.select(Notification, User)
-                .join(User, on=(Notification.sender == User.id))
-                .where(Notification.recipient == current_user)
-                .order_by(Notification.created_at.desc())
-                .limit(50))
+async def get_notifications(request: Request, since_id: Optional[int] = None, since: Optional[datetime] = None,
+                            wait: int = Query(0, ge=0, le=30), current_user: User = Depends(get_current_user)):
+    """
+    Latest 50 notifications, most recently active first. Aggregated rows carry
+    actor_count/recent_actors and a rendered "and N others ..." message.
+    since_id returns only newer rows; since (an updated_at value) also returns rows
+    that gained actors. Both are indexed range scans that come back empty (and
+    instantly) when nothing changed.
+    Long-poll fallback for clients without WebSockets: with wait=N and nothing new,
+    the request is held up to N seconds until the hub publishes something.
+    """
+    def load() -> list:
+        return notifications.render(select_notifications(current_user.id, since_id, since))
+
+    if not wait or (since_id is None and since is None):
+        return respond(await asyncio.to_thread(load))
+    # Subscribe before the first select so an event published in between isn't missed
+    sub = notifications.hub.subscribe(current_user.id)
+    try:
+        items = await asyncio.to_thread(load)
+        if not items:
+            try:
+                await asyncio.wait_for(sub.queue.get(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+            items = await asyncio.to_thread(load)
+    finally:
+        notifications.hub.unsubscribe(sub)
+    return respond(items)
+
+@app.get("/api/notifications/unread-count")
+def get_unread_notification_count(request: Request, current_user: User = Depends(get_current_user)):
+    return {"unread": notifications.unread_count(current_user.id)}
+
+@app.websocket("/api/ws/notifications")
+async def notifications_socket(websocket: WebSocket, token: Optional[str] = None):
+    """
+    Push channel for NotificationCenter.vue. Authenticates with ?token= (browsers
+    can't set headers on a WebSocket handshake), sends {"type": "hello", "unread": n}
+    and then hub events as they happen. Clients may send "ping" to keep proxies happy.
+    """
+    ctx = auth_context_from_token(token)
+    user = await asyncio.to_thread(ctx.load_user) if not ctx.error else None
+    if user is None or user.is_banned:
+        await websocket.close(code=4401)
+        return
+
+    await websocket.accept()
+    sub = notifications.hub.subscribe(user.id)
+
+    async def pump():
+        while True:
+            event = await sub.queue.get()
+            await websocket.send_text(dumps(event).decode("utf-8"))
+
+    sender = asyncio.create_task(pump())
+    try:
+        unread = await asyncio.to_thread(notifications.unread_count, user.id)
+        await websocket.send_text(dumps({"type": "hello", "unread": unread}).decode("utf-8"))
+        while True:
+            message = await websocket.receive_text()
+            if message == "ping":
+                await websocket.send_text('{"type":"pong"}')
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        notifications.hub.unsubscribe(sub)
 
 @app.post("/api/notifications/{notification_id}/read")
 def mark_notification_read(notification_id: int, request: Request, current_user: User = Depends(get_current_user)):
@@ -660,8 +859,9 @@ def mark_notification_read(notification_id: int, request: Request, current_user:
         n = Notification.get_by_id(notification_id)
         if n.recipient_id != current_user.id:
             raise HTTPException(status_code=403, detail="Not your notification")
-        n.is_read = True
-        n.save()
+        if not n.is_read:
+            n.is_read = True
+            n.save()  # publishes a "read" event to the user's other tabs
         return {"status": "success"}
     except Notification.DoesNotExist:
         raise HTTPException(status_code=404, detail="Notification not found")
@@ -670,14 +870,18 @@ def mark_notification_read(notification_id: int, request: Request, current_user:
 def mark_all_read(request: Request, current_user: User = Depends(get_current_user)):
     query = Notification.update(is_read=True).where((Notification.recipient == current_user) & (Notification.is_read == False))
     query.execute()
+    # Bulk update skips the model hooks, so tell the hub directly
+    notifications.hub.publish(current_user.id, {"type": "read_all", "unread": 0})
     return {"status": "success"}
 
 # --- Posts ---
 
-@app.get("/api/posts", response_model=List[PostRead])
+@app.get("/api/posts", response_model=List[PostListItem], response_model_exclude_unset=True)
 @limiter.limit("60/minute")
-def read_posts(request: Request, skip: int = 0, limit: int = 100, category_id: Optional[int] = None):
-    query = Post.select(Post, User).join(User)
+def read_posts(request: Request, skip: int = 0, limit: int = Query(100, ge=1, le=100), category_id: Optional[int] = None,
+               view: str = "full", fields: Optional[str] = None):
+    selected = resolve_post_fields(view, fields)
+    query = select_post_list(selected)
     
     if category_id:
         query = query.where(Post.category_id == category_id)
@@ -685,97 +889,42 @@ def read_posts(request: Request, skip: int = 0, limit: int = 100, category_id: O
     # Order by is_pinned desc, then created_at desc
     posts = list(query.order_by(Post.is_pinned.desc(), Post.created_at.desc()).offset(skip).limit(limit))
     
-    # Determine current user for is_liked
-    current_user_id = None
-    auth_header = request.headers.get('Authorization')
-    if auth_header and auth_header.startswith("Bearer "):
-        try:
-            token = auth_header.split(" ")[1]
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            current_user_id = int(payload.get("sub"))
-        except:
-            pass
+    # Determine current user for is_liked (claims decoded once by auth_middleware)
+    current_user_id = get_optional_user_id(request)
 
-    # Peewee objects need to be converted to dicts compatible with Pydantic
-    # especially for the nested 'user' relation
-    result = []
-    for p in posts:
-        is_liked = False
-        if current_user_id:
-            is_liked = PostLike.select().where((PostLike.user_id == current_user_id) & (PostLike.post == p)).exists()
-
-        post_dict = {
-            "id": p.id,
-            "title": p.title,
-            "content": p.content,
-            "category_id": p.category_id,
-            "created_at": p.created_at,
-            "updated_at": p.updated_at,
-            "views": p.views,
-            "likes": p.likes,
-            "is_liked": is_liked,
-            "is_pinned": p.is_pinned,
-            "user": {
-                "id": p.user.id,
-                "codemao_id": p.user.codemao_id,
-                "username": p.user.username,
-                "avatar_url": p.user.avatar_url,
-                "description": p.user.description,
-                "is_admin": p.user.is_admin
-            }
-        }
-        result.append(post_dict)
-        
-    return result
+    return respond(serialize_post_list(posts, selected, current_user_id))
 
 @app.get("/api/posts/{post_id}", response_model=PostRead)
 @limiter.limit("60/minute")
 def read_post(post_id: int, request: Request, response: Response):
     try:
-        post = Post.get_by_id(post_id)
+        post = Post.select(Post, User).join(User).where((Post.id == post_id) & (Post.is_deleted == False)).get()
+        ensure_rendered(post)
         
         # Check cookie to prevent view spamming
         view_cookie = f"viewed_post_{post_id}"
         if not request.cookies.get(view_cookie):
+            # Atomic increment: concurrent readers would otherwise overwrite each other's count
+            Post.update(views=Post.views + 1).where(Post.id == post.id).execute()
             post.views += 1
-            post.save()
             response.set_cookie(key=view_cookie, value="1", max_age=86400)
 
-        # Determine current user for is_liked
-        current_user_id = None
-        auth_header = request.headers.get('Authorization')
-        if auth_header and auth_header.startswith("Bearer "):
-            try:
-                token = auth_header.split(" ")[1]
-                payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-                current_user_id = int(payload.get("sub"))
-            except:
-                pass
+        # Determine current user for is_liked (claims decoded once by auth_middleware)
+        current_user_id = get_optional_user_id(request)
         
         is_liked = False
         if current_user_id:
             is_liked = PostLike.select().where((PostLike.user_id == current_user_id) & (PostLike.post == post)).exists()
 
-        return {
-            "id": post.id,
-            "title": post.title,
-            "content": post.content,
-            "category_id": post.category_id,
-            "created_at": post.created_at,
-            "updated_at": post.updated_at,
-            "views": post.views,
-            "likes": post.likes,
-            "is_liked": is_liked,
-            "is_pinned": post.is_pinned,
-            "user": {
-                "id": post.user.id,
-                "codemao_id": post.user.codemao_id,
-                "username": post.user.username,
-                "avatar_url": post.user.avatar_url,
-                "description": post.user.description,
-                "is_admin": post.user.is_admin
-            }
-        }
+        # No Last-Modified: likes, pin state and author fields change without touching updated_at.
+        # Views are left out too, or busy posts would never revalidate; they're approximate anyway.
+        etag = make_etag(post.id, post.updated_at, post.render_version, post.likes, post.is_pinned,
+                         post.category_id, is_liked, post.user.username, post.user.avatar_url, post.user.is_admin)
+        not_modified = conditional_response(request, response, etag, vary_auth=True)
+        if not_modified:
+            return not_modified
+
+        return respond(serialize_post(post, is_liked), response)
     except Post.DoesNotExist:
         raise HTTPException(status_code=404, detail="Post not found")
 
@@ -787,75 +936,36 @@ def pin_post(post_id: int, request: Request, current_user: User = Depends(get_cu
         raise HTTPException(status_code=403, detail="Not authorized to pin posts")
         
     try:
-        post = Post.get_by_id(post_id)
+        post = get_visible_post(post_id, fresh=True)
         post.is_pinned = not post.is_pinned # Toggle
         post.save()
+        entity_cache.publish(Post, post.id)
         return {"status": "success", "is_pinned": post.is_pinned}
     except Post.DoesNotExist:
         raise HTTPException(status_code=404, detail="Post not found")
 
 @app.get("/api/posts/{post_id}/embed", response_class=HTMLResponse)
-def embed_post(post_id: int, hide_title: bool = False):
+def embed_post(post_id: int, request: Request, hide_title: bool = False):
     try:
-        post = Post.get_by_id(post_id)
-        # Convert Markdown to HTML
-        html_content = markdown.markdown(post.content, extensions=['fenced_code', 'tables'])
-        
-        # Sanitize HTML
-        allowed_tags = list(bleach.sanitizer.ALLOWED_TAGS) + [
-            'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'br', 'pre', 'code', 
-            'img', 'blockquote', 'ul', 'ol', 'li', 'hr', 'table', 'thead', 
-            'tbody', 'tr', 'th', 'td', 'div', 'span'
-        ]
-        allowed_attrs = {
-            '*': ['class'],
-            'img': ['src', 'alt', 'title', 'width', 'height'],
-            'a': ['href', 'title', 'target']
-        }
-        
-        clean_html = bleach.clean(html_content, tags=allowed_tags, attributes=allowed_attrs)
+        post = get_visible_post(post_id)
+        post.user = entity_cache.get(User, post.user_id)
+        # Use the HTML stored at write time (re-rendered only if stale)
+        ensure_rendered(post)
 
-        # Process [work:ID] tags
-        def replace_work_tag(match):
-            try:
-                work_id = int(match.group(1))
-                # works module is imported below, but we can access it if it's in global scope
-                # However, python functions capture global scope.
-                # Let's ensure works is available. It is imported at module level later.
-                # To be safe, we might need to move the import up or rely on it being available at runtime.
-                # Since embed_post is called after app startup, works should be imported.
-                work = works.get_work_details(work_id)
-                
-                if not work:
-                    return f'<div class="work-card-error" style="padding:10px; background:#fee; color:red; border-radius:4px;">Work ID {work_id} not found</div>'
-                
-                # Sanitize data
-                safe_name = bleach.clean(work['work_name'])
-                safe_nick = bleach.clean(work['nickname'])
-                
-                return f"""
-                <div class="work-card">
-                    <a href="https://shequ.codemao.cn/work/{work['work_id']}" target="_blank" class="work-link">
-                        <div class="work-cover" style="background-image: url('{work['preview_url']}')"></div>
-                        <div class="work-info">
-                            <div class="work-title">{safe_name}</div>
-                            <div class="work-author">
-                                <img src="{work['avatar_url']}" alt="Avatar">
-                                <span>{safe_nick}</span>
-                            </div>
-                            <div class="work-stats">
-                                <span>👁️ {work['views_count']}</span>
-                                <span>❤️ {work['likes_count']}</span>
-                            </div>
-                        </div>
-                    </a>
-                </div>
-                """
-            except Exception as e:
-                print(f"Error expanding work tag: {e}")
-                return f'<span style="color:red">[Error loading work]</span>'
-
-        clean_html = re.sub(r'\[work:(\d+)\]', replace_work_tag, clean_html)
+        # Work cards embed live stats, so the resolved card data is part of the version.
+        # Hashing the data (not a per-process counter) gives every worker the same ETag.
+        try:
+            cards = work_cards.resolve_tags(post.content_html)
+        except Exception as e:
+            print(f"Error resolving work cards: {e}")
+            cards = None
+        etag = make_etag(post.id, post.updated_at, post.render_version, hide_title, post.user.username,
+                         work_cards.cards_version(cards) if cards is not None else "error")
+        if cards is not None and is_not_modified(request, etag, None):
+            return Response(status_code=304, headers=validator_headers(etag))
+
+        # Expand [work:ID] tags with the cards resolved above (one batched lookup for the whole post)
+        clean_html = expand_work_tags(post.content_html, cards)
 
         title_html = f"<h1>{post.title}</h1>" if not hide_title else ""
         meta_html = f'<div class="meta">Posted by <strong>{post.user.username}</strong> on {post.created_at.strftime("%Y-%m-%d %H:%M")}</div><hr>' if not hide_title else ""
@@ -1002,8 +1112,8 @@ def embed_post(post_id: int, hide_title: bool = False):
         </body>
         </html>
         """
-        return HTMLResponse(content=html)
-    except Post.DoesNotExist:
+        return HTMLResponse(content=html, headers=validator_headers(etag))
+    except (Post.DoesNotExist, User.DoesNotExist):
         raise HTTPException(status_code=404, detail="Post not found")
 
 @app.post("/api/posts", response_model=PostRead)
@@ -1013,35 +1123,20 @@ async def create_post(post: PostCreate, request: Request, current_user: User = D
         title=post.title,
         content=post.content,
         category_id=post.category_id,
-        user=current_user
+        user=current_user,
+        **render_post_fields(post.content)
     )
+    jobs.enqueue("timeline.fan_out", {"author_id": current_user.id, "item_type": "post", "item_id": new_post.id})
+    analytics.record("posts", post.category_id)
     
     # Return formatted response
-    return {
-            "id": new_post.id,
-            "title": new_post.title,
-            "content": new_post.content,
-            "category_id": new_post.category_id,
-            "created_at": new_post.created_at,
-            "updated_at": new_post.updated_at,
-            "views": new_post.views,
-            "likes": new_post.likes,
-            "is_pinned": new_post.is_pinned,
-            "user": {
-                "id": current_user.id,
-                "codemao_id": current_user.codemao_id,
-                "username": current_user.username,
-                "avatar_url": current_user.avatar_url,
-                "description": current_user.description,
-                "is_admin": current_user.is_admin
-            }
-    }
+    return respond(serialize_post(new_post, user=current_user))
 
 @app.put("/api/posts/{post_id}", response_model=PostRead)
 @limiter.limit("10/minute")
 async def update_post(post_id: int, post_update: PostCreate, request: Request, current_user: User = Depends(get_current_user)):
     try:
-        post = Post.get_by_id(post_id)
+        post = get_visible_post(post_id, fresh=True)
         
         # Check permissions: Author OR Admin
         if post.user.id != current_user.id and not current_user.is_admin:
@@ -1049,30 +1144,15 @@ async def update_post(post_id: int, post_update: PostCreate, request: Request, c
             
         post.title = post_update.title
         post.content = post_update.content
+        for key, value in render_post_fields(post_update.content).items():
+            setattr(post, key, value)
         if post_update.category_id:
             post.category_id = post_update.category_id
         post.updated_at = datetime.utcnow()
         post.save()
+        entity_cache.publish(Post, post.id)  # embeds on other workers read the cached row
         
-        return {
-            "id": post.id,
-            "title": post.title,
-            "content": post.content,
-            "category_id": post.category_id,
-            "created_at": post.created_at,
-            "updated_at": post.updated_at,
-            "views": post.views,
-            "likes": post.likes,
-            "is_pinned": post.is_pinned,
-            "user": {
-                "id": post.user.id,
-                "codemao_id": post.user.codemao_id,
-                "username": post.user.username,
-                "avatar_url": post.user.avatar_url,
-                "description": post.user.description,
-                "is_admin": post.user.is_admin
-            }
-        }
+        return respond(serialize_post(post))
     except Post.DoesNotExist:
         raise HTTPException(status_code=404, detail="Post not found")
 
@@ -1080,30 +1160,33 @@ async def update_post(post_id: int, post_update: PostCreate, request: Request, c
 @limiter.limit("10/minute")
 async def delete_post(post_id: int, request: Request, current_user: User = Depends(get_current_user)):
     try:
-        post = Post.get_by_id(post_id)
+        post = get_visible_post(post_id)
         
         # Check permissions: Author OR Admin
         if post.user.id != current_user.id and not current_user.is_admin:
             raise HTTPException(status_code=403, detail="Not authorized to delete this post")
             
-        # Delete associated comments first (cascade usually handles this but peewee might need explicit)
-        # Assuming cascade delete is not set up in DB, let's delete manually to be safe or rely on DB
-        # SQLite with foreign keys enabled supports cascade.
-        # But to be safe:
-        Comment.delete().where(Comment.post == post).execute()
-        
-        post.delete_instance()
-        return {"status": "success", "message": "Post deleted"}
+        # Hidden right away; comments, likes, notifications and the row itself
+        # are removed in small batches by a background job (cascade.py)
+        deletion = cascade.start("post", post.id, requested_by=current_user.id)
+        return {"status": "success", "message": "Post deleted", "deletion_id": deletion.id}
     except Post.DoesNotExist:
         raise HTTPException(status_code=404, detail="Post not found")
 
+@app.get("/api/deletions/{deletion_id}")
+def get_deletion_progress(deletion_id: int, request: Request, current_user: User = Depends(get_current_user)):
+    deletion = Deletion.get_or_none(Deletion.id == deletion_id)
+    if deletion is None or (deletion.requested_by_id != current_user.id and not current_user.is_admin):
+        raise HTTPException(status_code=404, detail="Deletion not found")
+    return cascade.progress(deletion)
+
 @app.post("/api/reports", response_model=ReportRead)
 @limiter.limit("5/minute")
 async def create_report(report: ReportCreate, request: Request, current_user: User = Depends(get_current_user)):
     # Validate target exists
     if report.target_type == "post":
         try:
-            Post.get_by_id(int(report.target_id))
+            get_visible_post(int(report.target_id))
         except:
             raise HTTPException(status_code=404, detail="Target post not found")
     elif report.target_type == "user":
@@ -1113,7 +1196,7 @@ async def create_report(report: ReportCreate, request: Request, current_user: Us
             raise HTTPException(status_code=404, detail="Target user not found")
     # Add other types checks if needed
     
-    new_report = Report.create(
+    new_report = reports.file_report(
         reporter=current_user,
         target_type=report.target_type,
         target_id=report.target_id,
@@ -1122,14 +1205,7 @@ async def create_report(report: ReportCreate, request: Request, current_user: Us
     
     return {
         "id": new_report.id,
-        "reporter": {
-            "id": current_user.id,
-            "codemao_id": current_user.codemao_id,
-            "username": current_user.username,
-            "avatar_url": current_user.avatar_url,
-            "description": current_user.description,
-            "is_admin": current_user.is_admin
-        },
+        "reporter": user_brief(current_user),
         "target_type": new_report.target_type,
         "target_id": new_report.target_id,
         "reason": new_report.reason,
@@ -1137,9 +1213,23 @@ async def create_report(report: ReportCreate, request: Request, current_user: Us
         "created_at": new_report.created_at
     }
 
+def cached_categories() -> tuple:
+    # Categories are only seeded at startup, so the payload and its ETag are cached
+    cached = categories_cache.get("all")
+    if cached is None:
+        categories = list(Category.select().order_by(Category.id).dicts())
+        cached = (categories, make_etag(*[(c["id"], c["name"], c["slug"]) for c in categories]))
+        categories_cache.set("all", cached)
+    return cached
+
 @app.get("/api/categories", response_model=List[CategoryRead])
-def read_categories():
-    return list(Category.select().dicts())
+def read_categories(request: Request, response: Response):
+    categories, etag = cached_categories()
+
+    not_modified = conditional_response(request, response, etag)
+    if not_modified:
+        return not_modified
+    return categories
 
 # --- Comments ---
 
@@ -1147,7 +1237,7 @@ def read_categories():
 def read_comments(post_id: int, request: Request):
     # Check if post exists
     try:
-        Post.get_by_id(post_id)
+        get_visible_post(post_id)
     except Post.DoesNotExist:
         raise HTTPException(status_code=404, detail="Post not found")
         
@@ -1157,45 +1247,23 @@ def read_comments(post_id: int, request: Request):
                 .where((Comment.post_id == post_id) & (Comment.is_deleted == False))
                 .order_by(Comment.created_at.desc()))
                 
-    # Determine current user for is_liked
-    current_user_id = None
-    auth_header = request.headers.get('Authorization')
-    if auth_header and auth_header.startswith("Bearer "):
-        try:
-            token = auth_header.split(" ")[1]
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            current_user_id = int(payload.get("sub"))
-        except:
-            pass
+    # Determine current user for is_liked (claims decoded once by auth_middleware)
+    current_user_id = get_optional_user_id(request)
 
-    result = []
-    for c in comments:
-        is_liked = False
-        if current_user_id:
-            is_liked = CommentLike.select().where((CommentLike.user_id == current_user_id) & (CommentLike.comment == c)).exists()
-            
-        result.append({
-            "id": c.id,
-            "content": c.content,
-            "created_at": c.created_at,
-            "likes": c.likes,
-            "is_liked": is_liked,
-            "parent_id": c.parent_id,
-            "user": {
-                "id": c.user.id,
-                "codemao_id": c.user.codemao_id,
-                "username": c.user.username,
-                "avatar_url": c.user.avatar_url,
-                "description": c.user.description,
-                "is_admin": c.user.is_admin
-            }
-        })
-    return result
+    comments = list(comments)
+    liked_ids = set()
+    if current_user_id and comments:
+        liked_ids = {comment_id for (comment_id,) in CommentLike
+                     .select(CommentLike.comment_id)
+                     .where((CommentLike.user_id == current_user_id) & (CommentLike.comment_id.in_([c.id for c in comments])))
+                     .tuples()}
+
+    return respond([serialize_comment(c, c.id in liked_ids) for c in comments])
 
 @app.post("/api/posts/{post_id}/like")
 async def like_post(post_id: int, current_user: User = Depends(get_current_user)):
     try:
-        post = Post.get_by_id(post_id)
+        post = get_visible_post(post_id, fresh=True)
     except Post.DoesNotExist:
         raise HTTPException(status_code=404, detail="Post not found")
 
@@ -1213,7 +1281,7 @@ async def like_post(post_id: int, current_user: User = Depends(get_current_user)
         
         # Notify owner
         if post.user.id != current_user.id:
-             Notification.create(
+             notifications.notify(
                 recipient=post.user,
                 sender=current_user,
                 type="like",
@@ -1228,7 +1296,8 @@ async def like_post(post_id: int, current_user: User = Depends(get_current_user)
 async def like_comment(comment_id: int, current_user: User = Depends(get_current_user)):
     try:
         comment = Comment.get_by_id(comment_id)
-    except Comment.DoesNotExist:
+        get_visible_post(comment.post_id, fresh=True)
+    except (Comment.DoesNotExist, Post.DoesNotExist):
         raise HTTPException(status_code=404, detail="Comment not found")
 
     existing_like = CommentLike.get_or_none(CommentLike.user == current_user, CommentLike.comment == comment)
@@ -1251,7 +1320,7 @@ async def report_comment(comment_id: int, report: ReportCreate, current_user: Us
     except Comment.DoesNotExist:
         raise HTTPException(status_code=404, detail="Comment not found")
         
-    Report.create(
+    reports.file_report(
         reporter=current_user,
         target_type="comment",
         target_id=str(comment.id),
@@ -1280,9 +1349,11 @@ async def delete_comment(post_id: int, comment_id: int, request: Request, curren
     except Comment.DoesNotExist:
         raise HTTPException(status_code=404, detail="Comment not found")
 
-@app.get("/api/trending/posts", response_model=List[PostRead])
-@limiter.limit("20/minute")
-def get_trending_posts(request: Request):
+def trending_post_ids() -> List[int]:
+    """Ranked ids for /api/trending/posts; the ranking is shared by everyone for TRENDING_TTL seconds."""
+    cached = trending_cache.get("posts")
+    if cached is not None:
+        return cached
     # Enhanced trending algorithm with time decay
     # Score = (likes * 2 + views) * time_decay_factor
     # Time decay: newer content gets higher scores
@@ -1294,7 +1365,8 @@ def get_trending_posts(request: Request):
     # Get posts from last 7 days with engagement
     # We calculate score in Python to avoid complex SQL date math issues across DBs
     try:
-        recent_posts = list(Post.select().where(Post.created_at >= week_ago))
+        # Only the columns needed for scoring; the page itself is projected below
+        recent_posts = list(Post.select(Post.id, Post.created_at, Post.likes, Post.views).where((Post.created_at >= week_ago) & (Post.is_deleted == False)))
         print(f"Found {len(recent_posts)} recent posts")
     except Exception as e:
         print(f"Error fetching posts: {e}")
@@ -1332,17 +1404,29 @@ def get_trending_posts(request: Request):
     # If not enough recent posts, fall back to global trending
     if len(posts) < 6:
         exclude_ids = [p.id for p in posts]
-        additional_posts = (Post.select()
-                           .where(Post.id.not_in(exclude_ids))
+        additional_posts = (Post.select(Post.id)
+                           .where(Post.id.not_in(exclude_ids) & (Post.is_deleted == False))
                            .order_by((Post.likes * 2 + Post.views).desc())
                            .limit(6 - len(posts)))
         posts = posts + list(additional_posts)
-    
-    return posts
 
-@app.get("/api/trending/works", response_model=List[SearchResult])
+    ranked_ids = [p.id for p in posts]
+    trending_cache.set("posts", ranked_ids)
+    return ranked_ids
+
+@app.get("/api/trending/posts", response_model=List[PostListItem], response_model_exclude_unset=True)
 @limiter.limit("20/minute")
-def get_trending_works(request: Request):
+def get_trending_posts(request: Request, view: str = "full", fields: Optional[str] = None):
+    selected = resolve_post_fields(view, fields)
+    ranked_ids = trending_post_ids()
+    rows = {p.id: p for p in select_post_list(selected).where(Post.id.in_(ranked_ids))}
+    return respond(serialize_post_list([rows[i] for i in ranked_ids if i in rows], selected, get_optional_user_id(request)))
+
+def trending_works() -> List[dict]:
+    """Trending work results, shared for TRENDING_TTL seconds."""
+    cached = trending_cache.get("works")
+    if cached is not None:
+        return cached
     # Enhanced trending works with original author support
     from datetime import datetime, timedelta
     
@@ -1352,7 +1436,7 @@ def get_trending_works(request: Request):
     
     # Fetch works in Python to calculate score
     try:
-        recent_works = list(Work.select(Work, User).join(User).where(Work.created_at >= month_ago))
+        recent_works = list(Work.select(Work, User).join(User).where((Work.created_at >= month_ago) & (Work.is_deleted == False)))
         print(f"Found {len(recent_works)} recent works")
     except Exception as e:
         print(f"Error fetching works: {e}")
@@ -1384,7 +1468,7 @@ def get_trending_works(request: Request):
             return 0
         
     recent_works.sort(key=calculate_score, reverse=True)
-    trending_works = recent_works[:12]
+    top_works = recent_works[:12]
                 
     results = []
     
@@ -1396,36 +1480,42 @@ def get_trending_works(request: Request):
             else:
                 author_name = w.user.username
                 
-            results.append(SearchResult(
-                type="work",
-                id=str(w.work_id),
-                title=w.name,
-                subtitle=f"by {author_name}",
-                url=f"https://shequ.codemao.cn/work/{w.work_id}",
-                image_url=w.cover_url
-            ))
+            results.append({
+                "type": "work",
+                "id": str(w.work_id),
+                "title": w.name,
+                "subtitle": f"by {author_name}",
+                "url": f"https://shequ.codemao.cn/work/{w.work_id}",
+                "image_url": w.cover_url
+            })
             
-    add_to_results(trending_works)
+    add_to_results(top_works)
         
     # If not enough recent works, add popular works from all time
     if len(results) < 6:
-        exclude_ids = [w.id for w in trending_works]
+        exclude_ids = [w.id for w in top_works]
         additional_works = (Work.select(Work, User)
                              .join(User)
-                             .where(Work.id.not_in(exclude_ids))
+                             .where(Work.id.not_in(exclude_ids) & (Work.is_deleted == False))
                              .order_by((Work.likes * 2 + Work.views).desc())
                              .limit(6 - len(results)))
         
         add_to_results(additional_works)
     
+    trending_cache.set("works", results)
     return results
 
+@app.get("/api/trending/works", response_model=List[SearchResult])
+@limiter.limit("20/minute")
+def get_trending_works(request: Request):
+    return trending_works()
+
 @app.post("/api/posts/{post_id}/comments", response_model=CommentRead)
 @limiter.limit("10/minute")
 async def create_comment(post_id: int, comment: CommentCreate, request: Request, current_user: User = Depends(get_current_user)):
     try:
         try:
-            post = Post.get_by_id(post_id)
+            post = get_visible_post(post_id, fresh=True)
         except Post.DoesNotExist:
             raise HTTPException(status_code=404, detail="Post not found")
         
@@ -1448,68 +1538,148 @@ async def create_comment(post_id: int, comment: CommentCreate, request: Request,
             is_deleted=False
         )
         
+        # Every notification for this comment goes to the background writer as one batch
+        events = []
+
         # Notify Post Owner or Parent Commenter
-        if parent and parent.user.id != current_user.id:
-            Notification.create(
-                recipient=parent.user,
+        if parent and parent.user_id != current_user.id:
+            events.append(notifications.event(
+                recipient=parent.user_id,
                 sender=current_user,
                 type="reply",
                 message=f"replied to your comment on: {post.title[:30]}...",
                 target_id=post.id,
                 target_type="post"
-            )
-        elif post.user.id != current_user.id:
-            Notification.create(
-                recipient=post.user,
+            ))
+        elif post.user_id != current_user.id:
+            events.append(notifications.event(
+                recipient=post.user_id,
                 sender=current_user,
                 type="comment",
                 message=f"commented on your post: {post.title[:30]}...",
                 target_id=post.id,
                 target_type="post"
-            )
+            ))
 
-        # Notify Mentioned Users
-        # Regex to find @username pattern
-        mentioned_usernames = set(re.findall(r'@(\w+)', comment.content))
-        for username in mentioned_usernames:
+        # Notify Mentioned Users (one IN query for all handles, see mentions.py)
+        handles = [h for h in mentions.extract(comment.content) if h != current_user.username]
+        for user_id in set(mentions.resolve(handles).values()):
             # Don't notify self or post owner (already notified above)
-            if username == current_user.username:
+            if user_id in (current_user.id, post.user_id):
                 continue
-                
-            try:
-                target_user = User.get(User.username == username)
-                if target_user.id == post.user.id:
-                    continue # Already notified as post owner
-                    
-                Notification.create(
-                    recipient=target_user,
-                    sender=current_user,
-                    type="mention",
-                    message=f"mentioned you in a comment on: {post.title[:30]}...",
-                    target_id=post.id,
-                    target_type="post"
-                )
-            except User.DoesNotExist:
-                pass # User not found, ignore
+            events.append(notifications.event(
+                recipient=user_id,
+                sender=current_user,
+                type="mention",
+                message=f"mentioned you in a comment on: {post.title[:30]}...",
+                target_id=post.id,
+                target_type="post"
+            ))
 
-        return {
-        "id": new_comment.id,
-        "content": new_comment.content,
-        "created_at": new_comment.created_at,
-        "likes": 0,
-        "is_liked": False,
-        "parent_id": new_comment.parent.id if new_comment.parent else None,
-        "user": {
-            "id": current_user.id,
-            "codemao_id": current_user.codemao_id,
-            "username": current_user.username,
-            "avatar_url": current_user.avatar_url,
-            "description": current_user.description,
-            "is_admin": current_user.is_admin
-        }
-    }
+        notifications.writer.submit(events)
+        analytics.record("comments")
+
+        return respond(serialize_comment(new_comment, user=current_user))
     except HTTPException:
         raise
     except Exception as e:
         print(f"Error creating comment: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+
+# --- Bootstrap ---
+# Everything the SPA asks for on first load, in one round trip. Sections run
+# concurrently, each from its own cache where it has one (snapshot, trending,
+# categories, official banners). A section that times out or fails is
+# reported under "errors" and the others are still returned.
+BOOTSTRAP_SECTION_TIMEOUT = float(os.getenv("BOOTSTRAP_SECTION_TIMEOUT", 3))
+# Sync sections get their own small pool: a section that times out keeps its
+# thread until the query returns, and that must not eat the threadpool every
+# other handler runs on. When this pool is full, new sections queue here and
+# are dropped unstarted if they time out.
+BOOTSTRAP_WORKERS = int(os.getenv("BOOTSTRAP_WORKERS", 8))
+bootstrap_pool = ThreadPoolExecutor(max_workers=BOOTSTRAP_WORKERS, thread_name_prefix="bootstrap")
+
+def _bootstrap_me(user: Optional[User]):
+    return UserRead.model_validate(user).model_dump() if user else None
+
+def _bootstrap_notifications(user: Optional[User]):
+    return notifications.render(select_notifications(user.id)) if user else None
+
+def _bootstrap_announcements(user: Optional[User]):
+    return [a for a in site_snapshot.current().announcements if a["active"]]
+
+def _bootstrap_categories(user: Optional[User]):
+    return cached_categories()[0]
+
+async def _bootstrap_banners(user: Optional[User]):
+    return await banners.get_banners()
+
+def _bootstrap_trending_posts(user: Optional[User]):
+    selected = resolve_post_fields("full", None)
+    ranked_ids = trending_post_ids()
+    rows = {p.id: p for p in select_post_list(selected).where(Post.id.in_(ranked_ids))}
+    return serialize_post_list([rows[i] for i in ranked_ids if i in rows], selected, user.id if user else None)
+
+def _bootstrap_trending_works(user: Optional[User]):
+    return trending_works()
+
+def _bootstrap_posts(user: Optional[User]):
+    selected = resolve_post_fields("full", None)
+    posts = list(select_post_list(selected).order_by(Post.is_pinned.desc(), Post.created_at.desc()).limit(5))
+    return serialize_post_list(posts, selected, user.id if user else None)
+
+def _bootstrap_works(user: Optional[User]):
+    return works.get_works()
+
+BOOTSTRAP_SECTIONS = {
+    "me": _bootstrap_me,
+    "announcements": _bootstrap_announcements,
+    "categories": _bootstrap_categories,
+    "banners": _bootstrap_banners,
+    "notifications": _bootstrap_notifications,
+    "trending_posts": _bootstrap_trending_posts,
+    "trending_works": _bootstrap_trending_works,
+    "posts": _bootstrap_posts,
+    "works": _bootstrap_works,
+}
+
+async def _run_section(name: str, user: Optional[User]):
+    section = BOOTSTRAP_SECTIONS[name]
+    if asyncio.iscoroutinefunction(section):
+        call = section(user)
+    else:
+        run = functools.partial(contextvars.copy_context().run, section, user)
+        call = asyncio.get_running_loop().run_in_executor(bootstrap_pool, run)
+    return await asyncio.wait_for(call, timeout=BOOTSTRAP_SECTION_TIMEOUT)
+
+@app.get("/api/bootstrap")
+@limiter.limit("30/minute")
+async def bootstrap(request: Request, sections: Optional[str] = None, user: Optional[User] = Depends(get_optional_user)):
+    """
+    First-load data in one request: {"sections": {name: data}, "errors": {name: reason}}.
+    ?sections=me,posts picks sections (default: all). me and notifications are null when anonymous.
+    """
+    if sections:
+        names = list(dict.fromkeys(n.strip() for n in sections.split(",") if n.strip()))
+        unknown = [n for n in names if n not in BOOTSTRAP_SECTIONS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown sections: {', '.join(unknown)}")
+    else:
+        names = list(BOOTSTRAP_SECTIONS)
+
+    results = await asyncio.gather(*(_run_section(n, user) for n in names), return_exceptions=True)
+    data, errors = {}, {}
+    for name, result in zip(names, results):
+        if isinstance(result, asyncio.TimeoutError):
+            data[name] = None
+            errors[name] = "timeout"
+        elif isinstance(result, HTTPException):
+            data[name] = None
+            errors[name] = result.detail
+        elif isinstance(result, Exception):
+            print(f"Bootstrap section {name} failed: {result}")
+            data[name] = None
+            errors[name] = "error"
+        else:
+            data[name] = result
+    return respond({"sections": data, "errors": errors})
@@ -0,0 +1,68 @@
+"""
+@handle resolution for comments.
+
+resolve() looks up every handle of a comment with one indexed
+`username IN (...)` query. Results, including misses, are kept in a
+username -> id cache. Misses use a short TTL so a newly registered user
+becomes mentionable quickly. Any User save drops the cached entries for
+both its current username and the one it was cached under, so a rename
+frees the old handle right away.
+
+Usernames are Codemao nicknames and are not unique. As before, a handle
+resolves to one account: the oldest one with that name.
+"""
+import re
+from typing import Dict, Iterable, List
+
+from cache import TTLCache
+from models import User, on_model_write
+
+MENTION_RE = re.compile(r'@(\w+)')
+MAX_MENTIONS = 50 # Per comment; handles past this are ignored
+MISS_TTL = 60
+
+_NOT_FOUND = 0
+_ids = TTLCache(maxsize=20000, ttl=600)
+_handles = TTLCache(maxsize=20000, ttl=600) # user id -> handle cached for it
+
+def extract(text: str) -> List[str]:
+    """Distinct handles in order of first appearance, capped at MAX_MENTIONS."""
+    return list(dict.fromkeys(MENTION_RE.findall(text or "")))[:MAX_MENTIONS]
+
+def resolve(handles: Iterable[str]) -> Dict[str, int]:
+    """Maps each handle that belongs to a user to that user's id."""
+    result, missing = {}, []
+    for handle in handles:
+        user_id = _ids.get(handle)
+        if user_id is None:
+            missing.append(handle)
+        elif user_id != _NOT_FOUND:
+            result[handle] = user_id
+    if missing:
+        found = {}
+        rows = (User.select(User.id, User.username)
+                .where(User.username.in_(missing))
+                .order_by(User.id.desc())
+                .tuples())
+        for user_id, username in rows:
+            found[username] = user_id # Descending, so the oldest account wins
+        for handle in missing:
+            if handle in found:
+                _ids.set(handle, found[handle])
+                _handles.set(found[handle], handle)
+                result[handle] = found[handle]
+            else:
+                _ids.set(handle, _NOT_FOUND, ttl=MISS_TTL)
+    return result
+
+@on_model_write
+def _invalidate(instance, deleted: bool) -> None:
+    if not isinstance(instance, User):
+        return
+    if instance.username:
+        _ids.delete(instance.username)
+    old = _handles.get(instance.id)
+    if old is not None:
+        # Renamed (or deleted): the old handle must stop resolving to this account
+        _ids.delete(old)
+        _handles.delete(instance.id)
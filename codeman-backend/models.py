@@ -1,19 +1,53 @@
 
 from peewee import *
 from datetime import datetime
+import hashlib
 import os
 
 db_path = os.getenv('DB_PATH', 'database.db')
-db = SqliteDatabase(db_path)
+# WAL lets readers run alongside a writer and busy_timeout makes concurrent writers
+# from other worker processes wait for the lock instead of failing with "database is locked"
+db = SqliteDatabase(db_path, pragmas={
+    'journal_mode': 'wal',
+    'busy_timeout': 5000,
+    'synchronous': 'normal'
+})
+
+# Callbacks run after any model instance is saved or deleted, used by the
+# in-process caches (entity_cache.py, work_cards.py) to drop stale entries.
+# Bulk Model.update()/delete() queries bypass these and must invalidate explicitly.
+_write_hooks = []
+
+def on_model_write(hook):
+    """Registers hook(instance, deleted) to run after save()/delete_instance()."""
+    _write_hooks.append(hook)
+    return hook
+
+def _run_write_hooks(instance, deleted):
+    for hook in _write_hooks:
+        try:
+            hook(instance, deleted)
+        except Exception as e:
+            print(f"Model write hook error: {e}")
 
 class BaseModel(Model):
     class Meta:
         database = db
 
+    def save(self, *args, **kwargs):
+        result = super().save(*args, **kwargs)
+        _run_write_hooks(self, False)
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        result = super().delete_instance(*args, **kwargs)
+        _run_write_hooks(self, True)
+        return result
+
 class User(BaseModel):
     # Codemao ID as primary identifier
     codemao_id = CharField(unique=True, index=True) 
-    username = CharField() # Codemao username/nickname
+    username = CharField(index=True) # Codemao username/nickname; indexed for @mention lookups
     avatar_url = CharField(null=True)
     description = TextField(null=True) # User bio
     codemao_token = TextField(null=True) # Store Codemao OAuth token
@@ -34,6 +68,11 @@ class Category(BaseModel):
 class Post(BaseModel):
     title = CharField()
     content = TextField() # Markdown content
+    # --- Render-at-write output (see rendering.py) ---
+    content_html = TextField(null=True) # Sanitized HTML, [work:ID] tags still unexpanded
+    excerpt = TextField(null=True) # Plain-text snippet for lists and search
+    render_version = IntegerField(default=0)
+    # -------------------------------------------------
     created_at = DateTimeField(default=datetime.utcnow)
     updated_at = DateTimeField(default=datetime.utcnow)
     
@@ -43,6 +82,12 @@ class Post(BaseModel):
     views = IntegerField(default=0)
     likes = IntegerField(default=0)
     is_pinned = BooleanField(default=False) # New field for pinning posts
+    is_deleted = BooleanField(default=False) # Hidden at once on delete; rows removed by cascade.py
+
+    class Meta:
+        indexes = (
+            (('user', 'created_at'), False), # Profile lists and fan-out-on-read (timeline.py)
+        )
 
 class Comment(BaseModel):
     content = TextField()
@@ -87,16 +132,32 @@ class Work(BaseModel):
     created_at = DateTimeField(default=datetime.utcnow)
     likes = IntegerField(default=0)
     views = IntegerField(default=0)
+    is_deleted = BooleanField(default=False) # Hidden at once on delete; rows removed by cascade.py
+
+    class Meta:
+        indexes = (
+            (('user', 'created_at'), False),
+        )
 
 class Notification(BaseModel):
     recipient = ForeignKeyField(User, backref='notifications')
-    sender = ForeignKeyField(User, backref='sent_notifications')
+    sender = ForeignKeyField(User, backref='sent_notifications') # Most recent actor
     type = CharField() # 'reply', 'like', 'system', 'follow'
     message = CharField()
     target_id = IntegerField(null=True) # Post ID or Work ID or User ID
     target_type = CharField(null=True) # 'post', 'work', 'user'
     is_read = BooleanField(default=False)
     created_at = DateTimeField(default=datetime.utcnow)
+    # Aggregation (see notifications.notify): repeated events on the same target fold into one row
+    actor_count = IntegerField(default=1)
+    recent_actor_ids = CharField(null=True) # Comma-separated user IDs, newest first
+    updated_at = DateTimeField(null=True, default=datetime.utcnow, index=True) # Last event folded in
+
+    class Meta:
+        indexes = (
+            (('recipient', 'type', 'target_type', 'target_id'), False),
+            (('recipient', 'updated_at'), False),
+        )
 
 class Follow(BaseModel):
     follower = ForeignKeyField(User, backref='following')
@@ -151,6 +212,7 @@ class BcmComment(BaseModel):
     content = TextField()
     created_at = DateTimeField(default=datetime.utcnow)
     user = ForeignKeyField(User, backref='bcm_comments')
+    is_deleted = BooleanField(default=False) # Hidden by moderation
 
 class OAuthApplication(BaseModel):
     name = CharField()
@@ -180,21 +242,42 @@ class SystemSetting(BaseModel):
     key = CharField(unique=True)
     value = TextField()
 
+class ReportTarget(BaseModel):
+    # One row per reported thing; the moderation queue pages over these (see reports.py)
+    target_type = CharField() # 'post', 'comment', 'work', 'work_comment', 'user'
+    target_id = CharField()
+    status = CharField(default="pending") # pending, resolved, rejected
+    report_count = IntegerField(default=0) # Reports since the target was last (re)opened
+    priority = IntegerField(default=0) # Higher first; see reports.priority()
+    is_visible = BooleanField(default=True) # Target still shown to users when last reported
+    first_reported_at = DateTimeField(default=datetime.utcnow)
+    last_reported_at = DateTimeField(default=datetime.utcnow)
+    resolved_at = DateTimeField(null=True)
+    resolved_by = ForeignKeyField(User, backref='+', null=True)
+
+    class Meta:
+        indexes = (
+            (('target_type', 'target_id'), True),
+            (('status', 'priority', 'id'), False), # Queue cursor
+        )
+
 class Report(BaseModel):
     reporter = ForeignKeyField(User, backref='reports')
     target_type = CharField() # 'post', 'comment', 'work', 'user'
     target_id = CharField() # ID can be string (for external) or int
     reason = TextField()
-    status = CharField(default="pending") # pending, resolved, rejected
+    status = CharField(default="pending", index=True) # pending, resolved, rejected
     created_at = DateTimeField(default=datetime.utcnow)
     resolved_at = DateTimeField(null=True)
     resolved_by = ForeignKeyField(User, backref='resolved_reports', null=True)
+    group = ForeignKeyField(ReportTarget, backref='reports', null=True) # Filled by reports.file_report()
 
 class ChatMessage(BaseModel):
     user = ForeignKeyField(User, backref='chat_messages')
     content = TextField()
     msg_type = CharField(default="text") # text, image, system
     created_at = DateTimeField(default=datetime.utcnow)
+    uid = CharField(null=True) # Assigned by chat_hub before the batched insert; dedupes cross-worker relays
     
     class Meta:
         indexes = (
@@ -225,7 +308,206 @@ class FriendRequest(BaseModel):
             (('sender', 'recipient'), True), # Unique constraint to prevent duplicate requests
         )
 
+class ConversationSummary(BaseModel):
+    # One row per (owner, peer) side of a DM thread, maintained on send/read so the
+    # inbox is an indexed read instead of a GROUP BY over DirectMessage
+    owner = ForeignKeyField(User, backref='conversations')
+    peer = ForeignKeyField(User, backref='+')
+    last_message = ForeignKeyField(DirectMessage, null=True, backref='+')
+    last_sender = ForeignKeyField(User, null=True, backref='+')
+    last_preview = CharField(default="")
+    unread_count = IntegerField(default=0)
+    updated_at = DateTimeField(default=datetime.utcnow)
+    peer_read_up_to = IntegerField(null=True) # Last of the owner's messages the peer has read
+    read_seq = IntegerField(null=True) # Global, bumped per read receipt; the relay's watermark
+
+    class Meta:
+        indexes = (
+            (('owner', 'peer'), True),
+            (('owner', 'updated_at'), False),
+            (('read_seq',), False),
+        )
+
+class TimelineEntry(BaseModel):
+    # Home timeline rows pushed at write time (see timeline.py), capped per owner
+    owner = ForeignKeyField(User, backref='+')
+    author = ForeignKeyField(User, backref='+')
+    item_type = CharField() # 'post', 'work'
+    item_id = IntegerField() # Post.id or Work.work_id
+    created_at = DateTimeField() # The item's creation time, used as the feed cursor
+
+    class Meta:
+        indexes = (
+            (('owner', 'item_type', 'item_id'), True),
+            (('owner', 'created_at'), False),
+            (('owner', 'author'), False),
+            (('item_type', 'item_id'), False),
+        )
+
+class Job(BaseModel):
+    # Durable background job queue (see jobs.py)
+    queue = CharField(default="default")
+    name = CharField() # Registered task name
+    payload = TextField(default="{}") # JSON kwargs for the task
+    priority = IntegerField(default=0) # Higher runs first
+    status = CharField(default="queued") # queued, running, done, failed
+    attempts = IntegerField(default=0)
+    max_attempts = IntegerField(default=5)
+    run_at = DateTimeField(default=datetime.utcnow) # Not before; pushed back on retry
+    locked_by = CharField(null=True) # Worker holding the lease
+    locked_until = DateTimeField(null=True) # Lease expiry; expired running jobs are requeued
+    last_error = TextField(null=True)
+    dedupe_key = CharField(null=True, unique=True) # e.g. one row per cron slot
+    created_at = DateTimeField(default=datetime.utcnow)
+    started_at = DateTimeField(null=True)
+    finished_at = DateTimeField(null=True)
+
+    class Meta:
+        indexes = (
+            (('queue', 'status', 'priority', 'run_at'), False), # Claim order
+            (('status', 'locked_until'), False), # Lease reaper
+        )
+
+class Deletion(BaseModel):
+    # Progress of a chunked background cascade delete (see cascade.py)
+    target_type = CharField() # 'post', 'work', 'user'
+    target_id = IntegerField() # Post.id, Work.work_id or User.id
+    requested_by = ForeignKeyField(User, backref='+', null=True)
+    status = CharField(default="pending") # pending, running, done, failed
+    step = IntegerField(default=0) # Index of the current cascade step
+    removed = TextField(default="{}") # JSON {step name: rows removed so far}
+    created_at = DateTimeField(default=datetime.utcnow)
+    updated_at = DateTimeField(default=datetime.utcnow)
+    finished_at = DateTimeField(null=True)
+
+    class Meta:
+        indexes = (
+            (('target_type', 'target_id'), False),
+        )
+
+class ModerationAction(BaseModel):
+    # Bulk ban + hide of a user's content, run in the background (see moderation.py)
+    user = ForeignKeyField(User, backref='+')
+    admin = ForeignKeyField(User, backref='+')
+    reason = TextField(null=True)
+    since = DateTimeField(null=True) # Only content created at or after this; null = everything
+    status = CharField(default="pending") # pending, running, done, failed, undoing, undone
+    step = IntegerField(default=0)
+    counts = TextField(default="{}") # JSON {step name: rows hidden}
+    was_banned = BooleanField(default=False) # Ban state before the action, restored by undo
+    previous_ban_reason = TextField(null=True)
+    created_at = DateTimeField(default=datetime.utcnow)
+    updated_at = DateTimeField(default=datetime.utcnow)
+    finished_at = DateTimeField(null=True)
+
+class ModerationLog(BaseModel):
+    # Undo log: one row per record a ModerationAction hid or removed
+    action = ForeignKeyField(ModerationAction, backref='log')
+    kind = CharField() # Step name, e.g. 'posts', 'notifications'
+    row_id = IntegerField()
+    data = TextField(null=True) # Full row as JSON for removed rows, so undo can re-insert it
+
+    class Meta:
+        indexes = (
+            (('action', 'kind', 'row_id'), True),
+        )
+
+class StatCounter(BaseModel):
+    # Pre-aggregated analytics counters (see analytics.py)
+    metric = CharField() # e.g. 'posts', 'comments', 'signups', 'active_users'
+    bucket = CharField() # 'hour' or 'day'
+    period_start = DateTimeField() # UTC start of the hour/day
+    dimension = CharField(default="") # Optional breakdown, e.g. category id for posts
+    value = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('metric', 'bucket', 'period_start', 'dimension'), True),
+        )
+
+class ActiveUserDay(BaseModel):
+    # One row per user per day they made an authenticated request; feeds the DAU counter
+    day = DateTimeField()
+    user = ForeignKeyField(User, backref='+')
+
+    class Meta:
+        indexes = (
+            (('day', 'user'), True),
+        )
+
+ALL_MODELS = [User, Category, Post, Comment, PostLike, CommentLike, Work, Notification, Follow, WorkComment, WorkLike, WorkCommentLike, Banner, BcmComment, OAuthApplication, OAuthCode, Announcement, SystemSetting, ReportTarget, Report, ChatMessage, DirectMessage, FriendRequest, ConversationSummary, TimelineEntry, Job, Deletion, ModerationAction, ModerationLog, StatCounter, ActiveUserDay]
+
+def migrate_columns(models):
+    # create_tables() never alters existing tables, so add any columns
+    # introduced after a database was first created. New fields must be
+    # nullable or have a default for this to work on populated tables.
+    from playhouse.migrate import SqliteMigrator, migrate
+    migrator = SqliteMigrator(db)
+    operations = []
+    tables = set(db.get_tables())
+    for model in models:
+        table = model._meta.table_name
+        if table not in tables:
+            continue  # created from scratch by create_tables()
+        existing = {c.name for c in db.get_columns(table)}
+        for field in model._meta.sorted_fields:
+            if field.column_name not in existing:
+                operations.append(migrator.add_column(table, field.column_name, field))
+    if operations:
+        migrate(*operations)
+
+def schema_fingerprint(models) -> int:
+    """31-bit hash of every table/column/index definition, stored in PRAGMA user_version."""
+    parts = []
+    for model in models:
+        parts.append(model._meta.table_name)
+        for field in model._meta.sorted_fields:
+            parts.append(f"{field.column_name}:{field.field_type}:{field.null}:{field.index}:{field.unique}")
+        parts.append(repr(model._meta.indexes))
+    digest = hashlib.sha1("|".join(parts).encode()).digest()
+    return int.from_bytes(digest[:4], "big") & 0x7FFFFFFF
+
 def create_tables():
+    fingerprint = schema_fingerprint(ALL_MODELS)
     with db:
+        # Skip per-table introspection on restarts when the models haven't changed
+        if db.execute_sql("PRAGMA user_version").fetchone()[0] == fingerprint:
+            return
+        # Add new columns first: create_tables() also creates any new indexes,
+        # which may reference those columns
+        migrate_columns(ALL_MODELS)
         # Review removed from list
-        db.create_tables([User, Category, Post, Comment, PostLike, CommentLike, Work, Notification, Follow, WorkComment, WorkLike, WorkCommentLike, Banner, BcmComment, OAuthApplication, OAuthCode, Announcement, SystemSetting, Report, ChatMessage, DirectMessage, FriendRequest])
+        db.create_tables(ALL_MODELS)
+        db.execute_sql(f"PRAGMA user_version = {fingerprint}")
+
+def setup_database():
+    """Creates/migrates tables and seeds defaults. Run once per deployment start (see serve.py)."""
+    create_tables()
+
+    # Set user with ID 1 as admin
+    try:
+        user_1 = User.get_or_none(User.id == 1)
+        if user_1 and not user_1.is_admin:
+            user_1.is_admin = True
+            user_1.save()
+            print(f"Set user ID 1 ({user_1.username}) as admin")
+    except Exception as e:
+        print(f"Could not set user ID 1 as admin: {e}")
+
+    # Rows from before aggregation have no updated_at; inbox ordering uses it
+    Notification.update(updated_at=Notification.created_at).where(Notification.updated_at.is_null()).execute()
+
+    # Reports from before the moderation queue aren't grouped yet
+    from reports import backfill_targets
+    backfill_targets()
+
+    # Init Categories
+    if Category.select().count() == 0:
+        categories = [
+            {"name": "General Discussion", "slug": "general"},
+            {"name": "Help & Support", "slug": "help"},
+            {"name": "Showcase", "slug": "showcase"},
+            {"name": "Tutorials", "slug": "tutorials"}
+        ]
+        for cat in categories:
+            Category.create(**cat)
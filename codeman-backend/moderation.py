@@ -0,0 +1,181 @@
+"""
+Bulk moderation: ban a user and hide everything they posted since a date.
+
+start() bans the user at once and enqueues a "moderation.run" job (jobs.py)
+on the single-slot "moderation" queue. The job works through STEPS in
+chunks of CHUNK rows. Each chunk is one short transaction that hides the
+rows and writes matching ModerationLog entries. Between chunks the job
+sleeps for PAUSE seconds, so request traffic always gets the write lock
+quickly. Progress (step and counts) is saved on the ModerationAction after
+every chunk.
+
+Hiding sets is_deleted on posts, comments, work comments and BcmComments.
+Rows the user had already deleted are skipped, so undo doesn't resurrect
+them. Notifications the user sent are removed, and their full row is kept
+in the log. Aggregated rows that other people also contributed to are left
+alone.
+
+undo() runs the log backwards the same chunked way. It clears the flags,
+re-inserts removed notifications and restores the user's previous ban
+state.
+"""
+import json
+import time
+from datetime import datetime
+from typing import Optional
+
+import entity_cache
+import jobs
+from models import (db, BcmComment, Comment, ModerationAction, ModerationLog, Notification, Post, User,
+                    WorkComment)
+
+CHUNK = 200
+PAUSE = 0.1
+
+class HideStep:
+    """Flags a user's rows as is_deleted."""
+
+    def __init__(self, name: str, model, cached: bool = False):
+        self.name = name
+        self.model = model
+        self.cached = cached # Rows live in entity_cache and need invalidating
+
+    def pending(self, action: ModerationAction):
+        model = self.model
+        query = model.select(model.id).where(
+            (model.user == action.user_id) & ((model.is_deleted == False) | model.is_deleted.is_null()))
+        if action.since is not None:
+            query = query.where(model.created_at >= action.since)
+        return query
+
+    def apply(self, action: ModerationAction, ids: list) -> None:
+        self.model.update(is_deleted=True).where(self.model.id.in_(ids)).execute()
+        ModerationLog.insert_many([{"action": action.id, "kind": self.name, "row_id": i} for i in ids]) \
+                     .on_conflict_ignore().execute()
+        if self.cached:
+            entity_cache.publish(self.model, *ids)
+
+    def revert(self, entries: list) -> None:
+        ids = [e.row_id for e in entries]
+        self.model.update(is_deleted=False).where(self.model.id.in_(ids)).execute()
+        if self.cached:
+            entity_cache.publish(self.model, *ids)
+
+class RemoveNotificationsStep:
+    """Deletes notifications the user sent, keeping each row in the log."""
+
+    name = "notifications"
+
+    def pending(self, action: ModerationAction):
+        query = Notification.select(Notification.id).where(
+            (Notification.sender == action.user_id) & (Notification.actor_count <= 1))
+        if action.since is not None:
+            query = query.where(Notification.created_at >= action.since)
+        return query
+
+    def apply(self, action: ModerationAction, ids: list) -> None:
+        rows = list(Notification.select().where(Notification.id.in_(ids)).dicts())
+        ModerationLog.insert_many([{"action": action.id, "kind": self.name, "row_id": r["id"],
+                                    "data": json.dumps(r, default=str)} for r in rows]) \
+                     .on_conflict_ignore().execute()
+        Notification.delete().where(Notification.id.in_(ids)).execute()
+
+    def revert(self, entries: list) -> None:
+        rows = []
+        for e in entries:
+            row = json.loads(e.data)
+            for key in ("created_at", "updated_at"):
+                if row.get(key):
+                    row[key] = datetime.fromisoformat(row[key])
+            rows.append(row)
+        if rows:
+            Notification.insert_many(rows).on_conflict_ignore().execute()
+
+STEPS = [
+    HideStep("posts", Post, cached=True),
+    HideStep("comments", Comment),
+    HideStep("work_comments", WorkComment),
+    HideStep("bcm_comments", BcmComment),
+    RemoveNotificationsStep(),
+]
+STEP_BY_NAME = {s.name: s for s in STEPS}
+
+def start(user: User, admin: User, reason: Optional[str] = None, since: Optional[datetime] = None) -> ModerationAction:
+    with db.atomic():
+        action = ModerationAction.create(user=user.id, admin=admin.id, reason=reason, since=since,
+                                         was_banned=bool(user.is_banned), previous_ban_reason=user.ban_reason)
+        user.is_banned = True
+        user.ban_reason = reason or "Banned by moderation"
+        user.save()
+        entity_cache.publish(User, user.id)
+        jobs.enqueue("moderation.run", {"action_id": action.id})
+    return action
+
+def _save(action_id: int, **fields) -> None:
+    fields["updated_at"] = datetime.utcnow()
+    ModerationAction.update(**fields).where(ModerationAction.id == action_id).execute()
+
+def run(action_id: int) -> None:
+    action = ModerationAction.get_or_none(ModerationAction.id == action_id)
+    if action is None or action.status not in ("pending", "running", "failed"):
+        return
+    counts = json.loads(action.counts or "{}")
+    _save(action_id, status="running")
+    try:
+        for index in range(action.step, len(STEPS)):
+            step = STEPS[index]
+            while True:
+                with db.atomic():
+                    ids = [i for (i,) in step.pending(action).limit(CHUNK).tuples()]
+                    if ids:
+                        step.apply(action, ids)
+                counts[step.name] = counts.get(step.name, 0) + len(ids)
+                _save(action_id, step=index if len(ids) == CHUNK else index + 1, counts=json.dumps(counts))
+                if len(ids) < CHUNK:
+                    break
+                time.sleep(PAUSE)
+    except Exception:
+        _save(action_id, status="failed")
+        raise
+    _save(action_id, status="done", finished_at=datetime.utcnow())
+
+def undo(action_id: int) -> None:
+    action = ModerationAction.get_or_none(ModerationAction.id == action_id)
+    if action is None or action.status == "undone":
+        return
+    _save(action_id, status="undoing")
+    for step in STEPS:
+        while True:
+            with db.atomic():
+                entries = list(ModerationLog.select()
+                               .where((ModerationLog.action == action_id) & (ModerationLog.kind == step.name))
+                               .limit(CHUNK))
+                if entries:
+                    step.revert(entries)
+                    ModerationLog.delete().where(ModerationLog.id.in_([e.id for e in entries])).execute()
+            if len(entries) < CHUNK:
+                break
+            time.sleep(PAUSE)
+    user = User.get_by_id(action.user_id)
+    user.is_banned = action.was_banned
+    user.ban_reason = action.previous_ban_reason
+    user.save()
+    entity_cache.publish(User, user.id)
+    _save(action_id, status="undone", finished_at=datetime.utcnow())
+
+def progress(action: ModerationAction) -> dict:
+    return {
+        "id": action.id,
+        "user_id": action.user_id,
+        "admin_id": action.admin_id,
+        "reason": action.reason,
+        "since": action.since,
+        "status": action.status,
+        "step": STEPS[action.step].name if action.step < len(STEPS) and action.status in ("pending", "running") else None,
+        "steps_done": min(action.step, len(STEPS)),
+        "steps_total": len(STEPS),
+        "counts": json.loads(action.counts or "{}"),
+        "created_at": action.created_at,
+        "updated_at": action.updated_at,
+        "finished_at": action.finished_at
+    }
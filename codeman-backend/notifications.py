@@ -0,0 +1,407 @@
+"""
+Notification writes (notify) and the in-process pub/sub hub for real-time delivery.
+
+notify() folds repeated events of the same (recipient, type, target) that
+happen while the previous row is still unread and less than
+AGGREGATION_WINDOW old. They fold into one row with an actor count and the
+last few actors, so 1,000 likes on a post become one "X and 999 others"
+row rather than 1,000 rows.
+
+Every Notification save() publishes through models.on_model_write:
+  * a new or updated unread row -> {"type": "notification", "item": {...}, "unread_delta": 0|1}
+    (1 only for a brand-new row; folded updates replace the existing item client-side)
+  * a notification marked read   -> {"type": "read", "ids": [id], "unread_delta": -1}
+Bulk Notification.update() queries bypass the hook and must call
+publish() themselves (see mark_all_read in main.py).
+
+Subscribers are the /api/ws/notifications sockets and long-poll requests.
+They each hold an asyncio.Queue on their own event loop. publish() may be
+called from threadpool handlers, so it hands events over with
+call_soon_threadsafe.
+
+Each worker process has its own hub. relay_loop() makes rows written by
+other workers visible: about once a second it fetches rows updated since
+the last updated_at it has seen (minus RELAY_OVERLAP), for users with a
+live subscriber only. That is two indexed queries per worker, however many
+tabs are open. Direct messages and their read receipts are relayed the same
+way, past an id watermark on DirectMessage and a read_seq watermark on
+ConversationSummary (see _relay_direct_messages).
+"""
+import asyncio
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+
+from peewee import fn
+
+from models import db, ConversationSummary, DirectMessage, Notification, User, on_model_write
+from serializers import serialize_direct_message, serialize_notification, user_brief
+
+RELAY_INTERVAL = 1.0
+RELAY_OVERLAP = timedelta(seconds=10) # > SQLite busy_timeout, the longest a stamped row can wait to commit
+QUEUE_SIZE = 100
+WRITE_INTERVAL = 0.2
+WRITE_BATCH = 500
+
+AGGREGATED_TYPES = {"like", "comment", "reply", "mention", "follow"}
+AGGREGATION_WINDOW = timedelta(hours=24)
+RECENT_ACTORS = 3
+
+def _id(value) -> int:
+    return value.id if isinstance(value, User) else value
+
+def actor_ids(notification) -> list:
+    if not notification.recent_actor_ids:
+        return [notification.sender_id]
+    return [int(x) for x in notification.recent_actor_ids.split(",") if x]
+
+def _fold_key(recipient_id: int, type: str, target_type: Optional[str], target_id: Optional[int]) -> tuple:
+    # Follows fold per recipient regardless of target, since each follow
+    # targets the follower's own profile
+    return (recipient_id, type) if type == "follow" else (recipient_id, type, target_type, target_id)
+
+def _fold(existing, sender_id: int, message: str, target_id: Optional[int], target_type: Optional[str],
+          now: datetime) -> bool:
+    """Folds one more actor into an open row. False if there's nothing new to show."""
+    actors = actor_ids(existing)
+    if actors[0] == sender_id:
+        return False  # same actor again (e.g. like/unlike/like)
+    if sender_id not in actors:
+        existing.actor_count += 1
+    actors = [sender_id] + [a for a in actors if a != sender_id]
+    existing.recent_actor_ids = ",".join(str(a) for a in actors[:RECENT_ACTORS])
+    existing.sender = sender_id
+    existing.message = message
+    existing.target_id = target_id
+    existing.target_type = target_type
+    existing.updated_at = now
+    return True
+
+def notify(recipient, sender, type: str, message: str, target_id: Optional[int] = None,
+           target_type: Optional[str] = None) -> Notification:
+    """
+    Records a notification, folding it into a recent unread row for the same
+    recipient/type/target when there is one.
+    """
+    recipient_id, sender_id = _id(recipient), _id(sender)
+    if type not in AGGREGATED_TYPES:
+        return Notification.create(recipient=recipient_id, sender=sender_id, type=type, message=message,
+                                   target_id=target_id, target_type=target_type,
+                                   recent_actor_ids=str(sender_id))
+
+    # IMMEDIATE takes the write lock up front so two workers can't both read
+    # actor_count = N and write N + 1
+    with db.atomic("IMMEDIATE"):
+        now = datetime.utcnow()  # under the lock, so updated_at follows commit order
+        query = Notification.select().where(
+            (Notification.recipient == recipient_id) &
+            (Notification.type == type) &
+            (Notification.is_read == False) &
+            (Notification.updated_at >= now - AGGREGATION_WINDOW))
+        if type != "follow":
+            query = query.where((Notification.target_type == target_type) & (Notification.target_id == target_id))
+        existing = query.order_by(Notification.updated_at.desc()).first()
+
+        if existing is None:
+            return Notification.create(recipient=recipient_id, sender=sender_id, type=type, message=message,
+                                       target_id=target_id, target_type=target_type,
+                                       recent_actor_ids=str(sender_id), created_at=now, updated_at=now)
+        if _fold(existing, sender_id, message, target_id, target_type, now):
+            existing.save()
+        return existing
+
+def event(recipient, sender, type: str, message: str, target_id: Optional[int] = None,
+          target_type: Optional[str] = None) -> dict:
+    """A notify() call packed up for NotificationWriter.submit()."""
+    return {"recipient": _id(recipient), "sender": _id(sender), "type": type, "message": message,
+            "target_id": target_id, "target_type": target_type}
+
+def write_batch(events: List[dict]) -> List[Notification]:
+    """
+    Writes many events with notify() semantics in one transaction:
+    one SELECT for the open rows they may fold into, one insert_many for the
+    new rows and one bulk_update for the folded ones. Returns the rows written.
+    """
+    if not events:
+        return []
+    with db.atomic("IMMEDIATE"):
+        now = datetime.utcnow()
+        open_rows = {}
+        foldable = [e for e in events if e["type"] in AGGREGATED_TYPES]
+        if foldable:
+            candidates = (Notification.select().where(
+                (Notification.recipient.in_(list({e["recipient"] for e in foldable}))) &
+                (Notification.type.in_(list({e["type"] for e in foldable}))) &
+                (Notification.is_read == False) &
+                (Notification.updated_at >= now - AGGREGATION_WINDOW))
+                .order_by(Notification.updated_at))
+            for n in candidates:
+                open_rows[_fold_key(n.recipient_id, n.type, n.target_type, n.target_id)] = n  # newest wins
+
+        new_rows, changed = [], {}
+        for e in events:
+            key = _fold_key(e["recipient"], e["type"], e["target_type"], e["target_id"])
+            existing = open_rows.get(key) if e["type"] in AGGREGATED_TYPES else None
+            if existing is None:
+                row = Notification(recipient=e["recipient"], sender=e["sender"], type=e["type"], message=e["message"],
+                                   target_id=e["target_id"], target_type=e["target_type"],
+                                   recent_actor_ids=str(e["sender"]), created_at=now, updated_at=now)
+                new_rows.append(row)
+                if e["type"] in AGGREGATED_TYPES:
+                    open_rows[key] = row  # later events in this batch fold into it
+            elif _fold(existing, e["sender"], e["message"], e["target_id"], e["target_type"], now) and existing.id:
+                changed[existing.id] = existing
+
+        if new_rows:
+            inserted = (Notification.insert_many([dict(r.__data__) for r in new_rows])
+                        .returning(Notification.id).tuples().execute())
+            for row, (row_id,) in zip(new_rows, inserted):
+                row.id = row_id
+        if changed:
+            Notification.bulk_update(list(changed.values()), fields=[
+                Notification.actor_count, Notification.recent_actor_ids, Notification.sender,
+                Notification.message, Notification.target_id, Notification.target_type, Notification.updated_at])
+    return new_rows + list(changed.values())
+
+def load_actors(rows: Iterable) -> Dict[int, User]:
+    """Fetches every recent actor of the given rows in one query."""
+    ids = {a for n in rows for a in actor_ids(n)}
+    if not ids:
+        return {}
+    return {u.id: u for u in User.select(User.id, User.codemao_id, User.username, User.avatar_url,
+                                          User.description, User.is_admin).where(User.id.in_(list(ids)))}
+
+def render(rows: list) -> list:
+    actors = load_actors(rows)
+    result = []
+    for n in rows:
+        recent = [actors[a] for a in actor_ids(n) if a in actors]
+        result.append(serialize_notification(n, n.sender, recent))
+    return result
+
+class Subscription:
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    def _put(self, event: dict) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Slow consumer: drop the backlog and tell it to refetch
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({"type": "resync"})
+
+    def deliver(self, event: dict) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            pass  # loop already closed
+
+class NotificationHub:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: Dict[int, Set[Subscription]] = {}
+        # (id, updated_at) versions already delivered locally, so the relay doesn't send them twice
+        self._recent_ids = deque(maxlen=2048)
+        self._recent_set: Set[tuple] = set()
+        self.last_relayed_at: Optional[datetime] = None
+        self.last_dm_id: Optional[int] = None
+        self.last_read_seq: Optional[int] = None
+
+    def subscribe(self, user_id: int) -> Subscription:
+        sub = Subscription(user_id)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            subs = self._subscribers.get(sub.user_id)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.user_id]
+
+    def subscribed_users(self) -> list:
+        with self._lock:
+            return list(self._subscribers)
+
+    def publish(self, user_id: int, event: dict) -> None:
+        with self._lock:
+            subs = list(self._subscribers.get(user_id, ()))
+        for sub in subs:
+            sub.deliver(event)
+
+    def mark_delivered(self, version: tuple) -> bool:
+        """Records a row version as delivered; False if it already was."""
+        with self._lock:
+            if version in self._recent_set:
+                return False
+            if len(self._recent_ids) == self._recent_ids.maxlen:
+                self._recent_set.discard(self._recent_ids[0])
+            self._recent_ids.append(version)
+            self._recent_set.add(version)
+            return True
+
+    def publish_new(self, notification) -> None:
+        if not self.mark_delivered((notification.id, notification.updated_at)):
+            return
+        if notification.recipient_id not in self.subscribed_users():
+            return
+        item = render([notification])[0]
+        self.publish(notification.recipient_id, {
+            "type": "notification",
+            "item": item,
+            "unread_delta": 1 if notification.actor_count == 1 else 0
+        })
+
+    def publish_dm(self, message, sender) -> None:
+        if not self.mark_delivered(("dm", message.id)):
+            return
+        self.publish(message.recipient_id, {"type": "dm", "peer": user_brief(sender),
+                                            "message": serialize_direct_message(message)})
+
+    def publish_dm_read(self, user_id: int, peer_id: int, up_to_id: int, seq: int) -> None:
+        """Tells user_id that peer_id has read their messages up to up_to_id."""
+        if not self.mark_delivered(("dm_read", seq)):
+            return
+        self.publish(user_id, {"type": "dm_read", "peer_id": peer_id, "up_to_id": up_to_id})
+
+hub = NotificationHub()
+
+def unread_count(user_id: int) -> int:
+    return (Notification.select()
+            .where((Notification.recipient == user_id) & (Notification.is_read == False))
+            .count())
+
+@on_model_write
+def _publish_on_write(instance, deleted: bool) -> None:
+    if deleted or not isinstance(instance, Notification):
+        return
+    if instance.is_read:
+        hub.publish(instance.recipient_id, {"type": "read", "ids": [instance.id], "unread_delta": -1})
+    else:
+        hub.publish_new(instance)
+
+def _relay_once() -> None:
+    users = hub.subscribed_users()
+    latest = (Notification.select(Notification.updated_at)
+              .order_by(Notification.updated_at.desc()).limit(1).scalar())
+    if hub.last_relayed_at is None or not users or latest is None:
+        hub.last_relayed_at = latest or datetime.utcnow()
+        return
+    # Rescan RELAY_OVERLAP back: a row stamped before it waited for the write
+    # lock commits with an updated_at older than rows already relayed.
+    # publish_new() skips versions this worker has delivered.
+    rows = (Notification.select(Notification, User)
+            .join(User, on=(Notification.sender == User.id))
+            .where((Notification.updated_at > hub.last_relayed_at - RELAY_OVERLAP) &
+                   (Notification.updated_at <= latest) &
+                   (Notification.recipient.in_(users)) & (Notification.is_read == False))
+            .order_by(Notification.updated_at))
+    for n in rows:
+        hub.publish_new(n)
+    hub.last_relayed_at = latest
+
+def _relay_direct_messages() -> None:
+    """
+    DMs and read receipts from other workers. Both watermarks follow commit
+    order: DirectMessage ids are assigned on insert, and read_seq is taken
+    under the IMMEDIATE lock in mark_thread_read.
+    """
+    users = hub.subscribed_users()
+    latest_dm = DirectMessage.select(fn.MAX(DirectMessage.id)).scalar() or 0
+    latest_seq = ConversationSummary.select(fn.MAX(ConversationSummary.read_seq)).scalar() or 0
+    if hub.last_dm_id is not None and users and latest_dm > hub.last_dm_id:
+        rows = (DirectMessage.select(DirectMessage, User)
+                .join(User, on=(DirectMessage.sender == User.id))
+                .where((DirectMessage.id > hub.last_dm_id) & (DirectMessage.id <= latest_dm) &
+                       (DirectMessage.recipient.in_(users)))
+                .order_by(DirectMessage.id))
+        for m in rows:
+            hub.publish_dm(m, m.sender)
+    if hub.last_read_seq is not None and users and latest_seq > hub.last_read_seq:
+        receipts = (ConversationSummary.select()
+                    .where((ConversationSummary.read_seq > hub.last_read_seq) &
+                           (ConversationSummary.read_seq <= latest_seq) & (ConversationSummary.owner.in_(users)))
+                    .order_by(ConversationSummary.read_seq))
+        for r in receipts:
+            hub.publish_dm_read(r.owner_id, r.peer_id, r.peer_read_up_to, r.read_seq)
+    hub.last_dm_id, hub.last_read_seq = latest_dm, latest_seq
+
+async def relay_loop() -> None:
+    while True:
+        try:
+            await asyncio.to_thread(_relay_once)
+            await asyncio.to_thread(_relay_direct_messages)
+        except Exception as e:
+            print(f"Notification relay error: {e}")
+        await asyncio.sleep(RELAY_INTERVAL)
+
+class NotificationWriter:
+    """
+    Background writer for notification events. Handlers submit() the events
+    of one action (a comment's reply and mention notifications, say) and
+    return straight away. write_loop() writes everything pending across
+    requests with write_batch() every WRITE_INTERVAL seconds, or sooner once
+    WRITE_BATCH events are waiting. Bulk writes skip the on_model_write hook,
+    so the writer publishes the rows itself.
+    Outside a running app (scripts, setup) submit() writes synchronously.
+    """
+
+    def __init__(self):
+        self._pending: List[dict] = []
+        self._lock = threading.Lock()
+        self._wake: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def submit(self, events: List[dict]) -> None:
+        if not events:
+            return
+        if self._wake is None:
+            self._write(events)
+            return
+        with self._lock:
+            self._pending.extend(events)
+            pending = len(self._pending)
+        if pending >= WRITE_BATCH:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def _write(self, events: List[dict]) -> None:
+        for row in write_batch(events):
+            hub.publish_new(row)
+
+    def flush(self) -> int:
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return 0
+        try:
+            self._write(batch)
+        except Exception as e:
+            print(f"Notification write error: {e}")
+            with self._lock:
+                self._pending = batch + self._pending  # retry on the next tick
+            return 0
+        return len(batch)
+
+    async def write_loop(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=WRITE_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+                await asyncio.to_thread(self.flush)
+        finally:
+            self._wake = None
+            self.flush()
+
+writer = NotificationWriter()
@@ -0,0 +1,55 @@
+"""
+Re-render stored post HTML/excerpts for posts written before render-at-write,
+or after RENDER_VERSION has been bumped.
+
+    python render_backfill.py [--workers N] [--batch 200] [--force]
+
+Rendering runs in a process pool; all DB writes happen in this process.
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from models import db, Post, create_tables
+from rendering import RENDER_VERSION, render_post_fields
+
+def _render_batch(rows):
+    # Runs in a worker process: pure CPU, no DB access
+    return [(post_id, render_post_fields(content)) for post_id, content in rows]
+
+def backfill(workers: int = None, batch_size: int = 200, force: bool = False) -> int:
+    query = Post.select(Post.id, Post.content).order_by(Post.id)
+    if not force:
+        query = query.where((Post.render_version != RENDER_VERSION) | (Post.content_html.is_null()))
+
+    batches = []
+    current = []
+    for post_id, content in query.tuples().iterator():
+        current.append((post_id, content))
+        if len(current) >= batch_size:
+            batches.append(current)
+            current = []
+    if current:
+        batches.append(current)
+
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for rendered in pool.map(_render_batch, batches):
+            with db.atomic():
+                for post_id, fields in rendered:
+                    Post.update(**fields).where(Post.id == post_id).execute()
+            done += len(rendered)
+            print(f"Rendered {done} posts")
+    return done
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill rendered post HTML and excerpts")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--batch", type=int, default=200)
+    parser.add_argument("--force", action="store_true", help="Re-render every post, not just stale ones")
+    args = parser.parse_args()
+
+    db.connect(reuse_if_open=True)
+    create_tables()
+    total = backfill(workers=args.workers, batch_size=args.batch, force=args.force)
+    print(f"Done. {total} posts rendered at version {RENDER_VERSION}.")
@@ -0,0 +1,84 @@
+import html
+import re
+
+# markdown and bleach (which pulls in html5lib) are imported on first render, not at startup
+
+# Bump this whenever the markdown extensions or sanitizer rules change.
+# Posts whose render_version is older get re-rendered on read and by render_backfill.py.
+RENDER_VERSION = 1
+
+EXCERPT_LENGTH = 200
+
+# Block elements markdown produces; bleach's default tags are added on first render
+MARKDOWN_TAGS = frozenset([
+    'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'br', 'pre', 'img', 'hr',
+    'table', 'thead', 'tbody', 'tr', 'th', 'td', 'div', 'span'
+])
+ALLOWED_ATTRS = {
+    '*': ['class'],
+    'img': ['src', 'alt', 'title', 'width', 'height'],
+    'a': ['href', 'title', 'target']
+}
+
+_allowed_tags = None
+
+def allowed_tags() -> frozenset:
+    global _allowed_tags
+    if _allowed_tags is None:
+        import bleach
+        _allowed_tags = frozenset(bleach.sanitizer.ALLOWED_TAGS) | MARKDOWN_TAGS
+    return _allowed_tags
+
+def render_markdown(content: str) -> str:
+    """Converts post markdown to sanitized HTML. [work:ID] tags are left as text and expanded on read."""
+    import bleach
+    import markdown
+    html_content = markdown.markdown(content or "", extensions=['fenced_code', 'tables'])
+    return bleach.clean(html_content, tags=allowed_tags(), attributes=ALLOWED_ATTRS)
+
+def make_excerpt(clean_html: str, length: int = EXCERPT_LENGTH) -> str:
+    """Builds a single-line plain-text excerpt from rendered HTML."""
+    import bleach
+    text = html.unescape(bleach.clean(clean_html, tags=[], strip=True))
+    text = re.sub(r'\s+', ' ', text).strip()
+    if len(text) > length:
+        return text[:length].rstrip() + "..."
+    return text
+
+def render_post_fields(content: str) -> dict:
+    """Returns the stored render columns for a Post with the given markdown."""
+    clean_html = render_markdown(content)
+    return {
+        "content_html": clean_html,
+        "excerpt": make_excerpt(clean_html),
+        "render_version": RENDER_VERSION
+    }
+
+def ensure_rendered(post) -> None:
+    """Renders a post in place if its stored output is missing or from an older pipeline."""
+    if post.render_version == RENDER_VERSION:
+        return
+    fields = render_post_fields(post.content)
+    for key, value in fields.items():
+        setattr(post, key, value)
+    # Save only the render columns so we don't clobber concurrent view/like counters
+    post.save(only=list(fields))
+
+def ensure_rendered_many(posts) -> None:
+    """
+    Batch variant for projected list queries that only selected id/excerpt/render_version:
+    loads the markdown for stale rows in one query and renders them.
+    """
+    stale = {p.id: p for p in posts if p.render_version != RENDER_VERSION}
+    if not stale:
+        return
+    model = type(next(iter(stale.values())))
+    # Read everything before writing: saving while the SELECT is still open upgrades its
+    # read snapshot, which SQLite refuses outright if another connection wrote meanwhile
+    rows = list(model.select(model.id, model.content).where(model.id.in_(list(stale))).tuples())
+    for post_id, content in rows:
+        post = stale[post_id]
+        fields = render_post_fields(content)
+        for key, value in fields.items():
+            setattr(post, key, value)
+        post.save(only=list(fields))
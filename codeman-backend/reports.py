@@ -0,0 +1,171 @@
+"""
+Report intake and the admin moderation queue.
+
+Every Report belongs to a ReportTarget, one row per reported thing. The
+queue lists targets rather than reports, so 500 reports of one spam post
+are one entry with report_count = 500.
+
+Targets are ordered by a stored integer priority, which is recomputed
+whenever the target is reported:
+
+    hours since epoch of the last report
+    + REPORT_WEIGHT hours per report (up to MAX_COUNTED)
+    + VISIBLE_BONUS hours if the target is still visible
+
+So a fresh report ranks like a recent one, every extra report is worth a
+day of recency, and content that has already been hidden sinks. Because
+priority is stored, the queue is one range scan of the
+(status, priority, id) index, keyset-paginated with ?cursor=priority:id.
+The cost per page is the same with 100 or 500,000 reports.
+
+A new report on a resolved or rejected target reopens it with a fresh count.
+"""
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from peewee import fn
+
+from models import db, Comment, Post, Report, ReportTarget, User, Work, WorkComment
+
+REPORT_WEIGHT = 24
+MAX_COUNTED = 50
+VISIBLE_BONUS = 72
+RECENT_REASONS = 3
+
+def priority(report_count: int, last_reported_at: datetime, is_visible: bool) -> int:
+    hours = int(last_reported_at.timestamp() // 3600)
+    return hours + REPORT_WEIGHT * min(report_count, MAX_COUNTED) + (VISIBLE_BONUS if is_visible else 0)
+
+def target_visible(target_type: str, target_id: str) -> bool:
+    try:
+        key = int(target_id)
+    except (TypeError, ValueError):
+        return True
+    if target_type == "post":
+        query = Post.select().where((Post.id == key) & (Post.is_deleted == False))
+    elif target_type == "comment":
+        query = Comment.select().where((Comment.id == key) & ((Comment.is_deleted == False) | Comment.is_deleted.is_null()))
+    elif target_type == "work":
+        query = Work.select().where((Work.work_id == key) & (Work.is_deleted == False))
+    elif target_type == "work_comment":
+        query = WorkComment.select().where((WorkComment.id == key) & (WorkComment.is_deleted == False))
+    elif target_type == "user":
+        query = User.select().where((User.id == key) & (User.is_banned == False))
+    else:
+        return True
+    return query.exists()
+
+def file_report(reporter, target_type: str, target_id: str, reason: str) -> Report:
+    """Creates a report and bumps its target's count and priority."""
+    now = datetime.utcnow()
+    target_id = str(target_id)
+    visible = target_visible(target_type, target_id)
+    with db.atomic("IMMEDIATE"):
+        target = ReportTarget.get_or_none((ReportTarget.target_type == target_type) & (ReportTarget.target_id == target_id))
+        if target is None:
+            target = ReportTarget(target_type=target_type, target_id=target_id, first_reported_at=now)
+        elif target.status != "pending":
+            # Reopened: count only the reports since the last decision
+            target.status = "pending"
+            target.report_count = 0
+            target.first_reported_at = now
+            target.resolved_at = None
+            target.resolved_by = None
+        target.report_count += 1
+        target.last_reported_at = now
+        target.is_visible = visible
+        target.priority = priority(target.report_count, now, visible)
+        target.save()
+        return Report.create(reporter=reporter, target_type=target_type, target_id=target_id, reason=reason,
+                             created_at=now, group=target.id)
+
+def parse_cursor(cursor: Optional[str]) -> Optional[Tuple[int, int]]:
+    if not cursor:
+        return None
+    try:
+        p, i = cursor.split(":", 1)
+        return int(p), int(i)
+    except ValueError:
+        raise ValueError("cursor must look like <priority>:<id>")
+
+def queue(status: str = "pending", cursor: Optional[str] = None, limit: int = 50,
+          target_type: Optional[str] = None) -> dict:
+    query = ReportTarget.select().where(ReportTarget.status == status)
+    if target_type:
+        query = query.where(ReportTarget.target_type == target_type)
+    after = parse_cursor(cursor)
+    if after is not None:
+        p, i = after
+        query = query.where((ReportTarget.priority < p) | ((ReportTarget.priority == p) & (ReportTarget.id < i)))
+    targets = list(query.order_by(ReportTarget.priority.desc(), ReportTarget.id.desc()).limit(limit))
+
+    # The latest few reports per target, in one windowed query
+    recent = {}
+    if targets:
+        ranked = (Report.select(Report.id, Report.group, Report.reason, Report.created_at, Report.reporter,
+                                fn.ROW_NUMBER().over(partition_by=[Report.group],
+                                                     order_by=[Report.id.desc()]).alias("rn"))
+                  .where(Report.group.in_([t.id for t in targets]))
+                  .alias("ranked"))
+        rows = (Report.select(ranked.c.group_id, ranked.c.reason, ranked.c.created_at, ranked.c.reporter_id)
+                .from_(ranked).where(ranked.c.rn <= RECENT_REASONS).tuples())
+        for group_id, reason, created_at, reporter_id in rows:
+            recent.setdefault(group_id, []).append({"reason": reason, "created_at": created_at, "reporter_id": reporter_id})
+
+    items = [{
+        "id": t.id,
+        "target_type": t.target_type,
+        "target_id": t.target_id,
+        "status": t.status,
+        "report_count": t.report_count,
+        "priority": t.priority,
+        "is_visible": t.is_visible,
+        "first_reported_at": t.first_reported_at,
+        "last_reported_at": t.last_reported_at,
+        "resolved_at": t.resolved_at,
+        "recent_reports": recent.get(t.id, [])
+    } for t in targets]
+    next_cursor = f"{targets[-1].priority}:{targets[-1].id}" if len(targets) == limit else None
+    return {"items": items, "next_cursor": next_cursor}
+
+def decide(target_ids: List[int], status: str, admin_id: int) -> int:
+    """Resolves or rejects targets and all their pending reports in one transaction."""
+    now = datetime.utcnow()
+    with db.atomic():
+        updated = (ReportTarget.update(status=status, resolved_at=now, resolved_by=admin_id)
+                   .where((ReportTarget.id.in_(target_ids)) & (ReportTarget.status == "pending"))
+                   .execute())
+        (Report.update(status=status, resolved_at=now, resolved_by=admin_id)
+         .where((Report.group.in_(target_ids)) & (Report.status == "pending"))
+         .execute())
+    return updated
+
+def backfill_targets() -> int:
+    """Groups reports filed before ReportTarget existed. Cheap no-op once done."""
+    if not Report.select().where(Report.group.is_null()).exists():
+        return 0
+    grouped = 0
+    with db.atomic():
+        rows = (Report.select(Report.target_type, Report.target_id, fn.COUNT(Report.id),
+                              fn.MIN(Report.created_at), fn.MAX(Report.created_at),
+                              fn.SUM(Report.status == "pending"))
+                .where(Report.group.is_null())
+                .group_by(Report.target_type, Report.target_id)
+                .tuples())
+        for target_type, target_id, count, first, last, pending in rows:
+            first = datetime.fromisoformat(first) if isinstance(first, str) else first
+            last = datetime.fromisoformat(last) if isinstance(last, str) else last
+            visible = target_visible(target_type, target_id)
+            target, _ = ReportTarget.get_or_create(target_type=target_type, target_id=target_id, defaults={
+                "status": "pending" if pending else "resolved",
+                "report_count": pending or count,
+                "first_reported_at": first,
+                "last_reported_at": last,
+                "is_visible": visible,
+                "priority": priority(pending or count, last, visible)
+            })
+            (Report.update(group=target.id)
+             .where((Report.target_type == target_type) & (Report.target_id == target_id) & Report.group.is_null())
+             .execute())
+            grouped += 1
+    return grouped
@@ -1,10 +1,19 @@
 
-from fastapi import APIRouter, HTTPException, Depends, Body
+from fastapi import APIRouter, HTTPException, Depends, Body, Request, Response
 from pydantic import BaseModel
 from typing import List, Optional
-from models import Announcement, User, SystemSetting, db, fn
+from models import Announcement, User, SystemSetting, ModerationAction, db, fn
 from security import get_current_user
-from datetime import datetime
+from datetime import datetime, timedelta
+import entity_cache
+import work_cards
+import jobs
+import cascade
+import moderation
+import reports
+import analytics
+import site_snapshot
+from conditional import is_not_modified, validator_headers
 
 router = APIRouter()
 
@@ -68,6 +77,7 @@ def ban_user(ban_data: UserBan, admin: User = Depends(get_current_admin)):
         u.is_banned = ban_data.is_banned
         u.ban_reason = ban_data.reason if ban_data.is_banned else None
         u.save()
+        entity_cache.publish(User, u.id)  # other workers check is_banned from their cache
         return {"status": "success", "is_banned": u.is_banned}
     except User.DoesNotExist:
         raise HTTPException(status_code=404, detail="User not found")
@@ -85,6 +95,7 @@ def toggle_user_admin(data: UserAdminToggle, admin: User = Depends(get_current_a
             
         u.is_admin = data.is_admin
         u.save()
+        entity_cache.publish(User, u.id)
         return {"status": "success", "is_admin": u.is_admin}
     except User.DoesNotExist:
         raise HTTPException(status_code=404, detail="User not found")
@@ -92,14 +103,137 @@ def toggle_user_admin(data: UserAdminToggle, admin: User = Depends(get_current_a
 # --- System Settings (Ban Screen) ---
 @router.get("/admin/settings/ban_screen")
 def get_ban_screen(admin: User = Depends(get_current_admin)):
-    setting = SystemSetting.get_or_none(SystemSetting.key == "ban_screen_html")
-    return {"html": setting.value if setting else "<h1>Account Suspended</h1><p>Your account has been banned for violating community rules.</p>"}
+    html = site_snapshot.setting("ban_screen_html")
+    return {"html": html if html is not None else "<h1>Account Suspended</h1><p>Your account has been banned for violating community rules.</p>"}
 
 @router.post("/admin/settings/ban_screen")
 def set_ban_screen(data: SettingUpdate, admin: User = Depends(get_current_admin)):
     setting, created = SystemSetting.get_or_create(key="ban_screen_html", defaults={"value": ""})
     setting.value = data.value
     setting.save()
+    site_snapshot.publish()
+    return {"status": "success"}
+
+@router.delete("/admin/users/{user_id}")
+def delete_user(user_id: int, admin: User = Depends(get_current_admin)):
+    """Bans the account and hides its posts and works now; everything else is purged in the background."""
+    if user_id == admin.id:
+        raise HTTPException(status_code=400, detail="Cannot delete yourself")
+    if not User.select().where(User.id == user_id).exists():
+        raise HTTPException(status_code=404, detail="User not found")
+    deletion = cascade.start("user", user_id, requested_by=admin.id)
+    return {"status": "success", "deletion_id": deletion.id}
+
+# --- Bulk Moderation ---
+class ModerationCreate(BaseModel):
+    user_id: int
+    reason: str
+    since: Optional[datetime] = None # Hide content created since then; omit for everything
+
+@router.post("/admin/moderation")
+def start_moderation(data: ModerationCreate, admin: User = Depends(get_current_admin)):
+    """Bans the user now and hides their content in the background. Poll GET /admin/moderation/{id}."""
+    u = User.get_or_none(User.id == data.user_id)
+    if u is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    if u.id == admin.id:
+        raise HTTPException(status_code=400, detail="Cannot ban yourself")
+    action = moderation.start(u, admin, data.reason, data.since)
+    return moderation.progress(action)
+
+@router.get("/admin/moderation")
+def list_moderation(user_id: Optional[int] = None, limit: int = 20, admin: User = Depends(get_current_admin)):
+    query = ModerationAction.select()
+    if user_id:
+        query = query.where(ModerationAction.user == user_id)
+    return [moderation.progress(a) for a in query.order_by(ModerationAction.id.desc()).limit(min(limit, 100))]
+
+@router.get("/admin/moderation/{action_id}")
+def get_moderation(action_id: int, admin: User = Depends(get_current_admin)):
+    action = ModerationAction.get_or_none(ModerationAction.id == action_id)
+    if action is None:
+        raise HTTPException(status_code=404, detail="Moderation action not found")
+    return moderation.progress(action)
+
+@router.post("/admin/moderation/{action_id}/undo")
+def undo_moderation(action_id: int, admin: User = Depends(get_current_admin)):
+    action = ModerationAction.get_or_none(ModerationAction.id == action_id)
+    if action is None:
+        raise HTTPException(status_code=404, detail="Moderation action not found")
+    if action.status not in ("done", "failed"):
+        raise HTTPException(status_code=409, detail=f"Cannot undo while {action.status}")
+    action.status = "undoing"
+    action.save()
+    jobs.enqueue("moderation.undo", {"action_id": action.id})
+    return {"status": "success"}
+
+# --- Report Queue ---
+class ReportBatch(BaseModel):
+    ids: List[int] # ReportTarget ids from GET /admin/reports
+    action: str # resolve, reject
+
+@router.get("/admin/reports")
+def get_report_queue(status: str = "pending", cursor: Optional[str] = None, limit: int = 50,
+                     target_type: Optional[str] = None, admin: User = Depends(get_current_admin)):
+    """Reported targets, highest priority first. Pass next_cursor back as ?cursor= for the next page."""
+    if status not in ("pending", "resolved", "rejected"):
+        raise HTTPException(status_code=400, detail="Unknown status")
+    try:
+        return reports.queue(status, cursor, max(1, min(limit, 100)), target_type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/admin/reports/batch")
+def batch_reports(data: ReportBatch, admin: User = Depends(get_current_admin)):
+    statuses = {"resolve": "resolved", "reject": "rejected"}
+    if data.action not in statuses:
+        raise HTTPException(status_code=400, detail="Action must be resolve or reject")
+    if not data.ids or len(data.ids) > 500:
+        raise HTTPException(status_code=400, detail="Pass 1-500 ids")
+    updated = reports.decide(data.ids, statuses[data.action], admin.id)
+    return {"status": "success", "updated": updated}
+
+# --- Analytics ---
+ANALYTICS_METRICS = ["posts", "comments", "works", "signups", "active_users"]
+
+@router.get("/admin/analytics")
+def get_analytics(metrics: Optional[str] = None, bucket: str = "day", days: int = 30,
+                  admin: User = Depends(get_current_admin)):
+    """Time series from the pre-aggregated counters (analytics.py). metrics is comma separated."""
+    if bucket not in analytics.BUCKETS:
+        raise HTTPException(status_code=400, detail="Bucket must be hour or day")
+    # Hourly buckets are only kept for HOUR_RETENTION
+    max_days = analytics.HOUR_RETENTION.days if bucket == "hour" else 366
+    days = max(1, min(days, max_days))
+    names = [m.strip() for m in metrics.split(",") if m.strip()] if metrics else ANALYTICS_METRICS
+    since = datetime.utcnow() - timedelta(days=days)
+    result = analytics.series(names, bucket, since=since)
+    result["top_categories"] = analytics.breakdown("posts", since)
+    return result
+
+@router.post("/admin/analytics/rebuild")
+def rebuild_analytics(admin: User = Depends(get_current_admin)):
+    job_id = jobs.enqueue("analytics.rebuild")
+    return {"status": "success", "job_id": job_id}
+
+# --- Caches ---
+@router.get("/admin/cache/stats")
+def get_cache_stats(admin: User = Depends(get_current_admin)):
+    return {
+        "entities": entity_cache.stats(),
+        "work_cards": work_cards.card_cache.stats(),
+        "live_works": work_cards.live_work_cache.stats()
+    }
+
+# --- Background Jobs ---
+@router.get("/admin/jobs")
+def get_job_stats(admin: User = Depends(get_current_admin)):
+    return jobs.stats()
+
+@router.post("/admin/jobs/{job_id}/retry")
+def retry_job(job_id: int, admin: User = Depends(get_current_admin)):
+    if not jobs.retry(job_id):
+        raise HTTPException(status_code=404, detail="No failed job with that id")
     return {"status": "success"}
 
 # --- Announcements ---
@@ -117,21 +251,12 @@ class AnnouncementRead(BaseModel):
     created_by: str
 
 @router.get("/announcements", response_model=List[AnnouncementRead])
-def get_announcements(active_only: bool = True):
-    query = Announcement.select(Announcement, User).join(User).order_by(Announcement.created_at.desc())
-    if active_only:
-        query = query.where(Announcement.active == True)
-    
-    return [
-        {
-            "id": a.id,
-            "content": a.content,
-            "type": a.type,
-            "active": a.active,
-            "created_at": a.created_at,
-            "created_by": a.created_by.username
-        } for a in query
-    ]
+def get_announcements(request: Request, active_only: bool = True):
+    # Served from the in-memory snapshot; the ETag changes only when an admin edits announcements
+    snapshot = site_snapshot.current()
+    if is_not_modified(request, snapshot.etag):
+        return Response(status_code=304, headers=validator_headers(snapshot.etag))
+    return Response(snapshot.bodies[active_only], media_type="application/json", headers=validator_headers(snapshot.etag))
 
 @router.post("/admin/announcements", response_model=AnnouncementRead)
 def create_announcement(announcement: AnnouncementCreate, admin: User = Depends(get_current_admin)):
@@ -141,6 +266,7 @@ def create_announcement(announcement: AnnouncementCreate, admin: User = Depends(
         active=announcement.active,
         created_by=admin
     )
+    site_snapshot.publish()
     
     return {
         "id": new_announcement.id,
@@ -159,6 +285,7 @@ def update_announcement(id: int, announcement: AnnouncementCreate, admin: User =
         a.type = announcement.type
         a.active = announcement.active
         a.save()
+        site_snapshot.publish()
         
         return {
             "id": a.id,
@@ -176,6 +303,7 @@ def delete_announcement(id: int, admin: User = Depends(get_current_admin)):
     try:
         a = Announcement.get_by_id(id)
         a.delete_instance()
+        site_snapshot.publish()
         return {"status": "success"}
     except Announcement.DoesNotExist:
         raise HTTPException(status_code=404, detail="Announcement not found")
@@ -5,9 +5,13 @@ import httpx
 from models import Banner, User
 from security import get_current_user
 from datetime import datetime
+from cache import TTLCache
 
 router = APIRouter()
 
+# Codemao's official banners rarely change; one fetch per worker every few minutes
+official_cache = TTLCache(maxsize=1, ttl=300)
+
 class BannerCreate(BaseModel):
     title: str
     image_url: str
@@ -35,15 +39,18 @@ async def get_banners():
         print(f"DB Banner Error: {e}")
 
     # 2. Get Codemao Official Banners
-    official_banners = []
-    url = "https://api.codemao.cn/web/banners/all?type=OFFICIAL"
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(url)
-            if response.status_code == 200:
-                official_banners = response.json().get("items", [])
-        except Exception as e:
-            print(f"Error fetching official banners: {e}")
+    official_banners = official_cache.get("official")
+    if official_banners is None:
+        official_banners = []
+        url = "https://api.codemao.cn/web/banners/all?type=OFFICIAL"
+        async with httpx.AsyncClient() as client:
+            try:
+                response = await client.get(url)
+                if response.status_code == 200:
+                    official_banners = response.json().get("items", [])
+                    official_cache.set("official", official_banners)
+            except Exception as e:
+                print(f"Error fetching official banners: {e}")
             
     # Combine: Custom first, then Official
     return custom_banners + official_banners
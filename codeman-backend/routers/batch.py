@@ -0,0 +1,148 @@
+"""
+POST /api/batch: several GET requests in one round trip.
+
+Each sub-request is dispatched straight into the app's router with a scope
+derived from the batch request, so there is no new HTTP connection and no
+second pass through the middleware. The auth context decoded for the batch
+(request.state.auth) is handed to every sub-request, which means handlers see
+the same user without decoding the token again. Exception handlers still
+apply, so a sub-request that raises HTTPException or fails validation
+comes back as its normal error response. Per-route rate limits count the
+same as for direct calls.
+
+Sub-requests run concurrently. If the whole batch is still running after
+BATCH_TIMEOUT seconds, the items that haven't finished are answered with a 504.
+"""
+import asyncio
+import json
+import os
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit
+
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.middleware.asyncexitstack import AsyncExitStackMiddleware
+from pydantic import BaseModel
+from starlette.exceptions import HTTPException as StarletteHTTPException
+
+from security import get_auth_context
+from serializers import respond
+
+router = APIRouter()
+
+MAX_ITEMS = 20
+BATCH_TIMEOUT = float(os.getenv("BATCH_TIMEOUT", 10))
+# Batching these makes no sense (or would recurse)
+BLOCKED_PREFIXES = ("/api/batch", "/api/ws/")
+# Scope entries a sub-request shares with the batch request; the router fills in the rest
+INHERITED_SCOPE = ("type", "asgi", "http_version", "scheme", "server", "client", "root_path", "app",
+                   "starlette.exception_handlers")
+SKIPPED_HEADERS = {b"content-length", b"content-type", b"if-none-match", b"if-modified-since"}
+RETURNED_HEADERS = ("content-type", "etag", "cache-control")
+
+class BatchItem(BaseModel):
+    path: str # e.g. "/api/works/123" or "/api/posts?limit=5"
+    id: Optional[str] = None # Echoed back so clients can match responses
+    method: str = "GET"
+
+class BatchRequest(BaseModel):
+    requests: List[BatchItem]
+
+class BatchResponseItem(BaseModel):
+    id: Optional[str] = None
+    status: int
+    headers: Dict[str, str] = {}
+    body: Any = None
+
+def _sub_scope(request: Request, path: str, query: str) -> dict:
+    parent = request.scope
+    scope = {key: parent[key] for key in INHERITED_SCOPE if key in parent}
+    scope.update({
+        "method": "GET",
+        "path": path,
+        "raw_path": path.encode("utf-8"),
+        "query_string": query.encode("utf-8"),
+        "headers": [(k, v) for k, v in parent["headers"] if k not in SKIPPED_HEADERS],
+        # Own dict so handlers can't step on each other's request.state, same auth context
+        "state": dict(parent.get("state", {})),
+    })
+    return scope
+
+async def _dispatch(request: Request, item: BatchItem) -> dict:
+    if item.method.upper() != "GET":
+        return {"id": item.id, "status": 405, "headers": {}, "body": {"detail": "Only GET requests can be batched"}}
+    url = urlsplit(item.path)
+    if not url.path.startswith("/api/") or url.path.startswith(BLOCKED_PREFIXES) or url.scheme or url.netloc:
+        return {"id": item.id, "status": 400, "headers": {}, "body": {"detail": "Path must be an /api/ GET route"}}
+
+    status = 500
+    headers: List[tuple] = []
+    chunks: List[bytes] = []
+    received = False
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await asyncio.Event().wait()  # no more body; wait until cancelled
+
+    async def send(message):
+        nonlocal status, headers
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            headers = message.get("headers", [])
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    try:
+        # The exit stack FastAPI's own middleware would provide (file uploads, dependency cleanup)
+        await AsyncExitStackMiddleware(request.app.router)(_sub_scope(request, url.path, url.query), receive, send)
+    except StarletteHTTPException as e:
+        # Raised by the router itself (404, 405) outside the route's exception handling
+        return {"id": item.id, "status": e.status_code, "headers": {}, "body": {"detail": e.detail}}
+    except Exception as e:
+        print(f"Batch item {item.path} failed: {e}")
+        return {"id": item.id, "status": 500, "headers": {}, "body": {"detail": "Internal Server Error"}}
+
+    response_headers = {}
+    cookies = []
+    for key, value in headers:
+        name = key.decode("latin-1").lower()
+        if name == "set-cookie":
+            cookies.append(value)
+        elif name in RETURNED_HEADERS:
+            response_headers[name] = value.decode("latin-1")
+    body = b"".join(chunks)
+    if response_headers.get("content-type", "").startswith("application/json") and body:
+        parsed = json.loads(body)
+    else:
+        parsed = body.decode("utf-8", errors="replace") if body else None
+    return {"id": item.id, "status": status, "headers": response_headers, "body": parsed, "cookies": cookies}
+
+@router.post("/batch", response_model=List[BatchResponseItem])
+async def batch(data: BatchRequest, request: Request, response: Response):
+    """
+    Runs up to MAX_ITEMS GET sub-requests concurrently with the caller's credentials.
+    Responses come back in request order as {id, status, headers, body}.
+    """
+    if not data.requests:
+        raise HTTPException(status_code=400, detail="No requests")
+    if len(data.requests) > MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_ITEMS} requests per batch")
+    get_auth_context(request)  # make sure the shared context is on request.state
+
+    tasks = [asyncio.create_task(_dispatch(request, item)) for item in data.requests]
+    done, pending = await asyncio.wait(tasks, timeout=BATCH_TIMEOUT)
+    for task in pending:
+        task.cancel()
+
+    results = []
+    for item, task in zip(data.requests, tasks):
+        if task in pending:
+            results.append({"id": item.id, "status": 504, "headers": {}, "body": {"detail": "Timed out"}})
+            continue
+        result = task.result()
+        for cookie in result.pop("cookies", []):
+            response.raw_headers.append((b"set-cookie", cookie))
+        results.append(result)
+    return respond(results, response)
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import time
+from datetime import datetime
+from typing import List, Optional
+
+from fastapi import APIRouter, Query, WebSocket, WebSocketDisconnect
+from pydantic import BaseModel
+
+from chat_hub import hub, load_history, MAX_CONTENT_LENGTH
+from security import auth_context_from_token
+from serializers import dumps, respond
+
+router = APIRouter()
+
+# Per-connection flood control: at most RATE_COUNT messages per RATE_WINDOW seconds
+RATE_COUNT = 5
+RATE_WINDOW = 5.0
+
+class ChatUser(BaseModel):
+    id: int
+    codemao_id: str
+    username: str
+    avatar_url: Optional[str] = None
+    description: Optional[str] = None
+    is_admin: bool = False
+
+class ChatMessageRead(BaseModel):
+    id: str
+    user: ChatUser
+    content: str
+    msg_type: str
+    created_at: datetime
+
+class ChatHistory(BaseModel):
+    messages: List[ChatMessageRead]
+    next_before: Optional[datetime] = None # Pass as ?before= (with ?before_id=) to load the previous page
+    next_before_id: Optional[int] = None
+
+@router.get("/chat/messages", response_model=ChatHistory)
+def get_chat_history(before: Optional[datetime] = None, before_id: Optional[int] = None,
+                     limit: int = Query(50, ge=1, le=100)):
+    """
+    Older chat history, for scrolling back past what the socket sent on join.
+    Cursor-paged on (created_at, id): pass next_before and next_before_id back
+    as `before` and `before_id`.
+    """
+    messages, oldest = load_history(before, limit, before_id)
+    return respond({
+        "messages": messages,
+        "next_before": oldest.created_at if oldest else None,
+        "next_before_id": oldest.id if oldest else None
+    })
+
+@router.websocket("/ws/chat")
+async def chat_socket(websocket: WebSocket, token: Optional[str] = None):
+    """
+    Public chat room. Anyone may listen; sending needs ?token= of a non-banned user.
+    On join: {"type": "history", "messages": [...], "online": n}.
+    Client sends {"type": "message", "content": "..."} or "ping".
+    Server pushes {"type": "message", "message": {...}} and {"type": "error", "detail": "..."}.
+    """
+    ctx = auth_context_from_token(token)
+    if ctx.error:
+        await websocket.close(code=4401)
+        return
+    user = ctx.load_user()
+
+    await websocket.accept()
+    conn = hub.join()
+
+    async def writer():
+        while not conn.closed:
+            await websocket.send_text(await conn.outbox.get())
+        await websocket.close(code=4408)
+
+    await websocket.send_text(dumps({
+        "type": "history",
+        "messages": hub.history(),
+        "online": len(hub.connections)
+    }).decode("utf-8"))
+    sender = asyncio.create_task(writer())
+    sent_at = []
+    try:
+        while True:
+            raw = await websocket.receive_text()
+            if raw == "ping":
+                conn.offer('{"type":"pong"}')
+                continue
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                continue
+            if not isinstance(data, dict) or data.get("type") != "message":
+                continue
+
+            if user is None or user.is_banned:
+                conn.offer('{"type":"error","detail":"Login required to send messages"}')
+                continue
+            content = str(data.get("content", "")).strip()
+            if not content or len(content) > MAX_CONTENT_LENGTH:
+                conn.offer(dumps({"type": "error", "detail": f"Message must be 1-{MAX_CONTENT_LENGTH} characters"}).decode("utf-8"))
+                continue
+            now = time.monotonic()
+            sent_at = [t for t in sent_at if now - t < RATE_WINDOW]
+            if len(sent_at) >= RATE_COUNT:
+                conn.offer('{"type":"error","detail":"Slow down"}')
+                continue
+            sent_at.append(now)
+            hub.post(user, content)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        hub.leave(conn)
+        sender.cancel()
@@ -35,7 +35,7 @@ def get_codeman_comments(post_id: str):
     """
     comments = (BcmComment.select(BcmComment, User)
                 .join(User)
-                .where(BcmComment.bcm_post_id == post_id)
+                .where((BcmComment.bcm_post_id == post_id) & (BcmComment.is_deleted == False))
                 .order_by(BcmComment.created_at.desc()))
                 
     return [{
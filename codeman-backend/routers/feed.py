@@ -0,0 +1,62 @@
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from pydantic import BaseModel
+
+import timeline
+from models import Post, PostLike, User, Work
+from routers.works import serialize_work_card
+from security import get_current_user
+from serializers import respond, serialize_post
+
+router = APIRouter()
+
+class FeedItem(BaseModel):
+    type: str # 'post' or 'work'
+    created_at: datetime
+    post: Optional[Dict[str, Any]] = None # Same shape as GET /api/posts/{id}
+    work: Optional[Dict[str, Any]] = None # Same shape as a GET /api/works card
+
+class FeedPage(BaseModel):
+    items: List[FeedItem]
+    next_before: Optional[datetime] = None # Pass as ?before= (with ?before_item=) for the next page
+    next_before_item: Optional[str] = None # "<type>:<id>" of the last entry
+
+@router.get("/feed", response_model=FeedPage)
+def get_feed(request: Request, before: Optional[datetime] = None, before_item: Optional[str] = None,
+             limit: int = Query(20, ge=1, le=50), current_user: User = Depends(get_current_user)):
+    """
+    Home timeline: posts and works from the people you follow, plus your own,
+    newest first. Cursor-paged on (created_at, item) via ?before= and ?before_item=.
+    """
+    try:
+        cursor_item = timeline.parse_item(before_item)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    entries = timeline.read_page(current_user.id, before, limit, cursor_item)
+
+    post_ids = [item_id for _, item_type, item_id, _ in entries if item_type == "post"]
+    work_ids = [item_id for _, item_type, item_id, _ in entries if item_type == "work"]
+    posts = {p.id: p for p in Post.select(Post, User).join(User).where(Post.id.in_(post_ids) & (Post.is_deleted == False))} if post_ids else {}
+    works = {w.work_id: w for w in Work.select(Work, User).join(User).where(Work.work_id.in_(work_ids) & (Work.is_deleted == False))} if work_ids else {}
+    liked = set()
+    if posts:
+        liked = {pid for (pid,) in PostLike.select(PostLike.post)
+                 .where((PostLike.user == current_user.id) & (PostLike.post.in_(list(posts)))).tuples()}
+
+    items = []
+    for created_at, item_type, item_id, _ in entries:
+        # Skip entries whose item has been removed since it was pushed
+        if item_type == "post" and item_id in posts:
+            items.append({"type": "post", "created_at": created_at,
+                          "post": serialize_post(posts[item_id], item_id in liked)})
+        elif item_type == "work" and item_id in works:
+            items.append({"type": "work", "created_at": created_at, "work": serialize_work_card(works[item_id])})
+
+    last = entries[-1] if len(entries) == limit else None
+    return respond({
+        "items": items,
+        "next_before": last[0] if last else None,
+        "next_before_item": f"{last[1]}:{last[2]}" if last else None
+    })
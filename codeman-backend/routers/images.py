@@ -0,0 +1,46 @@
+import os
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+
+import image_proxy
+from conditional import is_not_modified
+
+router = APIRouter()
+
+@router.get("/img")
+async def get_image(request: Request, url: str, w: Optional[int] = Query(None, ge=1, le=4096),
+                    fmt: Optional[str] = None):
+    """
+    Cached, resized copy of an allowlisted image, e.g. /api/img?url=<cover_url>&w=200.
+    w is rounded up to a standard width. Without fmt, WebP is served to browsers that accept it, JPEG otherwise;
+    fmt=original skips resizing.
+    """
+    headers = {"Cache-Control": image_proxy.CACHE_CONTROL}
+    if fmt is None:
+        fmt = "webp" if "image/webp" in request.headers.get("accept", "") else "jpeg"
+        headers["Vary"] = "Accept"
+    elif fmt not in image_proxy.FORMATS + ("original",):
+        raise HTTPException(status_code=400, detail="fmt must be webp, jpeg or original")
+    try:
+        f, path, content_type = await image_proxy.open_variant(url, w, fmt)
+    except image_proxy.ImageError as e:
+        raise HTTPException(status_code=e.status, detail=e.detail)
+
+    # Cache files never change once written, so the file name is a strong validator
+    headers["ETag"] = f'"{os.path.basename(path)}"'
+    if is_not_modified(request, headers["ETag"]):
+        f.close()
+        return Response(status_code=304, headers=headers)
+    headers["Content-Length"] = str(os.fstat(f.fileno()).st_size)
+    return StreamingResponse(_read_chunks(f), media_type=content_type, headers=headers)
+
+def _read_chunks(f, size: int = 64 * 1024):
+    # Reads the already open file, so a trim() after open_variant() can't break the response
+    with f:
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                break
+            yield chunk
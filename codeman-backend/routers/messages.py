@@ -0,0 +1,258 @@
+from datetime import datetime
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from pydantic import BaseModel, Field
+from peewee import fn
+
+import entity_cache
+import notifications
+from models import db, User, DirectMessage, FriendRequest, ConversationSummary
+from security import get_current_user
+from serializers import respond, serialize_direct_message, user_brief
+
+router = APIRouter()
+
+PREVIEW_LENGTH = 100
+
+class MessageUser(BaseModel):
+    id: int
+    codemao_id: str
+    username: str
+    avatar_url: Optional[str] = None
+    description: Optional[str] = None
+    is_admin: bool = False
+
+class DirectMessageCreate(BaseModel):
+    content: str = Field(..., min_length=1, max_length=2000)
+
+class DirectMessageRead(BaseModel):
+    id: int
+    sender_id: int
+    recipient_id: int
+    content: str
+    msg_type: str
+    is_read: bool
+    created_at: datetime
+
+class ThreadPage(BaseModel):
+    messages: List[DirectMessageRead] # Oldest first
+    next_before: Optional[datetime] = None # Pass as ?before= (with ?before_id=) for the previous page
+    next_before_id: Optional[int] = None
+
+class ConversationRead(BaseModel):
+    id: int
+    peer: MessageUser
+    last_message_id: Optional[int] = None
+    last_sender_id: Optional[int] = None
+    last_preview: str
+    unread_count: int
+    updated_at: datetime
+
+class ReadReceipt(BaseModel):
+    up_to_id: int # Marks every message from the peer with id <= up_to_id as read
+
+class FriendRequestCreate(BaseModel):
+    user_id: int
+
+class FriendRequestRead(BaseModel):
+    id: int
+    sender: MessageUser
+    status: str
+    created_at: datetime
+
+def are_friends(a: int, b: int) -> bool:
+    return FriendRequest.select().where(
+        (((FriendRequest.sender == a) & (FriendRequest.recipient == b)) |
+         ((FriendRequest.sender == b) & (FriendRequest.recipient == a))) &
+        (FriendRequest.status == "accepted")
+    ).exists()
+
+def get_peer(peer_id: int, current_user: User) -> User:
+    if peer_id == current_user.id:
+        raise HTTPException(status_code=400, detail="Cannot message yourself")
+    peer = entity_cache.get_or_none(User, peer_id)
+    if peer is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return peer
+
+# --- Friends ---
+
+@router.get("/friends", response_model=List[MessageUser])
+def list_friends(request: Request, current_user: User = Depends(get_current_user)):
+    accepted = FriendRequest.select(FriendRequest.sender, FriendRequest.recipient).where(
+        ((FriendRequest.sender == current_user.id) | (FriendRequest.recipient == current_user.id)) &
+        (FriendRequest.status == "accepted")
+    ).tuples()
+    friend_ids = [s if s != current_user.id else r for s, r in accepted]
+    if not friend_ids:
+        return respond([])
+    friends = User.select().where(User.id.in_(friend_ids)).order_by(User.username)
+    return respond([user_brief(u) for u in friends])
+
+@router.get("/friends/requests", response_model=List[FriendRequestRead])
+def list_friend_requests(request: Request, current_user: User = Depends(get_current_user)):
+    pending = (FriendRequest.select(FriendRequest, User)
+               .join(User, on=(FriendRequest.sender == User.id))
+               .where((FriendRequest.recipient == current_user.id) & (FriendRequest.status == "pending"))
+               .order_by(FriendRequest.created_at.desc()))
+    return respond([{"id": fr.id, "sender": user_brief(fr.sender), "status": fr.status, "created_at": fr.created_at}
+                    for fr in pending])
+
+@router.post("/friends/requests")
+def send_friend_request(data: FriendRequestCreate, request: Request, current_user: User = Depends(get_current_user)):
+    peer = get_peer(data.user_id, current_user)
+    if are_friends(current_user.id, peer.id):
+        return {"status": "already_friends"}
+    # A pending request in the other direction is accepted instead of duplicated
+    reverse = FriendRequest.get_or_none((FriendRequest.sender == peer.id) & (FriendRequest.recipient == current_user.id))
+    if reverse and reverse.status == "pending":
+        reverse.status = "accepted"
+        reverse.save()
+        return {"status": "accepted"}
+    fr, created = FriendRequest.get_or_create(sender=current_user.id, recipient=peer.id)
+    if not created and fr.status == "rejected":
+        fr.status = "pending"
+        fr.created_at = datetime.utcnow()
+        fr.save()
+    if created or fr.status == "pending":
+        notifications.notify(peer, current_user, "friend_request", "sent you a friend request",
+                             target_id=current_user.id, target_type="user")
+    return {"status": fr.status}
+
+@router.post("/friends/requests/{request_id}/{action}")
+def respond_friend_request(request_id: int, action: str, request: Request, current_user: User = Depends(get_current_user)):
+    if action not in ("accept", "reject"):
+        raise HTTPException(status_code=400, detail="Action must be accept or reject")
+    fr = FriendRequest.get_or_none(FriendRequest.id == request_id)
+    if fr is None or fr.recipient_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Friend request not found")
+    fr.status = "accepted" if action == "accept" else "rejected"
+    fr.save()
+    return {"status": fr.status}
+
+# --- Direct Messages ---
+
+@router.get("/messages", response_model=List[ConversationRead])
+def list_conversations(request: Request, before: Optional[datetime] = None, before_id: Optional[int] = None,
+                       limit: int = Query(30, ge=1, le=100), current_user: User = Depends(get_current_user)):
+    """
+    Inbox, most recent first. Pass the last row's updated_at and id back as
+    ?before= and ?before_id= for the next page; the id breaks ties between
+    conversations updated at the same moment.
+    """
+    query = (ConversationSummary.select(ConversationSummary, User)
+             .join(User, on=(ConversationSummary.peer == User.id))
+             .where(ConversationSummary.owner == current_user.id))
+    if before is not None:
+        if before_id is not None:
+            query = query.where((ConversationSummary.updated_at < before) |
+                                ((ConversationSummary.updated_at == before) & (ConversationSummary.id < before_id)))
+        else:
+            query = query.where(ConversationSummary.updated_at < before)
+    rows = query.order_by(ConversationSummary.updated_at.desc(), ConversationSummary.id.desc()).limit(limit)
+    return respond([{
+        "id": c.id,
+        "peer": user_brief(c.peer),
+        "last_message_id": c.last_message_id,
+        "last_sender_id": c.last_sender_id,
+        "last_preview": c.last_preview,
+        "unread_count": c.unread_count,
+        "updated_at": c.updated_at
+    } for c in rows])
+
+@router.get("/messages/unread-count")
+def get_unread_messages(request: Request, current_user: User = Depends(get_current_user)):
+    total = (ConversationSummary.select(fn.SUM(ConversationSummary.unread_count))
+             .where(ConversationSummary.owner == current_user.id).scalar())
+    return {"unread": total or 0}
+
+@router.get("/messages/{peer_id}", response_model=ThreadPage)
+def get_thread(peer_id: int, request: Request, before: Optional[datetime] = None, before_id: Optional[int] = None,
+               limit: int = Query(50, ge=1, le=100), current_user: User = Depends(get_current_user)):
+    """
+    One thread, newest page first. Each direction is a range scan on the
+    (sender, recipient, created_at) index; pass next_before and next_before_id
+    back as ?before= and ?before_id= to load the previous page. The id breaks
+    ties between messages with the same created_at.
+    """
+    peer = get_peer(peer_id, current_user)
+    query = DirectMessage.select().where(
+        ((DirectMessage.sender == current_user.id) & (DirectMessage.recipient == peer.id)) |
+        ((DirectMessage.sender == peer.id) & (DirectMessage.recipient == current_user.id))
+    )
+    if before is not None:
+        if before_id is not None:
+            query = query.where((DirectMessage.created_at < before) |
+                                ((DirectMessage.created_at == before) & (DirectMessage.id < before_id)))
+        else:
+            query = query.where(DirectMessage.created_at < before)
+    rows = list(query.order_by(DirectMessage.created_at.desc(), DirectMessage.id.desc()).limit(limit))
+    rows.reverse()
+    oldest = rows[0] if len(rows) == limit else None
+    return respond({
+        "messages": [serialize_direct_message(m) for m in rows],
+        "next_before": oldest.created_at if oldest else None,
+        "next_before_id": oldest.id if oldest else None
+    })
+
+@router.post("/messages/{peer_id}", response_model=DirectMessageRead)
+def send_message(peer_id: int, data: DirectMessageCreate, request: Request, current_user: User = Depends(get_current_user)):
+    peer = get_peer(peer_id, current_user)
+    if not are_friends(current_user.id, peer.id):
+        raise HTTPException(status_code=403, detail="You need to be friends with this user to send private messages")
+
+    now = datetime.utcnow()
+    preview = data.content[:PREVIEW_LENGTH]
+    # IMMEDIATE: both summary rows and the message commit together, and concurrent
+    # sends to the same recipient can't lose an unread increment
+    with db.atomic("IMMEDIATE"):
+        message = DirectMessage.create(sender=current_user.id, recipient=peer.id, content=data.content, created_at=now)
+        for owner, other, unread in ((current_user.id, peer.id, 0), (peer.id, current_user.id, 1)):
+            (ConversationSummary
+             .insert(owner=owner, peer=other, last_message=message.id, last_sender=current_user.id,
+                     last_preview=preview, unread_count=unread, updated_at=now)
+             .on_conflict(
+                 conflict_target=[ConversationSummary.owner, ConversationSummary.peer],
+                 update={
+                     ConversationSummary.last_message: message.id,
+                     ConversationSummary.last_sender: current_user.id,
+                     ConversationSummary.last_preview: preview,
+                     ConversationSummary.unread_count: ConversationSummary.unread_count + unread,
+                     ConversationSummary.updated_at: now
+                 })
+             .execute())
+
+    payload = serialize_direct_message(message)
+    notifications.hub.publish_dm(message, current_user)
+    return respond(payload)
+
+@router.post("/messages/{peer_id}/read")
+def mark_thread_read(peer_id: int, data: ReadReceipt, request: Request, current_user: User = Depends(get_current_user)):
+    """
+    Batched read receipt: one UPDATE covers everything the peer sent up to up_to_id,
+    however many messages that is.
+    """
+    peer = get_peer(peer_id, current_user)
+    with db.atomic("IMMEDIATE"):
+        marked = (DirectMessage.update(is_read=True)
+                  .where((DirectMessage.sender == peer.id) & (DirectMessage.recipient == current_user.id) &
+                         (DirectMessage.id <= data.up_to_id) & (DirectMessage.is_read == False))
+                  .execute())
+        if marked:
+            remaining = (DirectMessage.select()
+                         .where((DirectMessage.sender == peer.id) & (DirectMessage.recipient == current_user.id) &
+                                (DirectMessage.is_read == False))
+                         .count())
+            (ConversationSummary.update(unread_count=remaining)
+             .where((ConversationSummary.owner == current_user.id) & (ConversationSummary.peer == peer.id))
+             .execute())
+            # The receipt goes on the peer's side, numbered under the write lock so
+            # other workers can relay it in order (notifications.relay_loop)
+            seq = (ConversationSummary.select(fn.COALESCE(fn.MAX(ConversationSummary.read_seq), 0)).scalar()) + 1
+            (ConversationSummary.update(peer_read_up_to=data.up_to_id, read_seq=seq)
+             .where((ConversationSummary.owner == peer.id) & (ConversationSummary.peer == current_user.id))
+             .execute())
+    if marked:
+        notifications.hub.publish_dm_read(peer.id, current_user.id, data.up_to_id, seq)
+    return {"status": "success", "marked": marked}
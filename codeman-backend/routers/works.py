@@ -6,9 +6,16 @@ from typing import List, Optional
 from fastapi import APIRouter, Query, HTTPException, Request, Depends
 from pydantic import BaseModel
 import httpx
-from models import Work, User, Notification, WorkComment, WorkLike, WorkCommentLike, Report
-from security import get_current_user
+from models import Work, User, WorkComment, WorkLike, WorkCommentLike
+from security import get_current_user, get_optional_user
 from peewee import fn
+from work_cards import remember_live_work, live_work_cache
+import entity_cache
+from notifications import notify
+import jobs
+import cascade
+import reports
+import analytics
 
 router = APIRouter()
 
@@ -28,42 +35,53 @@ def get_works(skip: int = 0, limit: int = 20):
     # Fetch from DB (Join with User to get uploader info)
     works_query = (Work.select(Work, User)
                    .join(User)
+                   .where(Work.is_deleted == False)
                    .order_by(Work.created_at.desc())
                    .offset(skip)
                    .limit(limit))
     
-    db_works = []
-    for w in works_query:
-        # Use original author info if available and user is system/imported
-        if w.original_author_id:
-             display_nickname = w.original_author_name or "Original Developer"
-             display_avatar = w.original_author_avatar
-             display_user_id = w.original_author_id
-        else:
-             display_nickname = w.user.username
-             display_avatar = w.user.avatar_url
-             display_user_id = w.user.codemao_id
+    return [serialize_work_card(w) for w in works_query]
 
-        db_works.append({
-            "work_id": w.work_id,
-            "work_name": w.name,
-            "preview_url": w.cover_url,
-            "description": w.description,
-            "bcm_url": w.bcm_url,
-            "likes_count": w.likes,
-            "views_count": w.views,
-            "avatar_url": display_avatar,
-            "nickname": display_nickname,
-            "user_id": display_user_id,
-            "internal_user_id": w.user.id
-        })
-    
-    return db_works
+def serialize_work_card(w) -> dict:
+    """Work list card. Also used by the home feed (routers/feed.py)."""
+    # Use original author info if available and user is system/imported
+    if w.original_author_id:
+         display_nickname = w.original_author_name or "Original Developer"
+         display_avatar = w.original_author_avatar
+         display_user_id = w.original_author_id
+    else:
+         display_nickname = w.user.username
+         display_avatar = w.user.avatar_url
+         display_user_id = w.user.codemao_id
+
+    return {
+        "work_id": w.work_id,
+        "work_name": w.name,
+        "preview_url": w.cover_url,
+        "description": w.description,
+        "bcm_url": w.bcm_url,
+        "likes_count": w.likes,
+        "views_count": w.views,
+        "avatar_url": display_avatar,
+        "nickname": display_nickname,
+        "user_id": display_user_id,
+        "internal_user_id": w.user.id
+    }
+
+def get_local_work(work_id: int) -> Work:
+    work = Work.get(Work.work_id == work_id)
+    if work.is_deleted:
+        raise HTTPException(status_code=404, detail="Work has been deleted")
+    return work
 
 def get_work_details(work_id: int, current_user_id: Optional[int] = None):
     # 1. Try DB
     try:
-        w = Work.select(Work, User).join(User).where(Work.work_id == work_id).get()
+        # Work and owner rows come from the entity cache; comments are always read fresh
+        w = entity_cache.get_by(Work, Work.work_id, work_id)
+        if w is None or w.is_deleted:
+            return None
+        w.user = entity_cache.get(User, w.user_id)
         
         # Get Comments
         comments = (WorkComment.select(WorkComment, User)
@@ -120,7 +138,7 @@ def get_work_details(work_id: int, current_user_id: Optional[int] = None):
             "comment_count": len(comments_data),
             "internal_user_id": w.user.id
         }
-    except Work.DoesNotExist:
+    except User.DoesNotExist:
         return None
 
 
@@ -151,7 +169,7 @@ def search_works(q: str = Query(..., min_length=1)):
     # Search in DB
     db_query = (Work.select(Work, User)
                 .join(User)
-                .where(Work.name.contains(q)))
+                .where(Work.name.contains(q) & (Work.is_deleted == False)))
     
     db_results = []
     for w in db_query:
@@ -182,10 +200,14 @@ def search_works(q: str = Query(..., min_length=1)):
 import nh3
 
 @router.get("/works/{work_id}")
-async def get_work_info(work_id: int, current_user: Optional[User] = Depends(get_current_user)):
+async def get_work_info(work_id: int, current_user: Optional[User] = Depends(get_optional_user)):
     user_id = current_user.id if current_user else None
     info = get_work_details(work_id, user_id)
     if not info:
+        cached = live_work_cache.get(work_id)
+        if cached:
+            return cached
+
         # Fallback: Fetch from live Codemao API
         try:
             api_url = f"https://api.codemao.cn/creation-tools/v1/works/{work_id}"
@@ -221,7 +243,9 @@ async def get_work_info(work_id: int, current_user: Optional[User] = Depends(get
                     internal_user = User.get_or_none(User.codemao_id == result["user_id"])
                     if internal_user:
                         result["internal_user_id"] = internal_user.id
-                        
+
+                    # Also lets post embeds render cards for works we don't store
+                    remember_live_work(work_id, result)
                     return result
         except Exception as e:
             print(f"Live fetch error: {e}")
@@ -275,7 +299,7 @@ async def get_codemao_comments(work_id: int, limit: int = 20, offset: int = 0):
 async def create_work_comment(work_id: int, comment: CommentCreate, request: Request, current_user: User = Depends(get_current_user)):
     # First, try to find the work in our DB
     try:
-        work = Work.get(Work.work_id == work_id)
+        work = get_local_work(work_id)
     except Work.DoesNotExist:
         # Auto-claim logic (Same as before)
         try:
@@ -340,7 +364,7 @@ async def create_work_comment(work_id: int, comment: CommentCreate, request: Req
     
     # Notify Owner or Parent Commenter
     if parent and parent.user.id != current_user.id:
-        Notification.create(
+        notify(
             recipient=parent.user,
             sender=current_user,
             type="reply",
@@ -349,7 +373,7 @@ async def create_work_comment(work_id: int, comment: CommentCreate, request: Req
             target_type="work"
         )
     elif work.user.id != current_user.id and work.user.codemao_id != "0":
-        Notification.create(
+        notify(
             recipient=work.user,
             sender=current_user,
             type="comment",
@@ -375,7 +399,7 @@ async def create_work_comment(work_id: int, comment: CommentCreate, request: Req
 @router.post("/works/{work_id}/like")
 async def like_work(work_id: int, current_user: User = Depends(get_current_user)):
     try:
-        work = Work.get(Work.work_id == work_id)
+        work = get_local_work(work_id)
     except Work.DoesNotExist:
         # Auto-claim logic could be here too, but for now let's assume work exists or user must visit page first (which claims it)
         raise HTTPException(status_code=404, detail="Work not found in local DB. Please visit the work page first to initialize it.")
@@ -394,7 +418,7 @@ async def like_work(work_id: int, current_user: User = Depends(get_current_user)
         
         # Notify owner
         if work.user.id != current_user.id and work.user.codemao_id != "0":
-             Notification.create(
+             notify(
                 recipient=work.user,
                 sender=current_user,
                 type="like",
@@ -409,6 +433,8 @@ async def like_work(work_id: int, current_user: User = Depends(get_current_user)
 async def like_work_comment(comment_id: int, current_user: User = Depends(get_current_user)):
     try:
         comment = WorkComment.get(WorkComment.id == comment_id)
+        if comment.work.is_deleted:
+            raise WorkComment.DoesNotExist(comment_id)
     except WorkComment.DoesNotExist:
         raise HTTPException(status_code=404, detail="Comment not found")
 
@@ -449,7 +475,7 @@ async def report_work_comment(comment_id: int, report: ReportCreate, current_use
     except WorkComment.DoesNotExist:
         raise HTTPException(status_code=404, detail="Comment not found")
         
-    Report.create(
+    reports.file_report(
         reporter=current_user,
         target_type="work_comment",
         target_id=str(comment.id),
@@ -509,6 +535,8 @@ async def submit_work(submission: WorkSubmission, request: Request, current_user
     # 3. Save to DB
     try:
         work = Work.get(Work.work_id == submission.work_id)
+        if work.is_deleted:
+            raise HTTPException(status_code=409, detail="This work is still being deleted, try again in a minute")
         # Update existing
         work.name = data["work_name"]
         work.cover_url = data["preview"]
@@ -521,7 +549,7 @@ async def submit_work(submission: WorkSubmission, request: Request, current_user
         return {"message": "Work updated successfully", "work_id": work.work_id}
     except Work.DoesNotExist:
         # Create new
-        Work.create(
+        work = Work.create(
             work_id=submission.work_id,
             name=data["work_name"],
             cover_url=data["preview"],
@@ -531,4 +559,17 @@ async def submit_work(submission: WorkSubmission, request: Request, current_user
             likes=data["praise_times"],
             views=data["view_times"]
         )
+        jobs.enqueue("timeline.fan_out", {"author_id": current_user.id, "item_type": "work", "item_id": work.work_id})
+        analytics.record("works")
         return {"message": "Work submitted successfully", "work_id": submission.work_id}
+
+@router.delete("/works/{work_id}")
+def delete_work(work_id: int, current_user: User = Depends(get_current_user)):
+    work = Work.get_or_none((Work.work_id == work_id) & (Work.is_deleted == False))
+    if work is None:
+        raise HTTPException(status_code=404, detail="Work not found")
+    if work.user_id != current_user.id and not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not authorized to delete this work")
+    # Hidden right away; comments, likes and the row are removed in the background (cascade.py)
+    deletion = cascade.start("work", work.work_id, requested_by=current_user.id)
+    return {"status": "success", "message": "Work deleted", "deletion_id": deletion.id}
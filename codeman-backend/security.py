@@ -1,37 +1,30 @@
-from fastapi import HTTPException, Depends, status
+from fastapi import HTTPException, Depends, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from datetime import datetime, timedelta
 from typing import Optional
+from functools import lru_cache
 import jwt
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from models import User
+import entity_cache
+import keystore
 from config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
 
-import os
-# --- RSA Key Generation ---
-KEY_FILE = "private_key.pem"
-
-if os.path.exists(KEY_FILE):
-    with open(KEY_FILE, "rb") as f:
-        private_key = serialization.load_pem_private_key(
-            f.read(),
-            password=None
-        )
-else:
-    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
-    with open(KEY_FILE, "wb") as f:
-        f.write(private_key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=serialization.NoEncryption()
-        ))
-
-public_key = private_key.public_key()
-pem_public_key = public_key.public_bytes(
-    encoding=serialization.Encoding.PEM,
-    format=serialization.PublicFormat.SubjectPublicKeyInfo
-).decode('utf-8')
+# --- RSA Key ---
+# Loaded on first use (login / public-key endpoints) rather than at import; loading
+# and validating a 2048-bit key is the slowest part of importing this module.
+# serve.py or `python keystore.py` create the key file ahead of time.
+
+@lru_cache(maxsize=1)
+def get_private_key():
+    return keystore.load_rsa_private_key()
+
+@lru_cache(maxsize=1)
+def get_public_key_pem() -> str:
+    return get_private_key().public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode('utf-8')
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
@@ -45,31 +38,103 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+# --- Request Auth Context ---
+# auth_middleware decodes the bearer token once per request and stores the
+# result on request.state.auth. Handlers and dependencies read the cached
+# claims from there instead of decoding again; the User row is only loaded
+# when something actually asks for it.
+
+class AuthContext:
+    __slots__ = ("token", "claims", "error", "_user", "_user_loaded")
+
+    def __init__(self, token: Optional[str] = None, claims: Optional[dict] = None, error: Optional[str] = None):
+        self.token = token
+        self.claims = claims or {}
+        self.error = error
+        self._user = None
+        self._user_loaded = False
+
+    @property
+    def user_id(self) -> Optional[int]:
+        sub = self.claims.get("sub")
+        try:
+            return int(sub) if sub is not None else None
+        except (TypeError, ValueError):
+            return None
+
+    @property
+    def client_id(self) -> Optional[str]:
+        # Set for tokens issued through the OAuth code flow
+        return self.claims.get("azp")
+
+    def load_user(self) -> Optional[User]:
+        """Loads the token's user at most once per request."""
+        if not self._user_loaded:
+            self._user_loaded = True
+            user_id = self.user_id
+            if user_id is not None:
+                self._user = entity_cache.get_or_none(User, user_id)
+        return self._user
+
+def decode_token(token: str) -> dict:
+    return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+def build_auth_context(request: Request) -> AuthContext:
+    auth_header = request.headers.get("Authorization")
+    if not auth_header or not auth_header.startswith("Bearer "):
+        return AuthContext()
+    return auth_context_from_token(auth_header.split(" ")[1])
+
+def auth_context_from_token(token: Optional[str]) -> AuthContext:
+    """Same as build_auth_context for a bare token, e.g. the ?token= of a WebSocket handshake."""
+    if not token:
+        return AuthContext()
+    try:
+        return AuthContext(token=token, claims=decode_token(token))
+    except jwt.ExpiredSignatureError:
+        return AuthContext(token=token, error="Token expired")
+    except jwt.InvalidTokenError:
+        return AuthContext(token=token, error="Invalid token")
+
+def get_auth_context(request: Request) -> AuthContext:
+    """Returns the context built by auth_middleware, building it for paths the middleware skips."""
+    ctx = getattr(request.state, "auth", None)
+    if ctx is None:
+        ctx = build_auth_context(request)
+        request.state.auth = ctx
+    return ctx
+
+def get_optional_user_id(request: Request) -> Optional[int]:
+    """Current user's ID from the cached claims, without touching the DB. None if anonymous."""
+    return get_auth_context(request).user_id
+
+async def get_optional_user(request: Request) -> Optional[User]:
+    """Dependency for endpoints that work anonymously but personalize for logged-in users."""
+    user = get_auth_context(request).load_user()
+    if user is None or user.is_banned:
+        return None
+    return user
+
+async def get_current_user(request: Request, token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise credentials_exception
-    except jwt.PyJWTError:
+    ctx = get_auth_context(request)
+    if ctx.error or ctx.user_id is None:
         raise credentials_exception
-        
-    try:
-        user = User.get_by_id(int(user_id))
-        
-        # Check if banned
-        if user.is_banned:
-             raise HTTPException(
-                 status_code=status.HTTP_403_FORBIDDEN, 
-                 detail="Account Banned: " + (user.ban_reason or "No reason provided"),
-                 headers={"WWW-Authenticate": "Bearer"},
-             )
-             
-        return user
-    except User.DoesNotExist:
+
+    user = ctx.load_user()
+    if user is None:
         raise credentials_exception
+
+    # Check if banned
+    if user.is_banned:
+         raise HTTPException(
+             status_code=status.HTTP_403_FORBIDDEN, 
+             detail="Account Banned: " + (user.ban_reason or "No reason provided"),
+             headers={"WWW-Authenticate": "Bearer"},
+         )
+         
+    return user
@@ -0,0 +1,98 @@
+import json
+from datetime import date, datetime
+from operator import attrgetter
+from typing import Any, Callable, Iterable, Optional
+
+from fastapi.responses import Response
+
+from config import VALIDATE_RESPONSES
+
+try:
+    import orjson
+except ImportError:  # Optional speedup, falls back to the stdlib encoder
+    orjson = None
+
+def _default(value: Any):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(payload: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+def compile_serializer(fields: Iterable[str]) -> Callable[[Any], dict]:
+    """
+    Builds a row -> dict function for a fixed field list. The attribute lookups
+    are bound once into a single attrgetter instead of being re-resolved per row.
+    """
+    fields = tuple(fields)
+    getter = attrgetter(*fields)
+    if len(fields) == 1:
+        return lambda obj: {fields[0]: getter(obj)}
+    return lambda obj: dict(zip(fields, getter(obj)))
+
+# Field order mirrors the Pydantic response models in main.py
+USER_BRIEF_FIELDS = ("id", "codemao_id", "username", "avatar_url", "description", "is_admin")
+POST_FIELDS = ("title", "content", "category_id", "id", "excerpt", "created_at", "updated_at", "views", "likes")
+COMMENT_FIELDS = ("content", "id", "created_at")
+NOTIFICATION_FIELDS = ("id", "type", "target_id", "target_type", "is_read", "created_at", "updated_at", "actor_count")
+DIRECT_MESSAGE_FIELDS = ("id", "sender_id", "recipient_id", "content", "msg_type", "is_read", "created_at")
+
+user_brief = compile_serializer(USER_BRIEF_FIELDS)
+_post_fields = compile_serializer(POST_FIELDS)
+_comment_fields = compile_serializer(COMMENT_FIELDS)
+_notification_fields = compile_serializer(NOTIFICATION_FIELDS)
+serialize_direct_message = compile_serializer(DIRECT_MESSAGE_FIELDS)
+
+def serialize_post(post, is_liked: bool = False, user=None) -> dict:
+    data = _post_fields(post)
+    data["is_liked"] = is_liked
+    data["is_pinned"] = post.is_pinned
+    data["user"] = user_brief(user if user is not None else post.user)
+    return data
+
+def serialize_comment(comment, is_liked: bool = False, user=None) -> dict:
+    data = _comment_fields(comment)
+    data["user"] = user_brief(user if user is not None else comment.user)
+    data["likes"] = comment.likes or 0
+    data["is_liked"] = is_liked
+    data["parent_id"] = comment.parent_id
+    data["is_deleted"] = bool(comment.is_deleted)
+    return data
+
+def serialize_notification(notification, sender=None, recent_actors=()) -> dict:
+    """
+    Aggregated rows render as "<sender> and N others <message>": the client shows
+    sender.username in bold followed by message, so the count is folded into message.
+    """
+    data = _notification_fields(notification)
+    data["sender"] = user_brief(sender if sender is not None else notification.sender)
+    others = (notification.actor_count or 1) - 1
+    if others > 0:
+        data["message"] = f"and {others} {'other' if others == 1 else 'others'} {notification.message}"
+    else:
+        data["message"] = notification.message
+    data["recent_actors"] = [user_brief(u) for u in recent_actors]
+    return data
+
+def respond(payload: Any, response: Optional[Response] = None):
+    """
+    Returns handler payloads as pre-encoded JSON, bypassing response_model
+    re-validation. Set VALIDATE_RESPONSES=1 in development to route payloads
+    back through the declared response models instead.
+    Pass the handler's injected Response so cookies/headers set on it are kept.
+    """
+    if VALIDATE_RESPONSES:
+        return payload
+    fast = FastJSONResponse(payload)
+    if response is not None:
+        fast.raw_headers.extend((k, v) for k, v in response.raw_headers if k != b"content-length")
+    return fast
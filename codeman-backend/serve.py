@@ -0,0 +1,46 @@
+"""
+Multi-worker launcher.
+
+    python serve.py [--host 0.0.0.0] [--port 8000] [--workers N]
+
+Does the one-time work in this parent process, before any worker exists:
+creates or loads the key files in $CODEMAN_KEY_DIR (keystore.py), then creates, migrates and
+seeds the database. It then starts N uvicorn workers (default
+$WEB_CONCURRENCY, else the CPU count). Every worker reads the same keys, so a
+token issued by one worker verifies on all the others. The rate-limit
+counters are shared through shm_ratelimit.py.
+
+`uvicorn main:app` still works for single-process development.
+"""
+import argparse
+import os
+
+# Key files go to a runtime directory, not the source tree (or an image
+# built from it). Set before keystore is imported; workers inherit it.
+os.environ.setdefault("CODEMAN_KEY_DIR", os.path.join(os.path.expanduser("~"), ".codeman", "keys"))
+
+import uvicorn
+
+import keystore
+import worker_health
+
+def default_workers() -> int:
+    return int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the CodeMan API with several worker processes")
+    parser.add_argument("--host", default=os.getenv("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=default_workers())
+    args = parser.parse_args()
+
+    keystore.ensure_keys()
+
+    from models import db, setup_database
+    setup_database()
+    db.close()
+    os.environ["CODEMAN_SETUP_DONE"] = "1"
+
+    worker_health.clear_run_dir()
+    print(f"Starting {args.workers} worker(s) on {args.host}:{args.port}")
+    uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers, proxy_headers=True)
@@ -0,0 +1,156 @@
+"""
+Rate-limit storage shared by every worker process on the host.
+
+slowapi's default "memory://" storage keeps counters per process, so with N
+uvicorn workers each limit is effectively multiplied by N. This backend keeps
+fixed-window counters in a memory-mapped file (ideally on /dev/shm) that all
+workers map, registered with the `limits` library under the "shm" scheme:
+
+    Limiter(key_func=..., storage_uri="shm:///dev/shm/codeman-ratelimit?slots=65536")
+
+Layout: the file is a table of fixed-size 24-byte slots (key hash, window
+expiry, count) grouped into buckets of BUCKET_SLOTS. A key hashes to one
+bucket; only that bucket's byte range is locked (fcntl + a per-process
+stripe lock), so workers never contend on a global lock. When a bucket is
+full, the slot whose window expires first is reused.
+
+POSIX only (fcntl). config.py falls back to "memory://" elsewhere.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse, parse_qs
+
+from limits.storage import Storage
+
+SLOT = struct.Struct("<QdI4x")  # key hash, window expiry (unix time), count
+BUCKET_SLOTS = 8
+DEFAULT_SLOTS = 65536
+_THREAD_STRIPES = 64
+
+def _key_hash(key: str) -> int:
+    h = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+    return h or 1  # 0 marks an empty slot
+
+class SharedMemoryStorage(Storage):
+    STORAGE_SCHEME = ["shm"]
+
+    def __init__(self, uri: str, wrap_exceptions: bool = False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        parsed = urlparse(uri)
+        self.path = parsed.path or "/dev/shm/codeman-ratelimit"
+        query = parse_qs(parsed.query)
+        slots = int(query.get("slots", [options.get("slots", DEFAULT_SLOTS)])[0])
+        self.buckets = max(1, slots // BUCKET_SLOTS)
+        self.size = self.buckets * BUCKET_SLOTS * SLOT.size
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        # Whole-file lock only while sizing the table on first open
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < self.size:
+                os.ftruncate(self._fd, self.size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self._mm = mmap.mmap(self._fd, self.size)
+        # fcntl locks are per process, so threads in one worker also need a lock
+        self._stripes = [threading.Lock() for _ in range(_THREAD_STRIPES)]
+
+    @property
+    def base_exceptions(self):
+        return OSError
+
+    @contextmanager
+    def _bucket(self, key: str):
+        key_hash = _key_hash(key)
+        bucket = key_hash % self.buckets
+        offset = bucket * BUCKET_SLOTS * SLOT.size
+        length = BUCKET_SLOTS * SLOT.size
+        with self._stripes[bucket % _THREAD_STRIPES]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, offset)
+            try:
+                yield key_hash, offset
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offset)
+
+    def _find(self, key_hash: int, offset: int, now: float, create: bool):
+        """Returns (slot_offset, expiry, count) for key_hash, claiming a slot if create is set."""
+        victim = None
+        victim_expiry = float("inf")
+        for i in range(BUCKET_SLOTS):
+            slot_offset = offset + i * SLOT.size
+            stored_hash, expiry, count = SLOT.unpack_from(self._mm, slot_offset)
+            if stored_hash == key_hash:
+                if expiry <= now:
+                    return slot_offset, 0.0, 0
+                return slot_offset, expiry, count
+            # Empty or expired slots are free; otherwise evict whatever expires first
+            free_at = 0.0 if stored_hash == 0 or expiry <= now else expiry
+            if free_at < victim_expiry:
+                victim, victim_expiry = slot_offset, free_at
+        if not create:
+            return None, 0.0, 0
+        SLOT.pack_into(self._mm, victim, key_hash, 0.0, 0)
+        return victim, 0.0, 0
+
+    def incr(self, key: str, expiry: int, amount: int = 1, elastic_expiry: bool = False) -> int:
+        now = time.time()
+        with self._bucket(key) as (key_hash, offset):
+            slot_offset, window_expiry, count = self._find(key_hash, offset, now, create=True)
+            if window_expiry == 0.0 or elastic_expiry:
+                window_expiry = now + expiry
+            count += amount
+            SLOT.pack_into(self._mm, slot_offset, key_hash, window_expiry, count)
+            return count
+
+    def decr(self, key: str, amount: int = 1) -> int:
+        now = time.time()
+        with self._bucket(key) as (key_hash, offset):
+            slot_offset, window_expiry, count = self._find(key_hash, offset, now, create=False)
+            if slot_offset is None or window_expiry == 0.0:
+                return 0
+            count = max(0, count - amount)
+            SLOT.pack_into(self._mm, slot_offset, key_hash, window_expiry, count)
+            return count
+
+    def get(self, key: str) -> int:
+        with self._bucket(key) as (key_hash, offset):
+            _, _, count = self._find(key_hash, offset, time.time(), create=False)
+            return count
+
+    def get_expiry(self, key: str) -> float:
+        now = time.time()
+        with self._bucket(key) as (key_hash, offset):
+            _, window_expiry, _ = self._find(key_hash, offset, now, create=False)
+            return window_expiry or now
+
+    def check(self) -> bool:
+        return not self._mm.closed
+
+    def clear(self, key: str) -> None:
+        with self._bucket(key) as (key_hash, offset):
+            slot_offset, _, _ = self._find(key_hash, offset, time.time(), create=False)
+            if slot_offset is not None:
+                SLOT.pack_into(self._mm, slot_offset, 0, 0.0, 0)
+
+    def reset(self) -> int:
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            live = 0
+            now = time.time()
+            for slot_offset in range(0, self.size, SLOT.size):
+                stored_hash, expiry, _ = SLOT.unpack_from(self._mm, slot_offset)
+                if stored_hash and expiry > now:
+                    live += 1
+            self._mm[:] = bytes(self.size)
+            return live
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
@@ -0,0 +1,98 @@
+"""
+Versioned in-memory snapshot of announcements and system settings.
+
+Both tables are tiny and change only through routers/admin.py, but
+GET /api/announcements is hit on every page load. Each worker keeps one
+immutable Snapshot holding every announcement (with the author's username
+already resolved), all settings, and the pre-encoded JSON bodies for
+/api/announcements. Requests read it without touching the database, and the
+ETag is derived from the version, so clients revalidate with a 304.
+
+The version is a counter stored in SystemSetting under VERSION_KEY. After
+an admin mutation, publish() increments it and rebuilds the local
+snapshot. Other workers poll the counter every CHECK_INTERVAL seconds (one
+unique-key lookup) from watch_loop() and rebuild when it has moved. A
+rebuild reads the counter and the data in one transaction, so a snapshot
+never pairs old rows with a new version.
+"""
+import asyncio
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import entity_cache
+from conditional import make_etag
+from models import db, Announcement, SystemSetting, User
+from serializers import dumps
+
+VERSION_KEY = "site_snapshot_version"
+CHECK_INTERVAL = float(os.getenv("SITE_SNAPSHOT_CHECK_INTERVAL", 2))
+
+@dataclass(frozen=True)
+class Snapshot:
+    version: int
+    announcements: List[dict]
+    settings: Dict[str, str]
+    bodies: Dict[bool, bytes] = field(repr=False) # active_only -> /api/announcements body
+
+    @property
+    def etag(self) -> str:
+        return make_etag("site", self.version)
+
+_current: Optional[Snapshot] = None
+_lock = threading.Lock()
+
+def read_version() -> int:
+    value = SystemSetting.select(SystemSetting.value).where(SystemSetting.key == VERSION_KEY).scalar()
+    return int(value) if value else 0
+
+def rebuild() -> Snapshot:
+    global _current
+    with _lock:
+        with db.atomic():
+            version = read_version()
+            rows = (Announcement.select(Announcement, User.username)
+                    .join(User)
+                    .order_by(Announcement.created_at.desc()))
+            announcements = [{
+                "id": a.id,
+                "content": a.content,
+                "type": a.type,
+                "active": a.active,
+                "created_at": a.created_at,
+                "created_by": a.created_by.username
+            } for a in rows]
+            settings = {s.key: s.value for s in SystemSetting.select().where(SystemSetting.key.not_in([VERSION_KEY, entity_cache.VERSION_KEY]))}
+        bodies = {
+            True: dumps([a for a in announcements if a["active"]]),
+            False: dumps(announcements)
+        }
+        _current = Snapshot(version, announcements, settings, bodies)
+        return _current
+
+def current() -> Snapshot:
+    return _current or rebuild()
+
+def setting(key: str, default: Optional[str] = None) -> Optional[str]:
+    return current().settings.get(key, default)
+
+def publish() -> Snapshot:
+    """Call after changing announcements or settings; bumps the shared version and rebuilds."""
+    (SystemSetting.insert(key=VERSION_KEY, value="1")
+     .on_conflict(conflict_target=[SystemSetting.key],
+                  update={SystemSetting.value: SystemSetting.value.cast("INTEGER") + 1})
+     .execute())
+    return rebuild()
+
+def check() -> None:
+    if _current is None or read_version() != _current.version:
+        rebuild()
+
+async def watch_loop() -> None:
+    while True:
+        try:
+            await asyncio.to_thread(check)
+        except Exception as e:
+            print(f"Site snapshot check error: {e}")
+        await asyncio.sleep(CHECK_INTERVAL)
@@ -0,0 +1,83 @@
+"""
+Job task definitions (see jobs.py). Imported by main.py so every worker
+can run them.
+"""
+from datetime import datetime, timedelta
+
+import analytics
+import cascade
+import image_proxy
+import jobs
+import moderation
+import timeline
+from models import Follow, Job, OAuthCode, Post, Work
+
+JOB_RETENTION = timedelta(days=7)
+
+# --- timeline ---
+
+@jobs.task("timeline.fan_out")
+def timeline_fan_out(author_id: int, item_type: str, item_id: int):
+    if item_type == "post":
+        item = Post.get_or_none(Post.id == item_id)
+    else:
+        item = Work.get_or_none(Work.work_id == item_id)
+    if item is None or item.is_deleted:
+        return  # deleted before we got to it
+    timeline.fan_out(author_id, item_type, item_id, item.created_at)
+
+@jobs.task("timeline.backfill_follow")
+def timeline_backfill_follow(follower_id: int, author_id: int):
+    if Follow.select().where((Follow.follower == follower_id) & (Follow.followed == author_id)).exists():
+        timeline.backfill_follow(follower_id, author_id)
+
+@jobs.periodic("17 * * * *", "timeline.trim")
+def timeline_trim():
+    removed = timeline.trim()
+    if removed:
+        print(f"Timeline trim: removed {removed} entries")
+
+# --- cascade deletes ---
+
+@jobs.task("cascade.run", queue="cascade", max_attempts=10)
+def cascade_run(deletion_id: int):
+    cascade.run(deletion_id)
+
+# --- moderation ---
+
+@jobs.task("moderation.run", queue="moderation", max_attempts=10)
+def moderation_run(action_id: int):
+    moderation.run(action_id)
+
+@jobs.task("moderation.undo", queue="moderation", max_attempts=10)
+def moderation_undo(action_id: int):
+    moderation.undo(action_id)
+
+# --- analytics ---
+
+@jobs.task("analytics.rebuild", queue="maintenance")
+def analytics_rebuild():
+    analytics.rebuild()
+
+@jobs.periodic("25 4 * * *", "analytics.prune")
+def analytics_prune():
+    removed = analytics.prune()
+    if removed:
+        print(f"Analytics prune: removed {removed} rows")
+
+# --- housekeeping ---
+
+@jobs.periodic("50 * * * *", "images.trim")
+def images_trim():
+    removed = image_proxy.trim()
+    if removed:
+        print(f"Image cache trim: removed {removed} files")
+
+@jobs.periodic("*/10 * * * *", "oauth.cleanup_codes")
+def cleanup_oauth_codes():
+    OAuthCode.delete().where(OAuthCode.expires_at < datetime.utcnow()).execute()
+
+@jobs.periodic("40 3 * * *", "jobs.purge")
+def purge_jobs():
+    """Drops finished jobs after JOB_RETENTION; failed ones stay until retried or purged by hand."""
+    Job.delete().where((Job.status == "done") & (Job.finished_at < datetime.utcnow() - JOB_RETENTION)).execute()
@@ -0,0 +1,151 @@
+"""
+Home timeline ("following" feed).
+
+Fan-out on write: a new post or work is pushed into the TimelineEntry rows
+of every follower, and of the author. The push is a single
+INSERT ... SELECT FROM follow, so the cost is one statement however many
+followers there are. Timelines are capped at TIMELINE_CAP entries per
+owner. trim() enforces the cap and runs hourly as a periodic job (tasks.py).
+fan_out() and backfill_follow() run as jobs too, so posting and following
+return without waiting on them.
+
+Fan-out on read: authors with more than CELEBRITY_FOLLOWERS followers are
+not pushed. The feed merges their recent items in at read time, which
+uses the (user, created_at) indexes on Post and Work.
+
+Reading a page costs a range scan of (owner, created_at) for `limit` rows,
+plus `limit` rows per followed celebrity, plus one IN query each to
+hydrate posts and works.
+"""
+import os
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from peewee import fn, Value
+
+from cache import TTLCache
+from models import db, Follow, Post, TimelineEntry, Work
+
+TIMELINE_CAP = int(os.getenv("TIMELINE_CAP", 800))
+CELEBRITY_FOLLOWERS = int(os.getenv("TIMELINE_CELEBRITY_FOLLOWERS", 2000))
+BACKFILL_ON_FOLLOW = 20
+
+_celebrities = TTLCache(maxsize=1, ttl=300)
+
+def celebrity_ids() -> set:
+    """Authors served by fan-out-on-read. Recomputed every few minutes."""
+    ids = _celebrities.get("ids")
+    if ids is None:
+        ids = {uid for (uid,) in Follow.select(Follow.followed)
+                                     .group_by(Follow.followed)
+                                     .having(fn.COUNT(Follow.id) > CELEBRITY_FOLLOWERS)
+                                     .tuples()}
+        _celebrities.set("ids", ids)
+    return ids
+
+def is_celebrity(user_id: int) -> bool:
+    if user_id in celebrity_ids():
+        return True
+    # The cached set can lag; check this author directly before a large fan-out
+    return Follow.select().where(Follow.followed == user_id).count() > CELEBRITY_FOLLOWERS
+
+def fan_out(author_id: int, item_type: str, item_id: int, created_at: datetime) -> None:
+    """Pushes a new item into the author's and their followers' timelines."""
+    with db.atomic():
+        TimelineEntry.insert(owner=author_id, author=author_id, item_type=item_type,
+                             item_id=item_id, created_at=created_at).on_conflict_ignore().execute()
+        if is_celebrity(author_id):
+            return
+        followers = Follow.select(Follow.follower, Value(author_id), Value(item_type), Value(item_id), Value(created_at)) \
+                          .where(Follow.followed == author_id)
+        (TimelineEntry
+         .insert_from(followers, fields=[TimelineEntry.owner, TimelineEntry.author, TimelineEntry.item_type,
+                                         TimelineEntry.item_id, TimelineEntry.created_at])
+         .on_conflict_ignore()
+         .execute())
+
+def backfill_follow(follower_id: int, author_id: int) -> None:
+    """Copies a newly followed author's recent items into the follower's timeline."""
+    if author_id in celebrity_ids():
+        return
+    rows = [{"owner": follower_id, "author": author_id, "item_type": "post", "item_id": p.id, "created_at": p.created_at}
+            for p in Post.select(Post.id, Post.created_at).where((Post.user == author_id) & (Post.is_deleted == False))
+                         .order_by(Post.created_at.desc()).limit(BACKFILL_ON_FOLLOW)]
+    rows += [{"owner": follower_id, "author": author_id, "item_type": "work", "item_id": w.work_id, "created_at": w.created_at}
+             for w in Work.select(Work.work_id, Work.created_at).where((Work.user == author_id) & (Work.is_deleted == False))
+                          .order_by(Work.created_at.desc()).limit(BACKFILL_ON_FOLLOW)]
+    if rows:
+        TimelineEntry.insert_many(rows).on_conflict_ignore().execute()
+
+def remove_follow(follower_id: int, author_id: int) -> None:
+    TimelineEntry.delete().where((TimelineEntry.owner == follower_id) & (TimelineEntry.author == author_id)).execute()
+
+def trim() -> int:
+    """Drops entries beyond TIMELINE_CAP per owner."""
+    ranked = (TimelineEntry
+              .select(TimelineEntry.id,
+                      fn.ROW_NUMBER().over(partition_by=[TimelineEntry.owner],
+                                           order_by=[TimelineEntry.created_at.desc()]).alias("rn"))
+              .alias("ranked"))
+    stale = (TimelineEntry.select(ranked.c.id).from_(ranked).where(ranked.c.rn > TIMELINE_CAP))
+    return TimelineEntry.delete().where(TimelineEntry.id.in_(stale)).execute()
+
+def parse_item(value: Optional[str]) -> Optional[Tuple[str, int]]:
+    if not value:
+        return None
+    try:
+        item_type, item_id = value.split(":", 1)
+        return item_type, int(item_id)
+    except ValueError:
+        raise ValueError("before_item must look like <type>:<id>")
+
+def _older(created_at, item_type, item_id, before: datetime, before_item: Optional[Tuple[str, int]]):
+    """
+    Condition for rows after the cursor in feed order (created_at, item_type,
+    item_id), all descending. item_type is a column, or a string for sources
+    that hold one type.
+    """
+    if before_item is None:
+        return created_at < before
+    t, i = before_item
+    if not isinstance(item_type, str):
+        tie = (item_type < t) | ((item_type == t) & (item_id < i))
+    elif item_type == t:
+        tie = item_id < i
+    else:
+        return (created_at < before) if item_type > t else (created_at <= before)
+    return (created_at < before) | ((created_at == before) & tie)
+
+def read_page(user_id: int, before: Optional[datetime], limit: int,
+              before_item: Optional[Tuple[str, int]] = None) -> List[tuple]:
+    """
+    Returns up to `limit` (created_at, item_type, item_id, author_id) tuples, newest first.
+    The cursor is the last row's created_at plus (item_type, item_id), which
+    breaks ties between items created in the same instant.
+    """
+    query = (TimelineEntry.select(TimelineEntry.created_at, TimelineEntry.item_type, TimelineEntry.item_id,
+                                  TimelineEntry.author)
+             .where(TimelineEntry.owner == user_id))
+    if before is not None:
+        query = query.where(_older(TimelineEntry.created_at, TimelineEntry.item_type, TimelineEntry.item_id,
+                                   before, before_item))
+    items = list(query.order_by(TimelineEntry.created_at.desc(), TimelineEntry.item_type.desc(),
+                                TimelineEntry.item_id.desc()).limit(limit).tuples())
+
+    celebs = celebrity_ids()
+    if celebs:
+        followed = [uid for (uid,) in Follow.select(Follow.followed)
+                    .where((Follow.follower == user_id) & (Follow.followed.in_(list(celebs)))).tuples()]
+        for author_id in followed:
+            posts = Post.select(Post.created_at, Value("post"), Post.id, Post.user).where((Post.user == author_id) & (Post.is_deleted == False))
+            works = Work.select(Work.created_at, Value("work"), Work.work_id, Work.user).where((Work.user == author_id) & (Work.is_deleted == False))
+            if before is not None:
+                posts = posts.where(_older(Post.created_at, "post", Post.id, before, before_item))
+                works = works.where(_older(Work.created_at, "work", Work.work_id, before, before_item))
+            items += list(posts.order_by(Post.created_at.desc(), Post.id.desc()).limit(limit).tuples())
+            items += list(works.order_by(Work.created_at.desc(), Work.work_id.desc()).limit(limit).tuples())
+        # Celebrity items may also have been pushed before the author crossed the threshold
+        items = list({(t, i): (c, t, i, a) for c, t, i, a in items}.values())
+        items.sort(key=lambda row: row[:3], reverse=True)
+        items = items[:limit]
+    return items
@@ -0,0 +1,131 @@
+import html
+import re
+from typing import Dict, Iterable, Optional
+
+from cache import TTLCache
+from models import Work, User, on_model_write
+
+WORK_TAG_RE = re.compile(r'\[work:(\d+)\]')
+
+# Card data for works in our DB, keyed by Codemao work_id
+card_cache = TTLCache(maxsize=4096, ttl=600)
+# Full work info fetched live from Codemao by works.get_work_info, keyed by work_id
+live_work_cache = TTLCache(maxsize=2048, ttl=600)
+
+def invalidate_work_card(work_id: int) -> None:
+    card_cache.delete(work_id)
+
+@on_model_write
+def _invalidate_on_write(instance, deleted: bool) -> None:
+    if isinstance(instance, Work):
+        invalidate_work_card(instance.work_id)
+
+def remember_live_work(work_id: int, info: dict) -> None:
+    live_work_cache.set(work_id, info)
+
+def _card_from_row(row: dict) -> dict:
+    # Same display rules as works.get_works: imported works show the original author
+    if row["original_author_id"]:
+        nickname = row["original_author_name"] or "Original Developer"
+        avatar = row["original_author_avatar"]
+    else:
+        nickname = row["username"]
+        avatar = row["avatar_url"]
+    return {
+        "work_id": row["work_id"],
+        "work_name": row["name"],
+        "preview_url": row["cover_url"],
+        "avatar_url": avatar,
+        "nickname": nickname,
+        "views_count": row["views"],
+        "likes_count": row["likes"]
+    }
+
+def _card_from_live(info: dict) -> dict:
+    return {key: info.get(key) for key in ("work_id", "work_name", "preview_url", "avatar_url", "nickname", "views_count", "likes_count")}
+
+def resolve_work_cards(work_ids: Iterable[int]) -> Dict[int, Optional[dict]]:
+    """
+    Resolves card data for many works at once: cache first, then a single
+    IN query for the card columns, then the live-work cache for works we
+    don't store. Unknown works map to None.
+    """
+    cards = {}
+    pending = []
+    for work_id in set(work_ids):
+        card = card_cache.get(work_id)
+        if card is not None:
+            cards[work_id] = card
+        else:
+            pending.append(work_id)
+
+    if pending:
+        rows = (Work.select(Work.work_id, Work.name, Work.cover_url, Work.likes, Work.views,
+                            Work.original_author_id, Work.original_author_name, Work.original_author_avatar,
+                            User.username, User.avatar_url)
+                .join(User)
+                .where(Work.work_id.in_(pending) & (Work.is_deleted == False))
+                .dicts())
+        for row in rows:
+            card = _card_from_row(row)
+            card_cache.set(row["work_id"], card)
+            cards[row["work_id"]] = card
+
+    for work_id in pending:
+        if work_id in cards:
+            continue
+        live = live_work_cache.get(work_id)
+        cards[work_id] = _card_from_live(live) if live else None
+
+    return cards
+
+def render_work_card(card: dict) -> str:
+    esc = lambda value: html.escape(str(value if value is not None else ""), quote=True)
+    return f"""
+                <div class="work-card">
+                    <a href="https://shequ.codemao.cn/work/{esc(card['work_id'])}" target="_blank" class="work-link">
+                        <div class="work-cover" style="background-image: url('{esc(card['preview_url'])}')"></div>
+                        <div class="work-info">
+                            <div class="work-title">{esc(card['work_name'])}</div>
+                            <div class="work-author">
+                                <img src="{esc(card['avatar_url'])}" alt="Avatar">
+                                <span>{esc(card['nickname'])}</span>
+                            </div>
+                            <div class="work-stats">
+                                <span>👁️ {esc(card['views_count'])}</span>
+                                <span>❤️ {esc(card['likes_count'])}</span>
+                            </div>
+                        </div>
+                    </a>
+                </div>
+                """
+
+def resolve_tags(clean_html: str) -> Dict[int, Optional[dict]]:
+    """Card data for every [work:ID] tag in the HTML; also what embed ETags are computed from."""
+    work_ids = [int(m) for m in WORK_TAG_RE.findall(clean_html)]
+    return resolve_work_cards(work_ids) if work_ids else {}
+
+def cards_version(cards: Dict[int, Optional[dict]]) -> tuple:
+    """Stable digest input for resolved cards, the same on every worker."""
+    return tuple((work_id, tuple(sorted(card.items())) if card else None) for work_id, card in sorted(cards.items()))
+
+def expand_work_tags(clean_html: str, cards: Optional[Dict[int, Optional[dict]]] = None) -> str:
+    """Replaces every [work:ID] tag in rendered post HTML with a work card. Pass cards from resolve_tags() to reuse them."""
+    if not WORK_TAG_RE.search(clean_html):
+        return clean_html
+
+    if cards is None:
+        try:
+            cards = resolve_tags(clean_html)
+        except Exception as e:
+            print(f"Error resolving work cards: {e}")
+            return WORK_TAG_RE.sub('<span style="color:red">[Error loading work]</span>', clean_html)
+
+    def replace_work_tag(match):
+        work_id = int(match.group(1))
+        card = cards.get(work_id)
+        if not card:
+            return f'<div class="work-card-error" style="padding:10px; background:#fee; color:red; border-radius:4px;">Work ID {work_id} not found</div>'
+        return render_work_card(card)
+
+    return WORK_TAG_RE.sub(replace_work_tag, clean_html)
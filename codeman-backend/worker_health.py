@@ -0,0 +1,88 @@
+"""
+Per-worker health reporting for multi-process serving (see serve.py).
+
+Every worker writes a small JSON heartbeat file into RUN_DIR every
+HEARTBEAT_INTERVAL seconds. /api/health reads all of them, so whichever worker
+answers can report on its siblings. A worker whose heartbeat is older than
+STALE_AFTER seconds is reported as not alive.
+"""
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+RUN_DIR = os.getenv("CODEMAN_RUN_DIR", os.path.join(tempfile.gettempdir(), "codeman-workers"))
+HEARTBEAT_INTERVAL = 5
+STALE_AFTER = 3 * HEARTBEAT_INTERVAL
+
+started_at = time.time()
+requests_served = 0
+
+def _path(pid: int) -> str:
+    return os.path.join(RUN_DIR, f"worker-{pid}.json")
+
+def count_request() -> None:
+    global requests_served
+    requests_served += 1
+
+def snapshot() -> dict:
+    return {
+        "pid": os.getpid(),
+        "started_at": started_at,
+        "last_beat": time.time(),
+        "requests": requests_served
+    }
+
+def write_heartbeat() -> None:
+    os.makedirs(RUN_DIR, exist_ok=True)
+    path = _path(os.getpid())
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(tmp_path, path)
+
+def remove_heartbeat() -> None:
+    try:
+        os.remove(_path(os.getpid()))
+    except OSError:
+        pass
+
+async def heartbeat_loop() -> None:
+    while True:
+        try:
+            write_heartbeat()
+        except OSError as e:
+            print(f"Heartbeat write failed: {e}")
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+def read_workers() -> list:
+    now = time.time()
+    workers = []
+    try:
+        names = os.listdir(RUN_DIR)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if not (name.startswith("worker-") and name.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(RUN_DIR, name)) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            continue  # being replaced or removed right now
+        info["alive"] = now - info.get("last_beat", 0) < STALE_AFTER
+        workers.append(info)
+    workers.sort(key=lambda w: w["pid"])
+    return workers
+
+def clear_run_dir() -> None:
+    """Removes heartbeats left by a previous run. Called by serve.py before starting workers."""
+    if not os.path.isdir(RUN_DIR):
+        return
+    for name in os.listdir(RUN_DIR):
+        if name.startswith("worker-"):
+            try:
+                os.remove(os.path.join(RUN_DIR, name))
+            except OSError:
+                pass